@@ -0,0 +1,211 @@
+import asyncio
+import importlib.util
+import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Set, Tuple
+
+import httpx
+from anthropic import AsyncAnthropic
+from openai import AsyncOpenAI
+
+from config import (
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_RETRIES,
+    LLM_MAX_RETRIES,
+)
+
+# HTTP/2 needs the optional h2 package (httpx[http2]); fall back to HTTP/1.1 keep-alive without it
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Transient upstream failures worth retrying
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+# SDK clients keyed by credentials; the API key can come from the client-side settings dialog
+MAX_SDK_CLIENTS = 16
+
+
+class LatencyHistogram:
+    """
+    In-process per-upstream latency histogram (seconds), cumulative like Prometheus buckets.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.counts: Dict[str, List[int]] = {}
+        self.sums: Dict[str, float] = {}
+
+    def observe(self, upstream: str, seconds: float):
+        counts = self.counts.setdefault(upstream, [0] * (len(self.BUCKETS) + 1))
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                counts[i] += 1
+        counts[-1] += 1  # +Inf
+        self.sums[upstream] = self.sums.get(upstream, 0.0) + seconds
+
+    @contextmanager
+    def time(self, upstream: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(upstream, time.perf_counter() - start)
+
+    def snapshot(self):
+        return {
+            upstream: {
+                "buckets": dict(zip([str(b) for b in self.BUCKETS] + ["+Inf"], counts)),
+                "count": counts[-1],
+                "sum": round(self.sums[upstream], 4),
+            }
+            for upstream, counts in self.counts.items()
+        }
+
+
+upstream_latency = LatencyHistogram()
+
+_http_client: httpx.AsyncClient | None = None
+_openai_clients: "OrderedDict[Tuple[str, str | None], AsyncOpenAI]" = OrderedDict()
+_anthropic_clients: "OrderedDict[str, AsyncAnthropic]" = OrderedDict()
+# Active leases per SDK client, and evicted clients that are closed once their last lease is released
+_leases: Dict[Any, int] = {}
+_evicted: Set[Any] = set()
+_closing: Set["asyncio.Task[None]"] = set()
+
+
+def _new_http_client(timeout: float = 60) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(timeout, connect=5),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+        # Connection-level retries (refused/reset while connecting) are handled by the transport
+        transport=httpx.AsyncHTTPTransport(http2=HTTP2_AVAILABLE, retries=HTTP_RETRIES),
+    )
+
+
+def init_clients():
+    get_http_client()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    # Application-lifetime pooled client; created lazily for scripts that bypass the app lifespan
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _new_http_client()
+    return _http_client
+
+
+class ClientLease:
+    """
+    Holds an SDK client for the duration of an `async with` block. A client evicted from
+    the cache while leased (e.g. mid-stream) is closed when its last lease is released.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def __aenter__(self):
+        _leases[self.client] = _leases.get(self.client, 0) + 1
+        return self.client
+
+    async def __aexit__(self, *exc_info):
+        _leases[self.client] -= 1
+        if _leases[self.client] == 0:
+            del _leases[self.client]
+            if self.client in _evicted:
+                _evicted.discard(self.client)
+                _close_later(self.client)
+
+
+def _close_later(client):
+    # Keep a reference to the task so it is not garbage collected before the pool is closed
+    task = asyncio.get_running_loop().create_task(client.close())
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+
+def _remember(cache: OrderedDict, key, factory) -> ClientLease:
+    client = cache.get(key)
+    if client is None:
+        client = cache[key] = factory()
+        while len(cache) > MAX_SDK_CLIENTS:
+            _, evicted = cache.popitem(last=False)
+            if evicted in _leases:
+                _evicted.add(evicted)
+            else:
+                _close_later(evicted)
+    cache.move_to_end(key)
+    return ClientLease(client)
+
+
+def openai_client(api_key: str, base_url: str | None = None) -> ClientLease:
+    # The SDK retries connection errors, 408/409/429 and 5xx with exponential backoff
+    return _remember(
+        _openai_clients,
+        (api_key, base_url),
+        lambda: AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            max_retries=LLM_MAX_RETRIES,
+            http_client=_new_http_client(timeout=600),
+        ),
+    )
+
+
+def anthropic_client(api_key: str) -> ClientLease:
+    return _remember(
+        _anthropic_clients,
+        api_key,
+        lambda: AsyncAnthropic(
+            api_key=api_key,
+            max_retries=LLM_MAX_RETRIES,
+            http_client=_new_http_client(timeout=600),
+        ),
+    )
+
+
+async def request_with_retry(
+    method: str,
+    url: str,
+    upstream: str,
+    retries: int = HTTP_RETRIES,
+    backoff: float = 0.5,
+    **kwargs,
+) -> httpx.Response:
+    """
+    Send a request on the shared client, retrying transport errors and 429/502/503/504
+    with jittered exponential backoff. Every attempt is recorded in the upstream histogram.
+    """
+    client = get_http_client()
+    for attempt in range(retries + 1):
+        try:
+            with upstream_latency.time(upstream):
+                response = await client.request(method, url, **kwargs)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return response
+            await response.aclose()
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+        await asyncio.sleep(backoff * 2**attempt * random.uniform(0.5, 1.0))
+    raise AssertionError("unreachable")
+
+
+async def close_clients():
+    global _http_client
+    clients = [_http_client, *_openai_clients.values(), *_anthropic_clients.values(), *_evicted]
+    _http_client = None
+    _openai_clients.clear()
+    _anthropic_clients.clear()
+    _evicted.clear()
+    await asyncio.gather(
+        *[client.aclose() if isinstance(client, httpx.AsyncClient) else client.close() for client in clients if client is not None],
+        *_closing,
+        return_exceptions=True,
+    )
@@ -5,6 +5,32 @@ import os
 
 ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", None)
 
+# OCR engine pool: number of warm PaddleOCR engines (and worker threads) per backend process
+OCR_POOL_SIZE = int(os.environ.get("OCR_POOL_SIZE", 1))
+OCR_USE_GPU = os.environ.get("OCR_USE_GPU", "False") == "True"
+# Ask model serve to mask the interiors of detected symbols that carry no text before OCR
+# (served OCR only; tiling is configured in the OCRTransform user_config)
+OCR_MASK_SYMBOLS = os.environ.get("OCR_MASK_SYMBOLS", "False") == "True"
+# Shared upstream HTTP clients (model serve, OpenAI, Anthropic): pool limits and retries
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 2))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 3))
+
+# Number of drawings recognized concurrently per /recognition request
+RECOGNITION_CONCURRENCY = int(os.environ.get("RECOGNITION_CONCURRENCY", 4))
+
+# How drawings are compared: "local" runs the deterministic diff engine, "llm" sends the
+# recognition results to the LLM as before. LLM_SUMMARY adds an optional LLM-written summary
+# on top of the local diff.
+DIFF_ENGINE = os.environ.get("DIFF_ENGINE", "local")
+LLM_SUMMARY = os.environ.get("LLM_SUMMARY", "False") == "True"
+# Token budget of the compact detection/OCR payload sent on the DIFF_ENGINE=llm path
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 6000))
+
+# Run OCR in the model serve OCRTransform deployment (in parallel with detection) instead of the local pool
+MODEL_SERVE_OCR = os.environ.get("MODEL_SERVE_OCR", "True") == "True"
+
 # Debugging-related
 
 SHOULD_MOCK_AI_RESPONSE = bool(os.environ.get("MOCK", False))
@@ -1,54 +1,3 @@
-import asyncio
-from typing import List,Union,Awaitable, Callable
-
-STREAM_CHUNK_SIZE = 2000
-
-
-async def detect_completion(
-    process_chunk: Callable[[str], Awaitable[None]], result: List[Union[str, None]]
-) -> str:
-    html = generate_html_response(result)
-    
-    for i in range(0, len(html), STREAM_CHUNK_SIZE):
-        await process_chunk(html[i : i + STREAM_CHUNK_SIZE])
-        await asyncio.sleep(0.01)
-        
-    return html
-
-
-def generate_html_response(result):
-    # Add heading
-    html = f"<html>{HEAD}<body>"
-    # Add detect result
-    html += f"""
-    <div class="container">
-		<h3>元件识别结果</h3>
-        <div class="iamge-container">
-    		<img class="responsive-image" src="data:image/png;base64,{result[0]["detect_result"]["image_with_box"]}" >
-    		<img class="responsive-image" src="data:image/png;base64,{result[1]["detect_result"]["image_with_box"]}">
-        </div>
-      <div>
-        <div class="iamge-container">
-            <h3>OCR转换结果1</h3>
-    		<img class="responsive-image" src="data:image/png;base64,{result[0]["ocr_result"]["draw_image"]}">
-            <h4>文本内容</h4>
-            <div type="text" class="input">
-                {",".join(result[0]["ocr_result"]["texts"])}
-            </div>
-            <h3>OCR转换结果2</h3>
-    		<img class="responsive-image" src="data:image/png;base64,{result[1]["ocr_result"]["draw_image"]}">
-            <h4>文本内容</h4>
-            <div type="text" class="input">
-                {",".join(result[1]["ocr_result"]["texts"])}
-            </div>
-        </div>
-      </div>
-    </div>
-    """
-    html += f"""<script>{JS}</script>"""
-    return html
-
-
 def generate_match_response(message):
     html = f"<div class='result'>{message}</div>"
     html += f"{MACTCH_REUSLT}"
@@ -69,6 +18,33 @@ def generate_org_response(message):
     """
     return html
 
+def generate_partial_response(index, detect_result, ocr_result):
+    # 单张图纸识别完成后推送的中间结果: 各类元件数量和识别到的文字
+    counts = {}
+    for classtext in detect_result.get("classtexts", []):
+        counts[classtext] = counts.get(classtext, 0) + 1
+    symbols = "，".join(f"{name} x{count}" for name, count in counts.items()) or "未识别到元件"
+    texts = ",".join((ocr_result or {}).get("texts", []))
+    return f"""
+    <div class="result">
+        <h4>图纸{index + 1} 识别完成</h4>
+        <div class="input">元件：{symbols}</div>
+        <div class="input">文本内容：{texts}</div>
+    </div>
+    """
+
+def generate_region_response(index, label, region):
+    # 大模型流式输出中每解析出一个差异框就推送该区域的标注截图
+    return f"""
+    <div class="result">
+        <h4>图纸{index + 1}：{label}</h4>
+        <img class="image" src="data:image/png;base64,{region}">
+    </div>
+    """
+
+def generate_detail_response(line):
+    return f"<div class='input'><p>{line}</p></div>"
+
 def generate_image_response(message,detail,describe):
     # Add heading
     #html = f"<html>{HEAD}<body>"
@@ -0,0 +1,312 @@
+"""
+本地确定性的图纸比对引擎
+
+输入为 /recognition 中每张图纸的 detect_result / ocr_result, 输出与大模型返回相同结构的 differences JSON,
+供 posts_respose / utils.draw_box 使用:
+    {"differences": {"images": [{"imageid": 0, "boxes": [{"bbox": [x1, y1, x2, y2], "label": ""}]}, ...],
+                     "detail": [...], "describe": "", "difference": [...]}}
+
+步骤:
+1. 对齐: 两张图中唯一且相同的文字作为锚点(不足时用同类元件的互为最近邻), 拟合每个方向的缩放 + 平移
+2. 元件匹配: 对齐后的位置、尺寸、外观(灰度缩略图的余弦相似度)和类别组成代价矩阵, 匈牙利算法求解
+3. 文字匹配: 对齐后的位置和编辑距离组成代价矩阵, 同样用匈牙利算法求解
+未匹配的元件 / 文字为新增或删除, 匹配上但类别或内容不同的为修改
+"""
+from collections import Counter
+
+import cv2
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+import utils.utils as utils
+
+INFEASIBLE = 1e6
+
+
+def edit_distance(a: str, b: str) -> int:
+    # Levenshtein 距离, 单行 DP
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def quad_to_xyxy(quad):
+    points = np.asarray(quad, dtype=np.float64).reshape(-1, 2)
+    return [*points.min(axis=0), *points.max(axis=0)]
+
+
+def centers(boxes: np.ndarray) -> np.ndarray:
+    return (boxes[:, :2] + boxes[:, 2:]) / 2 if len(boxes) else np.zeros((0, 2))
+
+
+class SheetTransform:
+    """
+    x' = sx * x + tx, y' = sy * y + ty, 把图 A 的坐标映射到图 B
+    CAD 图纸的修订版一般只有缩放和平移, 不考虑旋转
+    """
+
+    def __init__(self, scale, offset):
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.offset = np.asarray(offset, dtype=np.float64)
+
+    def points(self, points: np.ndarray) -> np.ndarray:
+        return points * self.scale + self.offset
+
+    def boxes(self, boxes: np.ndarray) -> np.ndarray:
+        if len(boxes) == 0:
+            return boxes
+        return np.concatenate([self.points(boxes[:, :2]), self.points(boxes[:, 2:])], axis=1)
+
+    @classmethod
+    def from_sizes(cls, size_a, size_b):
+        # 没有可靠锚点时按图片尺寸等比映射
+        (wa, ha), (wb, hb) = size_a, size_b
+        return cls([wb / wa, hb / ha], [0, 0])
+
+    @classmethod
+    def fit(cls, src: np.ndarray, dst: np.ndarray, fallback: "SheetTransform", iterations=3):
+        # 每个方向独立最小二乘, 每轮剔除残差大于 3 倍中位数的锚点
+        if len(src) < 3:
+            return fallback
+        keep = np.ones(len(src), dtype=bool)
+        scale, offset = fallback.scale.copy(), fallback.offset.copy()
+        for _ in range(iterations):
+            if keep.sum() < 3:
+                break
+            for axis in range(2):
+                A = np.stack([src[keep, axis], np.ones(keep.sum())], axis=1)
+                (scale[axis], offset[axis]), *_ = np.linalg.lstsq(A, dst[keep, axis], rcond=None)
+            residual = np.linalg.norm(src * scale + offset - dst, axis=1)
+            keep = residual <= max(3 * np.median(residual[keep]), 1.0)
+        # 拟合出的缩放明显不合理时(锚点退化)退回尺寸映射
+        if np.any(scale <= 0) or np.any(np.abs(np.log(scale / fallback.scale)) > np.log(2)):
+            return fallback
+        return cls(scale, offset)
+
+
+class Sheet:
+    def __init__(self, result: dict):
+        image = np.asarray(utils.base64_to_pil(result["org_image"].split(",")[-1]).convert("L"))
+        self.gray = image
+        self.size = (image.shape[1], image.shape[0])
+        self.diag = float(np.hypot(*self.size))
+
+        detect_result = result.get("detect_result") or {}
+        self.boxes = np.asarray(detect_result.get("boxes", []), dtype=np.float64).reshape(-1, 4)
+        self.classes = list(detect_result.get("classtexts", []))
+
+        detections = (result.get("ocr_result") or {}).get("detections", [])
+        self.text_boxes = np.asarray([quad_to_xyxy(d["bbox"]) for d in detections], dtype=np.float64).reshape(-1, 4)
+        self.texts = [str(d["text"]).strip() for d in detections]
+
+    def descriptors(self, boxes: np.ndarray, size=32) -> np.ndarray:
+        # 元件外观描述: 灰度缩略图去均值后归一化, 内积即余弦相似度
+        h, w = self.gray.shape
+        features = np.zeros((len(boxes), size * size), dtype=np.float32)
+        for i, (x1, y1, x2, y2) in enumerate(np.round(boxes).astype(int)):
+            x1, y1, x2, y2 = max(0, x1), max(0, y1), min(w, x2), min(h, y2)
+            if x2 - x1 < 2 or y2 - y1 < 2:
+                continue
+            crop = cv2.resize(self.gray[y1:y2, x1:x2], (size, size), interpolation=cv2.INTER_AREA).astype(np.float32).ravel()
+            crop -= crop.mean()
+            norm = np.linalg.norm(crop)
+            if norm > 0:
+                features[i] = crop / norm
+        return features
+
+
+class DiffEngine:
+    def __init__(self, position_tol=0.03, class_penalty=0.5, appearance_weight=0.5, size_weight=0.5, max_symbol_cost=3.0, max_text_distance=0.6):
+        """
+        :param position_tol: 位置门限, 相对图 B 对角线的比例, 超过门限的两个对象不会被匹配
+        :param class_penalty: 元件类别不同时的附加代价, 同一位置类别改变会被报告为修改
+        :param appearance_weight: 外观差异 (1 - 余弦相似度) 的权重
+        :param size_weight: 尺寸差异的权重
+        :param max_symbol_cost: 元件匹配的最大代价
+        :param max_text_distance: 文字匹配允许的最大归一化编辑距离, 超过时视为删除 + 新增
+        """
+        self.position_tol = position_tol
+        self.class_penalty = class_penalty
+        self.appearance_weight = appearance_weight
+        self.size_weight = size_weight
+        self.max_symbol_cost = max_symbol_cost
+        self.max_text_distance = max_text_distance
+
+    def align(self, a: Sheet, b: Sheet) -> SheetTransform:
+        fallback = SheetTransform.from_sizes(a.size, b.size)
+        # 1. 两张图中都只出现一次的相同文字(位号、管线号)是最可靠的锚点
+        count_a, count_b = Counter(a.texts), Counter(b.texts)
+        anchors = [t for t in count_a if len(t) >= 2 and count_a[t] == 1 and count_b.get(t) == 1]
+        src = [centers(a.text_boxes[[a.texts.index(t)]])[0] for t in anchors]
+        dst = [centers(b.text_boxes[[b.texts.index(t)]])[0] for t in anchors]
+        # 2. 锚点不足时补充同类元件在尺寸映射下的互为最近邻
+        if len(anchors) < 3 and len(a.boxes) and len(b.boxes):
+            ca, cb = fallback.points(centers(a.boxes)), centers(b.boxes)
+            distance = np.linalg.norm(ca[:, None] - cb[None], axis=2)
+            distance[np.array(a.classes)[:, None] != np.array(b.classes)[None]] = np.inf
+            nearest_b, nearest_a = distance.argmin(axis=1), distance.argmin(axis=0)
+            for i, j in enumerate(nearest_b):
+                if nearest_a[j] == i and distance[i, j] <= self.position_tol * 3 * b.diag:
+                    src.append(centers(a.boxes[[i]])[0])
+                    dst.append(cb[j])
+        return SheetTransform.fit(np.array(src).reshape(-1, 2), np.array(dst).reshape(-1, 2), fallback)
+
+    def match_symbols(self, a: Sheet, b: Sheet, transform: SheetTransform):
+        # 返回 [(i, j)] 匹配对
+        if len(a.boxes) == 0 or len(b.boxes) == 0:
+            return []
+        boxes_a = transform.boxes(a.boxes)
+        gate = self.position_tol * b.diag
+        distance = np.linalg.norm(centers(boxes_a)[:, None] - centers(b.boxes)[None], axis=2) / gate
+        wh_a = np.maximum(boxes_a[:, 2:] - boxes_a[:, :2], 1)
+        wh_b = np.maximum(b.boxes[:, 2:] - b.boxes[:, :2], 1)
+        size = np.abs(np.log(wh_a[:, None] / wh_b[None])).sum(axis=2)
+        appearance = 1 - a.descriptors(a.boxes) @ b.descriptors(b.boxes).T
+        different_class = np.array(a.classes)[:, None] != np.array(b.classes)[None]
+        cost = distance + self.size_weight * size + self.appearance_weight * appearance + self.class_penalty * different_class
+        cost[distance > 1] = INFEASIBLE
+        rows, cols = linear_sum_assignment(cost)
+        return [(i, j) for i, j in zip(rows, cols) if cost[i, j] <= self.max_symbol_cost]
+
+    def match_texts(self, a: Sheet, b: Sheet, transform: SheetTransform):
+        # 返回 [(i, j, 归一化编辑距离)] 匹配对
+        if len(a.text_boxes) == 0 or len(b.text_boxes) == 0:
+            return []
+        gate = self.position_tol * b.diag
+        distance = np.linalg.norm(centers(transform.boxes(a.text_boxes))[:, None] - centers(b.text_boxes)[None], axis=2) / gate
+        cost = np.full(distance.shape, INFEASIBLE)
+        text_distance = np.ones(distance.shape)
+        # 只对位置门限内的候选计算编辑距离
+        for i, j in zip(*np.nonzero(distance <= 1)):
+            ta, tb = a.texts[i], b.texts[j]
+            text_distance[i, j] = edit_distance(ta, tb) / max(len(ta), len(tb), 1)
+            cost[i, j] = distance[i, j] + 2 * text_distance[i, j]
+        rows, cols = linear_sum_assignment(cost)
+        return [(i, j, text_distance[i, j]) for i, j in zip(rows, cols)
+                if cost[i, j] < INFEASIBLE and text_distance[i, j] <= self.max_text_distance]
+
+    def pair(self, result_a: dict, result_b: dict):
+        # 对齐后匹配两张图的元件和文字, 返回 (a, b, symbol_pairs, text_pairs)
+        a, b = Sheet(result_a), Sheet(result_b)
+        transform = self.align(a, b)
+        return a, b, self.match_symbols(a, b, transform), self.match_texts(a, b, transform)
+
+    def compare(self, result_a: dict, result_b: dict, id_a=0, id_b=1):
+        a, b, symbol_pairs, text_pairs = self.pair(result_a, result_b)
+        boxes_a, boxes_b, detail, labels = [], [], [], []
+        name_a, name_b = f"图片{id_a + 1}", f"图片{id_b + 1}"
+
+        def box(bbox, label):
+            return {"bbox": [int(round(v)) for v in bbox], "label": label}
+
+        def where(bbox):
+            return f"({int(bbox[0])},{int(bbox[1])})"
+
+        matched_a = {i for i, _ in symbol_pairs}
+        matched_b = {j for _, j in symbol_pairs}
+        for i, j in symbol_pairs:
+            if a.classes[i] != b.classes[j]:
+                label = f"{a.classes[i]}->{b.classes[j]}"
+                boxes_a.append(box(a.boxes[i], label))
+                boxes_b.append(box(b.boxes[j], label))
+                detail.append(f"{name_a} {where(a.boxes[i])} 区域是{a.classes[i]}，而{name_b}对应位置是{b.classes[j]}")
+                labels.append(label)
+        for i in sorted(set(range(len(a.boxes))) - matched_a):
+            boxes_a.append(box(a.boxes[i], a.classes[i]))
+            detail.append(f"{name_a} {where(a.boxes[i])} 区域有{a.classes[i]}，而{name_b}没有")
+            labels.append(a.classes[i])
+        for j in sorted(set(range(len(b.boxes))) - matched_b):
+            boxes_b.append(box(b.boxes[j], b.classes[j]))
+            detail.append(f"{name_b} {where(b.boxes[j])} 区域有{b.classes[j]}，而{name_a}没有")
+            labels.append(b.classes[j])
+
+        matched_a = {i for i, _, _ in text_pairs}
+        matched_b = {j for _, j, _ in text_pairs}
+        changed_texts = 0
+        for i, j, text_distance in text_pairs:
+            if text_distance > 0:
+                changed_texts += 1
+                boxes_a.append(box(a.text_boxes[i], a.texts[i]))
+                boxes_b.append(box(b.text_boxes[j], b.texts[j]))
+                detail.append(f"{name_a}的ocr内容是{a.texts[i]}，{name_b}的ocr是{b.texts[j]}，不一致")
+                labels.append(f"{a.texts[i]}->{b.texts[j]}")
+        removed_texts = sorted(set(range(len(a.text_boxes))) - matched_a)
+        added_texts = sorted(set(range(len(b.text_boxes))) - matched_b)
+        for i in removed_texts:
+            boxes_a.append(box(a.text_boxes[i], a.texts[i]))
+            detail.append(f"{name_a} {where(a.text_boxes[i])} 区域有文字{a.texts[i]}，而{name_b}没有")
+            labels.append(a.texts[i])
+        for j in added_texts:
+            boxes_b.append(box(b.text_boxes[j], b.texts[j]))
+            detail.append(f"{name_b} {where(b.text_boxes[j])} 区域有文字{b.texts[j]}，而{name_a}没有")
+            labels.append(b.texts[j])
+
+        changed_symbols = sum(a.classes[i] != b.classes[j] for i, j in symbol_pairs)
+        stats = {
+            "symbols_changed": changed_symbols,
+            "symbols_removed": len(a.boxes) - len(symbol_pairs),
+            "symbols_added": len(b.boxes) - len(symbol_pairs),
+            "texts_changed": changed_texts,
+            "texts_removed": len(removed_texts),
+            "texts_added": len(added_texts),
+        }
+        return boxes_a, boxes_b, detail, labels, stats
+
+
+def describe(stats: dict, name_a="图片1", name_b="图片2"):
+    if not any(stats.values()):
+        return f"{name_a}和{name_b}的元件和文字一致，没有差异"
+    return (f"元件：{name_b}相对{name_a}新增{stats['symbols_added']}个、删除{stats['symbols_removed']}个、类型改变{stats['symbols_changed']}个；"
+            f"文字：新增{stats['texts_added']}处、删除{stats['texts_removed']}处、内容改变{stats['texts_changed']}处")
+
+
+def compare_results(results: list, engine: DiffEngine | None = None) -> dict:
+    """
+    比对 /recognition 的识别结果, results[0] 为基准图, 其余图纸逐一与基准图比对
+    :param results: [{"org_image", "detect_result", "ocr_result"}, ...]
+    :return: {"differences": {...}}, 结构与大模型的返回一致; stats 为各类差异的数量
+    """
+    engine = engine or DiffEngine()
+    images = [{"imageid": index, "boxes": []} for index in range(len(results))]
+    detail, labels, summaries, all_stats = [], [], [], []
+    for index in range(1, len(results)):
+        boxes_a, boxes_b, pair_detail, pair_labels, stats = engine.compare(results[0], results[index], 0, index)
+        images[0]["boxes"].extend(boxes_a)
+        images[index]["boxes"].extend(boxes_b)
+        detail.extend(pair_detail)
+        labels.extend(pair_labels)
+        summaries.append(describe(stats, "图片1", f"图片{index + 1}"))
+        all_stats.append(stats)
+    return {
+        "differences": {
+            "images": images,
+            "detail": detail,
+            "describe": "；".join(summaries),
+            "difference": labels,
+        },
+        "stats": all_stats,
+    }
+
+
+def differing_items(results: list, engine: DiffEngine | None = None) -> list:
+    """
+    本地预匹配后仍不一致的元件和文字: 未匹配的, 以及匹配上但类别 / 内容不同的
+    :return: 每张图一个 {"symbols": set(索引), "texts": set(索引)}, 基准图取与其余各图比对结果的并集
+    """
+    engine = engine or DiffEngine()
+    items = [{"symbols": set(), "texts": set()} for _ in results]
+    for index in range(1, len(results)):
+        a, b, symbol_pairs, text_pairs = engine.pair(results[0], results[index])
+        same_symbols = [(i, j) for i, j in symbol_pairs if a.classes[i] == b.classes[j]]
+        same_texts = [(i, j) for i, j, text_distance in text_pairs if text_distance == 0]
+        items[0]["symbols"] |= set(range(len(a.boxes))) - {i for i, _ in same_symbols}
+        items[0]["texts"] |= set(range(len(a.text_boxes))) - {i for i, _ in same_texts}
+        items[index]["symbols"] = set(range(len(b.boxes))) - {j for _, j in same_symbols}
+        items[index]["texts"] = set(range(len(b.text_boxes))) - {j for _, j in same_texts}
+    return items
@@ -1,8 +1,8 @@
 import asyncio
 import re
 from typing import Dict, List, Union
-from openai import AsyncOpenAI
 from bs4 import BeautifulSoup
+from clients import openai_client, upstream_latency
 
 
 async def process_tasks(prompts: List[str], api_key: str, base_url: str):
@@ -21,7 +21,6 @@ async def process_tasks(prompts: List[str], api_key: str, base_url: str):
 
 
 async def generate_image(prompt: str, api_key: str, base_url: str):
-    client = AsyncOpenAI(api_key=api_key, base_url=base_url)
     image_params: Dict[str, Union[str, int]] = {
         "model": "dall-e-3",
         "quality": "standard",
@@ -30,8 +29,9 @@ async def generate_image(prompt: str, api_key: str, base_url: str):
         "size": "1024x1024",
         "prompt": prompt,
     }
-    res = await client.images.generate(**image_params)  # type: ignore
-    await client.close()
+    async with openai_client(api_key, base_url) as client:
+        with upstream_latency.time("openai_images"):
+            res = await client.images.generate(**image_params)  # type: ignore
     return res.data[0].url
 
 
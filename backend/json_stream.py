@@ -0,0 +1,119 @@
+"""
+Incremental JSON parsing over an LLM token stream.
+
+The parser is fed the completion piece by piece and reports every value whose path
+matches one of the watched patterns as soon as that value closes, e.g. each
+("differences", "images", 0, "boxes", 3) item while the rest of the answer is still
+being generated. Text before the first "{" or "[" (```json fences, preambles) is skipped.
+"""
+import json
+from typing import Any, List, Sequence, Tuple
+
+WILDCARD = "*"
+
+Path = Tuple[Any, ...]
+
+
+class _Frame:
+    __slots__ = ("is_object", "key", "start", "expect_key")
+
+    def __init__(self, is_object: bool, start: int):
+        self.is_object = is_object
+        # Current key of an object, or index of the current item of an array
+        self.key = None if is_object else 0
+        self.start = start
+        self.expect_key = is_object
+
+
+class IncrementalJSONParser:
+    def __init__(self, patterns: Sequence[Sequence[Any]]):
+        """
+        :param patterns: paths to watch; "*" matches any key or array index
+        """
+        self.patterns = [tuple(pattern) for pattern in patterns]
+        self.buffer = ""
+        self.pos = 0
+        self.stack: List[_Frame] = []
+        self.started = False
+        self.done = False
+        self.root = None
+        self.in_string = False
+        self.escape = False
+        self.string_start = 0
+        self.scalar_start = None
+
+    def feed(self, text: str) -> List[Tuple[Path, Any]]:
+        """
+        :return: (path, value) of the watched values completed by this piece, in document order
+        """
+        self.buffer += text
+        events: List[Tuple[Path, Any]] = []
+        buffer = self.buffer
+        while self.pos < len(buffer) and not self.done:
+            c = buffer[self.pos]
+            if not self.started:
+                if c in "{[":
+                    self.started = True
+                    self.root = self.pos
+                    self.stack.append(_Frame(c == "{", self.pos))
+            elif self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    frame = self.stack[-1]
+                    if frame.is_object and frame.expect_key:
+                        frame.key = json.loads(buffer[self.string_start : self.pos + 1])
+                        frame.expect_key = False
+                    else:
+                        self._complete(self.string_start, self.pos + 1, events)
+            else:
+                if self.scalar_start is not None and (c in ",]}" or c.isspace()):
+                    self._complete(self.scalar_start, self.pos, events)
+                    self.scalar_start = None
+                if c == '"':
+                    self.in_string = True
+                    self.string_start = self.pos
+                elif c in "{[":
+                    self.stack.append(_Frame(c == "{", self.pos))
+                elif c in "}]":
+                    frame = self.stack.pop()
+                    if self.stack:
+                        self._complete(frame.start, self.pos + 1, events)
+                    else:
+                        self.done = True
+                elif c == ",":
+                    frame = self.stack[-1]
+                    if frame.is_object:
+                        frame.expect_key = True
+                    else:
+                        frame.key += 1
+                elif c != ":" and not c.isspace() and self.scalar_start is None:
+                    self.scalar_start = self.pos
+            self.pos += 1
+        return events
+
+    def result(self):
+        # The whole document once it has closed, None if it is still open or malformed
+        if not self.done:
+            return None
+        try:
+            return json.loads(self.buffer[self.root : self.pos])
+        except json.JSONDecodeError:
+            return None
+
+    def _complete(self, start: int, end: int, events: List[Tuple[Path, Any]]):
+        path = tuple(frame.key for frame in self.stack)
+        if not any(self._matches(pattern, path) for pattern in self.patterns):
+            return
+        try:
+            events.append((path, json.loads(self.buffer[start:end])))
+        except json.JSONDecodeError:
+            # A malformed item (e.g. trailing comma) does not stop the rest of the stream
+            pass
+
+    @staticmethod
+    def _matches(pattern: Path, path: Path) -> bool:
+        return len(pattern) == len(path) and all(p == WILDCARD or p == k for p, k in zip(pattern, path))
@@ -1,9 +1,9 @@
+import time
 from enum import Enum
 from typing import Any, Awaitable, Callable, List, cast
-from anthropic import AsyncAnthropic
-from openai import AsyncOpenAI
 from openai.types.chat import ChatCompletionMessageParam, ChatCompletionChunk
 from config import IS_DEBUG_ENABLED
+from clients import anthropic_client, openai_client, upstream_latency
 from debug.DebugFileWriter import DebugFileWriter
 
 from utils.utils import pprint_prompt
@@ -36,11 +36,11 @@ async def stream_openai_response(
     base_url: str | None,
     callback: Callable[[str], Awaitable[None]],
     model: Llm,
-    is_callback:bool
+    is_callback:bool,
+    on_delta: Callable[[str], Awaitable[None]] | None = None,
 ) -> str:
-    #client = AsyncOpenAI(api_key=api_key, base_url=base_url)
     try:
-        client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        lease = openai_client(api_key, base_url)
     except Exception as e:
         print(f"Error connecting to OpenAI API: {e}")
         return "Error connecting to OpenAI API"
@@ -60,34 +60,39 @@ async def stream_openai_response(
     ):
         params["max_tokens"] = 4096
         
+    start = time.perf_counter()
     try:
-        stream = await client.chat.completions.create(**params)  # type: ignore
-        full_response = ""
-        long_text_response = ""
-        if is_callback:
-            await callback('<pre><code class="language-python">')
-        async for chunk in stream:  # type: ignore
-            if chunk:
-                assert isinstance(chunk, ChatCompletionChunk)
-                content = chunk.choices[0].delta.content or ""
-                full_response += content
-                long_text_response+=content
-                if is_callback & len(long_text_response) > 500 :
-                    await callback(long_text_response)
-                    long_text_response = ""
-            else:
-                 print("Empty chunk received.")
-        if is_callback & (long_text_response != ""):
-            print("TTTTTTTTTTTTTTTTTT")
-            await callback(long_text_response)
-        if is_callback:
-            await callback("</code></pre>")
+        async with lease as client:
+            stream = await client.chat.completions.create(**params)  # type: ignore
+            full_response = ""
+            long_text_response = ""
+            if is_callback:
+                await callback('<pre><code class="language-python">')
+            async for chunk in stream:  # type: ignore
+                if chunk:
+                    assert isinstance(chunk, ChatCompletionChunk)
+                    content = chunk.choices[0].delta.content or ""
+                    full_response += content
+                    long_text_response+=content
+                    # Raw per-token hook, e.g. for incremental JSON parsing; independent of is_callback
+                    if on_delta is not None and content:
+                        await on_delta(content)
+                    if is_callback & len(long_text_response) > 500 :
+                        await callback(long_text_response)
+                        long_text_response = ""
+                else:
+                     print("Empty chunk received.")
+            if is_callback & (long_text_response != ""):
+                print("TTTTTTTTTTTTTTTTTT")
+                await callback(long_text_response)
+            if is_callback:
+                await callback("</code></pre>")
     except Exception as e:
         print(f"Error while streaming OpenAI response: {e}")
-        await client.close()
         return "Error while streaming OpenAI response"
-    
-    await client.close()
+    finally:
+        upstream_latency.observe("openai", time.perf_counter() - start)
+
     return full_response
 
 # TODO: Have a seperate function that translates OpenAI messages to Claude messages
@@ -97,7 +102,7 @@ async def stream_claude_response(
     callback: Callable[[str], Awaitable[None]],
 ) -> str:
 
-    client = AsyncAnthropic(api_key=api_key)
+    lease = anthropic_client(api_key)
 
     # Base parameters
     model = Llm.CLAUDE_3_SONNET
@@ -131,21 +136,19 @@ async def stream_claude_response(
                 }
 
     # Stream Claude response
-    async with client.messages.stream(
-        model=model.value,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        system=system_prompt,
-        messages=claude_messages,  # type: ignore
-    ) as stream:
-        async for text in stream.text_stream:
-            await callback(text)
-
-    # Return final message
-    response = await stream.get_final_message()
-
-    # Close the Anthropic client
-    await client.close()
+    with upstream_latency.time("anthropic"):
+        async with lease as client, client.messages.stream(
+            model=model.value,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=system_prompt,
+            messages=claude_messages,  # type: ignore
+        ) as stream:
+            async for text in stream.text_stream:
+                await callback(text)
+
+            # Return final message
+            response = await stream.get_final_message()
 
     return response.content[0].text
 
@@ -159,8 +162,6 @@ async def stream_claude_response_native(
     model: Llm = Llm.CLAUDE_3_OPUS,
 ) -> str:
 
-    client = AsyncAnthropic(api_key=api_key)
-
     # Base model parameters
     max_tokens = 4096
     temperature = 0.0
@@ -176,59 +177,59 @@ async def stream_claude_response_native(
     full_stream = ""
     debug_file_writer = DebugFileWriter()
 
-    while current_pass_num <= max_passes:
-        current_pass_num += 1
-
-        # Set up message depending on whether we have a <thinking> prefix
-        messages_to_send = (
-            messages + [{"role": "assistant", "content": prefix}]
-            if include_thinking
-            else messages
-        )
-
-        pprint_prompt(messages_to_send)
+    # One lease across all passes, so the client is not closed between them
+    async with anthropic_client(api_key) as client:
+        while current_pass_num <= max_passes:
+            current_pass_num += 1
 
-        async with client.messages.stream(
-            model=model.value,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            system=system_prompt,
-            messages=messages_to_send,  # type: ignore
-        ) as stream:
-            async for text in stream.text_stream:
-                print(text, end="", flush=True)
-                full_stream += text
-                await callback(text)
-
-        response = await stream.get_final_message()
-        response_text = response.content[0].text
-
-        # Write each pass's code to .html file and thinking to .txt file
-        if IS_DEBUG_ENABLED:
-            debug_file_writer.write_to_file(
-                f"pass_{current_pass_num - 1}.html",
-                debug_file_writer.extract_html_content(response_text),
-            )
-            debug_file_writer.write_to_file(
-                f"thinking_pass_{current_pass_num - 1}.txt",
-                response_text.split("</thinking>")[0],
+            # Set up message depending on whether we have a <thinking> prefix
+            messages_to_send = (
+                messages + [{"role": "assistant", "content": prefix}]
+                if include_thinking
+                else messages
             )
 
-        # Set up messages array for next pass
-        messages += [
-            {"role": "assistant", "content": str(prefix) + response.content[0].text},
-            {
-                "role": "user",
-                "content": "You've done a good job with a first draft. Improve this further based on the original instructions so that the app is fully functional and looks like the original video of the app we're trying to replicate.",
-            },
-        ]
-
-        print(
-            f"Token usage: Input Tokens: {response.usage.input_tokens}, Output Tokens: {response.usage.output_tokens}"
-        )
-
-    # Close the Anthropic client
-    await client.close()
+            pprint_prompt(messages_to_send)
+
+            with upstream_latency.time("anthropic"):
+                async with client.messages.stream(
+                    model=model.value,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    system=system_prompt,
+                    messages=messages_to_send,  # type: ignore
+                ) as stream:
+                    async for text in stream.text_stream:
+                        print(text, end="", flush=True)
+                        full_stream += text
+                        await callback(text)
+
+                response = await stream.get_final_message()
+            response_text = response.content[0].text
+
+            # Write each pass's code to .html file and thinking to .txt file
+            if IS_DEBUG_ENABLED:
+                debug_file_writer.write_to_file(
+                    f"pass_{current_pass_num - 1}.html",
+                    debug_file_writer.extract_html_content(response_text),
+                )
+                debug_file_writer.write_to_file(
+                    f"thinking_pass_{current_pass_num - 1}.txt",
+                    response_text.split("</thinking>")[0],
+                )
+
+            # Set up messages array for next pass
+            messages += [
+                {"role": "assistant", "content": str(prefix) + response.content[0].text},
+                {
+                    "role": "user",
+                    "content": "You've done a good job with a first draft. Improve this further based on the original instructions so that the app is fully functional and looks like the original video of the app we're trying to replicate.",
+                },
+            ]
+
+            print(
+                f"Token usage: Input Tokens: {response.usage.input_tokens}, Output Tokens: {response.usage.output_tokens}"
+            )
 
     if IS_DEBUG_ENABLED:
         debug_file_writer.write_to_file("full_stream.txt", full_stream)
@@ -4,11 +4,29 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routes import screenshot, generate_code, home, evals,recognition_match
+from ocr import init_ocr_pool, shutdown_ocr_pool
+from config import MODEL_SERVE_OCR
+from clients import init_clients, close_clients
 
-app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the OCR models once so /recognition never pays model loading per image.
+    # When model serve runs OCR alongside detection the local pool is not needed.
+    if not MODEL_SERVE_OCR:
+        init_ocr_pool()
+    # Pooled upstream clients live for the whole app so calls reuse connections
+    init_clients()
+    yield
+    await close_clients()
+    shutdown_ocr_pool()
+
+
+app = FastAPI(openapi_url=None, docs_url=None, redoc_url=None, lifespan=lifespan)
 
 # Configure CORS settings
 app.add_middleware(
@@ -1,13 +1,20 @@
+import asyncio
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from paddleocr import PaddleOCR, draw_ocr
 from utils import utils
 import base64
 from PIL import Image
 from io import BytesIO
+from config import OCR_POOL_SIZE, OCR_USE_GPU
 
 class OCRPipeline:
-    def __init__(self,use_angle_cls=True, lang="ch",use_gpu=True):
+    # 本地兜底: 整图交给 PaddleOCR; 切片 OCR 和符号遮挡只在 model serve 的 OCRTransform 中实现 (MODEL_SERVE_OCR)
+    def __init__(self,use_angle_cls=True, lang="ch",use_gpu=True, render=False):
         self.ocr = PaddleOCR(use_angle_cls=use_angle_cls, lang=lang,use_gpu=use_gpu)  # 这里设置为中文识    
+        # draw_ocr 逐行用 TrueType 字体绘制文字, 代价较高, 只在 render 为 True 时随结果返回
+        self.render_result = render
 
     def converter(self,base64_str:str):
         image_data = base64.b64decode(base64_str)
@@ -21,14 +28,13 @@ class OCRPipeline:
         return image
 
     def postprocess_results(self,original_image,result):
-
-        draw_image = self.draw_text_on_white_image(original_image,result)
         # 准备JSON格式的数据结构
         ocr_results = {
-            "draw_image":utils.convertBase64(draw_image),
             "detections": [],
             "texts":[line[1][0] for line in result]
         }
+        if self.render_result:
+            ocr_results["draw_image"] = utils.convertBase64(self.draw_text_on_white_image(original_image,result))
 
         # 遍历PaddleOCR的输出结果
         for line in result:
@@ -47,10 +53,66 @@ class OCRPipeline:
         scores = [line[1][1] for line in result]
         im_show = draw_ocr(image, boxes, txts, scores, font_path=font_path)
         return im_show
+
+    def render(self, image, ocr_result):
+        # 根据已有的 OCR 结果绘制, 返回 base64 图片
+        result = [[detection["bbox"], (detection["text"], detection["confidence"])] for detection in ocr_result["detections"]]
+        return utils.convertBase64(self.draw_text_on_white_image(self.preprocess_image(image), result))
     
     def __call__(self, image):
         image_deal = self.preprocess_image(image)
         results = self.ocr.ocr(image_deal)
-        detections= self.postprocess_results(image_deal,results[0])
+        # 图片中没有文字时 PaddleOCR 返回 [None]
+        detections= self.postprocess_results(image_deal,results[0] or [])
         return detections
 
+
+class OCRPool:
+    """
+    Process-wide pool of warm PaddleOCR engines. Models are loaded once at startup;
+    each OCR call borrows an engine and runs in a bounded thread pool so the event
+    loop is never blocked.
+    """
+
+    def __init__(self, size=1, use_angle_cls=True, lang="ch", use_gpu=False):
+        self.size = size
+        self.engines: "queue.Queue[OCRPipeline]" = queue.Queue()
+        for _ in range(size):
+            self.engines.put(OCRPipeline(use_angle_cls=use_angle_cls, lang=lang, use_gpu=use_gpu))
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="ocr")
+
+    def _run(self, image):
+        engine = self.engines.get()
+        try:
+            return engine(image)
+        finally:
+            self.engines.put(engine)
+
+    async def run(self, image):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run, image)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+_ocr_pool: OCRPool | None = None
+
+
+def init_ocr_pool(size: int = OCR_POOL_SIZE, use_gpu: bool = OCR_USE_GPU) -> OCRPool:
+    global _ocr_pool
+    if _ocr_pool is None:
+        _ocr_pool = OCRPool(size=size, use_angle_cls=True, lang="ch", use_gpu=use_gpu)
+    return _ocr_pool
+
+
+def get_ocr_pool() -> OCRPool:
+    # Falls back to lazy creation when the app lifespan did not warm the pool (e.g. scripts)
+    return init_ocr_pool()
+
+
+def shutdown_ocr_pool():
+    global _ocr_pool
+    if _ocr_pool is not None:
+        _ocr_pool.shutdown()
+        _ocr_pool = None
@@ -4,7 +4,7 @@ from openai.types.chat import ChatCompletionMessageParam, ChatCompletionContentP
 
 from prompts.imported_code_prompts import IMPORTED_CODE_SYSTEM_PROMPTS
 from prompts.screenshot_system_prompts import SYSTEM_PROMPTS
-from prompts.match_cad_prompts import CAD_MATCH_SYSTEM_PROMPTS
+from prompts.match_cad_prompts import CAD_MATCH_SYSTEM_PROMPTS, SUMMARY_SYSTEM_PROMPT
 from prompts.types import Stack
 import json
 
@@ -87,6 +87,21 @@ JSON_USER_PROMPT = """
 Please correctly compare and analyse the entered information of the recognised pictures.
 """
 
+def assemble_summary_prompt(differences: dict) -> List[ChatCompletionMessageParam]:
+    # Only the engine's detail lines and counts are sent; geometry stays local
+    user_content = "\n".join(differences.get("detail", [])) or "没有差异"
+    return [
+        {
+            "role": "system",
+            "content": SUMMARY_SYSTEM_PROMPT,
+        },
+        {
+            "role": "user",
+            "content": f"{differences.get('describe', '')}\n{user_content}",
+        },
+    ]
+
+
 def assemble_json_prompt(
     detection_info: List[Union[str, None]],
     stack: Stack,
@@ -101,13 +116,14 @@ def assemble_json_prompt(
         },
     ]
 
-    # Include detection_info as text parts in user_content
+    # Include detection_info as text parts in user_content; pre-serialized payloads
+    # (see prompts.compact) are passed through as-is
     for info in detection_info:
         if info:  # Make sure the info is not None or empty
             user_content.append(
                 {
                     "type": "text",
-                    "text": json.dumps(info),
+                    "text": info if isinstance(info, str) else json.dumps(info),
                 }
             )
             
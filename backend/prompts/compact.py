@@ -0,0 +1,140 @@
+"""
+Compact prompt payload for the LLM comparison path (DIFF_ENGINE=llm).
+
+Instead of json.dumps of every detection and OCR quad, each drawing is sent as columnar
+rows of only the symbols / texts that the local pre-matching could not pair up, with
+boxes quantized to a GRID x GRID grid. Rows are added by confidence until the token
+budget is reached. The LLM answers in grid coordinates and dequantize_differences maps
+the boxes back to pixels for utils.draw_box.
+"""
+import importlib.util
+import re
+from typing import Dict, List, Tuple
+
+from diff_engine import DiffEngine, differing_items, quad_to_xyxy
+import utils.utils as utils
+
+GRID = 1000
+
+FORMAT_NOTE = f"""
+Each drawing is listed as columnar rows. Coordinates are x1,y1,x2,y2 on a {GRID}x{GRID} grid of that drawing.
+Symbols and texts that are identical in all drawings were matched locally and are omitted; only their counts are given.
+Return every bbox in the same grid coordinates.
+"""
+
+# Rough json.dumps size of one legacy payload entry (a symbol across the columnar lists, an OCR quad with
+# text and confidence), used to report what the full payload would have cost without serializing it
+RAW_SYMBOL_TOKENS = 16
+RAW_TEXT_TOKENS = 60
+
+_CJK = re.compile(r"[⺀-鿿가-힯＀-￯]")
+# Resolved once; count_tokens runs for every candidate row during budget enforcement
+TIKTOKEN_AVAILABLE = importlib.util.find_spec("tiktoken") is not None
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    # tiktoken when available, otherwise ~4 ASCII characters per token and one token per CJK character
+    global _encoding
+    if TIKTOKEN_AVAILABLE:
+        if _encoding is None:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _quantize(box, width, height) -> str:
+    x1, y1, x2, y2 = box
+    return f"{round(x1 * GRID / width)},{round(y1 * GRID / height)},{round(x2 * GRID / width)},{round(y2 * GRID / height)}"
+
+
+def build_compact_payload(results: list, budget: int = 6000, engine: DiffEngine | None = None):
+    """
+    :param results: [{"org_image", "detect_result", "ocr_result"}, ...]
+    :param budget: token budget of the payload text
+    :return: (payload text, per-image (sx, sy) pixel-per-grid scales, token report)
+    """
+    items = differing_items(results, engine) if len(results) > 1 else [
+        {"symbols": set(range(len((r.get("detect_result") or {}).get("boxes", [])))),
+         "texts": set(range(len((r.get("ocr_result") or {}).get("detections", []))))}
+        for r in results
+    ]
+    scales: List[Tuple[float, float]] = []
+    raw_tokens = 0
+    # (priority, image index, section, row text)
+    candidates: List[Tuple[float, int, str, str]] = []
+    headers: List[str] = []
+    for index, (result, keep) in enumerate(zip(results, items)):
+        width, height = utils.base64_to_pil(result["org_image"].split(",")[-1]).size
+        scales.append((width / GRID, height / GRID))
+        detect_result = result.get("detect_result") or {}
+        detections = (result.get("ocr_result") or {}).get("detections", [])
+        raw_tokens += RAW_SYMBOL_TOKENS * len(detect_result.get("boxes", [])) + RAW_TEXT_TOKENS * len(detections)
+        confidences = detect_result.get("confidences") or [1.0] * len(detect_result.get("boxes", []))
+        for i in sorted(keep["symbols"]):
+            row = f"{detect_result['classtexts'][i]}|{_quantize(detect_result['boxes'][i], width, height)}"
+            candidates.append((confidences[i], index, "symbols", row))
+        for i in sorted(keep["texts"]):
+            detection = detections[i]
+            row = f"{detection['text']}|{_quantize(quad_to_xyxy(detection['bbox']), width, height)}"
+            candidates.append((float(detection.get("confidence", 1.0)), index, "texts", row))
+        omitted_symbols = len(detect_result.get("boxes", [])) - len(keep["symbols"])
+        omitted_texts = len(detections) - len(keep["texts"])
+        headers.append(f"## imageId={index} matched_symbols={omitted_symbols} matched_texts={omitted_texts}")
+
+    used = count_tokens(FORMAT_NOTE) + sum(count_tokens(h) for h in headers) + 20 * len(results)
+    rows: Dict[Tuple[int, str], List[str]] = {}
+    dropped = 0
+    for _, index, section, row in sorted(candidates, key=lambda c: -c[0]):
+        cost = count_tokens(row) + 1
+        if used + cost > budget:
+            dropped += 1
+            continue
+        used += cost
+        rows.setdefault((index, section), []).append(row)
+
+    lines = [FORMAT_NOTE.strip()]
+    for index, header in enumerate(headers):
+        lines.append(header)
+        lines.append("symbols: class|x1,y1,x2,y2")
+        lines.extend(rows.get((index, "symbols"), []))
+        lines.append("texts: text|x1,y1,x2,y2")
+        lines.extend(rows.get((index, "texts"), []))
+    if dropped:
+        lines.append(f"({dropped} lower-confidence rows omitted to fit the token budget)")
+    payload = "\n".join(lines)
+
+    report = {
+        "rows_total": len(candidates),
+        "rows_sent": len(candidates) - dropped,
+        "budget": budget,
+        "payload_tokens": count_tokens(payload),
+        "raw_tokens": raw_tokens,
+    }
+    return payload, scales, report
+
+
+def dequantize_differences(result, scales: List[Tuple[float, float]]):
+    # Map LLM bboxes from grid coordinates back to pixels of each drawing
+    if not isinstance(result, dict):
+        return result
+    images = (result.get("differences") or {}).get("images") or []
+    for position, image in enumerate(images):
+        index = image.get("imageid", position) if isinstance(image.get("imageid"), int) else position
+        if not 0 <= index < len(scales):
+            continue
+        for box in image.get("boxes", []):
+            box["bbox"] = dequantize_box(box.get("bbox") or [], scales[index])
+    return result
+
+
+def dequantize_box(bbox, scale: Tuple[float, float]):
+    # A single grid bbox to pixels; anything that is not x1,y1,x2,y2 is returned unchanged
+    if len(bbox) != 4:
+        return bbox
+    sx, sy = scale
+    return [round(bbox[0] * sx), round(bbox[1] * sy), round(bbox[2] * sx), round(bbox[3] * sy)]
+
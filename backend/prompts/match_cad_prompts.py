@@ -40,6 +40,16 @@ Explanation of the meaning of the parameters in the reply example:
 
 """
 
+SUMMARY_SYSTEM_PROMPT = """
+You are an expert in reviewing revisions of CAD / P&ID drawings.
+You are given the list of differences between two drawings, already computed by a deterministic comparison engine.
+Do not add, remove or change any difference; only summarise them.
+
+- Chinese Response.
+- Two to four sentences, plain text without markdown or JSON.
+- Group related changes (for example all valve type changes) and mention the most important ones first.
+"""
+
 CAD_MATCH_SYSTEM_PROMPTS = SystemPrompts(
     html_tailwind="",
     react_tailwind="",
@@ -1,5 +1,6 @@
 from fastapi import APIRouter
 from fastapi.responses import HTMLResponse
+from clients import upstream_latency
 
 
 router = APIRouter()
@@ -10,3 +11,9 @@ async def get_status():
     return HTMLResponse(
         content="<h3>Your backend is running correctly. Please open the front-end URL (default is http://localhost:5173) to use screenshot-to-code.</h3>"
     )
+
+
+@router.get("/metrics/upstreams")
+async def get_upstream_latency():
+    # Per-upstream latency histograms (seconds) of model serve and LLM calls
+    return upstream_latency.snapshot()
@@ -1,7 +1,9 @@
+import asyncio
+import base64
 import os
 from fastapi import APIRouter, WebSocket
 import openai
-from config import ANTHROPIC_API_KEY, IS_PROD, SHOULD_MOCK_AI_RESPONSE
+from config import ANTHROPIC_API_KEY, DIFF_ENGINE, IS_PROD, LLM_SUMMARY, MODEL_SERVE_OCR, PROMPT_TOKEN_BUDGET, OCR_MASK_SYMBOLS, RECOGNITION_CONCURRENCY, SHOULD_MOCK_AI_RESPONSE
 from custom_types import InputMode
 from llm import (
     Llm,
@@ -12,19 +14,30 @@ from llm import (
 from openai.types.chat import ChatCompletionMessageParam
 from mock_llm import mock_completion
 from typing import Dict, List, cast, get_args,Union
-from prompts import assemble_json_prompt
+from prompts import assemble_json_prompt, assemble_summary_prompt
+from prompts.compact import build_compact_payload, dequantize_box, dequantize_differences
+from diff_engine import compare_results
+from json_stream import IncrementalJSONParser
 from datetime import datetime
 import json
 # from utils import pprint_prompt
 from ws.constants import APP_ERROR_WEB_SOCKET_CODE  # type: ignore
 from pydantic import BaseModel
 import httpx
-from detect_result import detect_completion,generate_image_response,llm_emp_response,generate_org_response
+from clients import request_with_retry
+from detect_result import generate_image_response,llm_emp_response,generate_org_response,generate_partial_response,generate_region_response,generate_detail_response
 import utils.utils as utils
-from ocr import OCRPipeline
+from ocr import get_ocr_pool
 
 router = APIRouter()
 
+# 大模型回复中需要边生成边推送的部分, 见 prompts.match_cad_prompts.RETURN_FORMAT
+DIFF_STREAM_PATTERNS = [
+    ("differences", "images", "*", "imageid"),
+    ("differences", "images", "*", "boxes", "*"),
+    ("differences", "detail", "*"),
+]
+
 
 def write_logs(prompt_messages: List[ChatCompletionMessageParam], completion: str):
     # Get the logs path from environment, default to the current working directory
@@ -119,7 +132,9 @@ async def recognition(websocket:WebSocket):
                 if openai_api_key:
                     print("Using OpenAI API key from environment variable")
 
-            if not openai_api_key and (
+            # 本地比对且不需要总结时不调用大模型, 也就不需要 API key
+            needs_llm = DIFF_ENGINE != "local" or LLM_SUMMARY
+            if needs_llm and not openai_api_key and (
                 code_generation_model == Llm.GPT_4_VISION
                 or code_generation_model == Llm.GPT_4_TURBO_2024_04_09
                 or code_generation_model == Llm.GPT_4O_2024_05_13
@@ -155,14 +170,17 @@ async def recognition(websocket:WebSocket):
             
             completion = generate_org_response(modelserve_param)
             await process_chunk(completion)
+            async def on_image_done(index, result):
+                # 每张图纸识别完成后立即推送该图的结果, 不等待其余图纸
+                detect_result, ocr_result = result
+                await websocket.send_json({"type": "status", "value": f"Recognized drawing {index + 1}/{len(modelserve_param)}"})
+                await process_chunk(generate_partial_response(index, detect_result, ocr_result))
+
             try:
-                for image in modelserve_param:
-                    request = DetectRequest(image=image)
-                    import asyncio
-                    detect_coro = modelserve(request)
-                    ocr_coro = ocr_image(image)
-                    ocr_result,detect_result = await asyncio.gather(ocr_coro,detect_coro)
-                    result = {"org_image":image,"detect_result":detect_result.get("detect_result",image),"ocr_result":ocr_result}
+                # 所有图纸的检测和 OCR 同时提交, 受 RECOGNITION_CONCURRENCY 限制, 按完成顺序推送结果
+                results = await run_pipelined(modelserve_param, recognize_image, RECOGNITION_CONCURRENCY, on_image_done)
+                for image,(detect_result,ocr_result) in zip(modelserve_param,results):
+                    result = {"org_image":image,"detect_result":detect_result,"ocr_result":ocr_result}
                     # TODO parsing result
                     detect_results.append(result)
             except Exception as e:
@@ -175,47 +193,93 @@ async def recognition(websocket:WebSocket):
                 await websocket.close()
                 print(e)
                 return
-            prompt_data = get_data_from_result(detect_results)
-            # completion = await detect_completion(
-            # process_chunk, result=detect_results)
-            # Assemble the prompt
-            try:
-                prompt_messages = assemble_json_prompt(prompt_data, "json")
-            except:
-                await websocket.send_json(
-                    {
-                            "type": "error",
-                            "value": "Error assembling prompt.",
-                    }
-                )
-                await websocket.close()
-                return
-            
-               
-            if code_generation_model == Llm.CLAUDE_3_SONNET:
-                if not ANTHROPIC_API_KEY:
-                    await throw_error(
-                        "No Anthropic API key found. Please add the environment variable ANTHROPIC_API_KEY to backend/.env"
+            if DIFF_ENGINE == "local":
+                # 本地几何比对: 结果确定, 不消耗 token; 大模型只用于可选的文字总结
+                diff_result = await asyncio.to_thread(compare_results, detect_results)
+                if LLM_SUMMARY:
+                    summary = await summarize_differences(
+                        diff_result["differences"], code_generation_model, openai_api_key, openai_base_url
                     )
-                    raise Exception("No Anthropic key")
-
-                openai_response = await stream_claude_response(
-                    prompt_messages,  # type: ignore
-                    api_key=ANTHROPIC_API_KEY,
-                    callback=lambda x: process_chunk(x),
-                )
-                exact_llm_version = code_generation_model
+                    if summary:
+                        diff_result["differences"]["describe"] = summary
             else:
-                openai_response = await stream_openai_response(
-                    prompt_messages,  # type: ignore
-                    api_key=openai_api_key,
-                    base_url=openai_base_url,
-                    callback=lambda x: process_chunk(x),
-                    model=code_generation_model,
-                    is_callback = False
-                )
-                exact_llm_version = code_generation_model
-            print("Exact used model for generation: ", exact_llm_version)
+                # 只发送本地预匹配后仍不一致的元件和文字, 坐标量化到网格, 按 token 预算截断
+                # Assemble the prompt
+                try:
+                    payload, grid_scales, token_report = await asyncio.to_thread(
+                        build_compact_payload, detect_results, PROMPT_TOKEN_BUDGET
+                    )
+                    print("Prompt token report:", token_report)
+                    await websocket.send_json({"type": "status", "value": f"Prompt tokens: {token_report['payload_tokens']} (full payload ~{token_report['raw_tokens']})"})
+                    prompt_messages = assemble_json_prompt([payload], "json")
+                except:
+                    await websocket.send_json(
+                        {
+                                "type": "error",
+                                "value": "Error assembling prompt.",
+                        }
+                    )
+                    await websocket.close()
+                    return
+            
+
+                # 边生成边解析: 每个差异框 / detail 行闭合后立即标注并推送, 不等待完整回复
+                diff_stream = IncrementalJSONParser(DIFF_STREAM_PATTERNS)
+                image_ids = {}
+
+                async def push_difference(path, value):
+                    if path[1] == "detail":
+                        await process_chunk(generate_detail_response(str(value)))
+                        return
+                    position = path[2]
+                    if path[-1] == "imageid":
+                        image_ids[position] = value
+                        return
+                    index = image_ids.get(position, position)
+                    if not isinstance(value, dict) or not isinstance(index, int) or not 0 <= index < len(modelserve_param):
+                        return
+                    label = str(value.get("label", ""))
+                    bbox = dequantize_box(value.get("bbox") or [], grid_scales[index])
+                    region = await asyncio.to_thread(utils.draw_region, modelserve_param[index], bbox, label, index)
+                    if region:
+                        await process_chunk(generate_region_response(index, label, region))
+
+                async def on_llm_delta(text: str):
+                    for path, value in diff_stream.feed(text):
+                        try:
+                            await push_difference(path, value)
+                        except Exception as e:
+                            # 单个框渲染失败不影响流式输出和最终的整图结果
+                            print(f"Error pushing difference {path}: {e}")
+
+                if code_generation_model == Llm.CLAUDE_3_SONNET:
+                    if not ANTHROPIC_API_KEY:
+                        await throw_error(
+                            "No Anthropic API key found. Please add the environment variable ANTHROPIC_API_KEY to backend/.env"
+                        )
+                        raise Exception("No Anthropic key")
+
+                    openai_response = await stream_claude_response(
+                        prompt_messages,  # type: ignore
+                        api_key=ANTHROPIC_API_KEY,
+                        callback=on_llm_delta,
+                    )
+                    exact_llm_version = code_generation_model
+                else:
+                    openai_response = await stream_openai_response(
+                        prompt_messages,  # type: ignore
+                        api_key=openai_api_key,
+                        base_url=openai_base_url,
+                        callback=lambda x: process_chunk(x),
+                        model=code_generation_model,
+                        is_callback = False,
+                        on_delta=on_llm_delta,
+                    )
+                    exact_llm_version = code_generation_model
+                print("Exact used model for generation: ", exact_llm_version)
+                # 流式解析已得到完整文档时直接使用, 否则回退到从全文中截取 JSON
+                diff_result = diff_stream.result() or utils.extract_json_from_text(openai_response)
+                diff_result = dequantize_differences(diff_result, grid_scales)
         except openai.AuthenticationError as e:
             print("[GENERATE_CODE] Authentication failed", e)
             error_message = (
@@ -251,7 +315,7 @@ async def recognition(websocket:WebSocket):
             )
             return await throw_error(error_message)
          # Write the messages dict into a log so that we can debug later
-        deal_data =  posts_respose(modelserve_param,openai_response)
+        deal_data =  render_differences(modelserve_param,diff_result)
         await process_chunk(deal_data)
         # completion += openai_response
         # write_logs(prompt_messages, completion)
@@ -261,6 +325,7 @@ async def recognition(websocket:WebSocket):
 
 class DetectRequest(BaseModel):
     image:str
+
    
 # class OcrDetect(BaseModel):
 #     draw_image:str
@@ -288,14 +353,77 @@ def pre_data(params):
         images_str.append(base64_str)
     return images_str
 
+async def run_pipelined(items, worker, limit, on_result):
+    """
+    所有任务同时启动, 最多 limit 个并发执行, 每完成一个立即回调 on_result(index, result)
+    返回按输入顺序排列的结果; 任一任务失败时取消其余任务并抛出异常
+    """
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(index, item):
+        async with semaphore:
+            return index, await worker(item)
+
+    tasks = [asyncio.create_task(run(index, item)) for index, item in enumerate(items)]
+    results = [None] * len(items)
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, result = await next_done
+            results[index] = result
+            await on_result(index, result)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return results
+
+async def recognize_image(image):
+    # 单张图纸的检测和 OCR, 返回 (detect_result, ocr_result)
+    # model serve 的动态批处理会把并发到达的单张请求合并推理
+    if MODEL_SERVE_OCR:
+        response = await modelserve(DetectRequest(image=image))
+        return response["detect_result"], response["ocr_result"]
+    # 本地 OCR 兜底: 整图识别, 与检测并行
+    detect_response, ocr_result = await asyncio.gather(modelserve(DetectRequest(image=image), with_ocr=False), ocr_image(image))
+    return detect_response["detect_result"], ocr_result
+
 async def ocr_image(image_path):
-    ocr = OCRPipeline(use_angle_cls=True, lang="ch",use_gpu=False)  # 这里设置为中文识  
-    result = ocr(image_path) 
-    return result
+    # 使用启动时预热的 OCR 引擎池, 在线程池中执行, 不阻塞事件循环
+    return await get_ocr_pool().run(image_path)
 
 def posts_respose(images,message):
+    return render_differences(images,utils.extract_json_from_text(message))
+
+async def summarize_differences(differences, model, openai_api_key, openai_base_url):
+    # 只把本地比对得到的差异描述交给大模型做文字总结, 失败时保留本地生成的 describe
+    prompt_messages = assemble_summary_prompt(differences)
+
+    async def discard(_: str):
+        return None
+
+    try:
+        if model == Llm.CLAUDE_3_SONNET:
+            if not ANTHROPIC_API_KEY:
+                return None
+            return await stream_claude_response(
+                prompt_messages,  # type: ignore
+                api_key=ANTHROPIC_API_KEY,
+                callback=discard,
+            )
+        summary = await stream_openai_response(
+            prompt_messages,  # type: ignore
+            api_key=openai_api_key,
+            base_url=openai_base_url,
+            callback=discard,
+            model=model,
+            is_callback = False
+        )
+        return None if summary.startswith("Error") else summary
+    except Exception as e:
+        print(f"Error summarizing differences: {e}")
+        return None
+
+def render_differences(images,result):
     html =""
-    result = utils.extract_json_from_text(message)
     base64_str_list = images
   
     if result :
@@ -336,23 +464,32 @@ def get_data_from_result(result) -> List[Union[str, None]]:
             prompt_data.append(pitem)
     return prompt_data
 
-async def modelserve(request: DetectRequest):
-    api_base_url = os.environ.get("MODEL_SERVE_URL", "http://localhost:8000/caddetect")
-    imagesplit = request.image.split(",")
-    image = imagesplit[0]
+def strip_data_url(image:str) -> str:
+    imagesplit = image.split(",")
     if len(imagesplit)>1:
-       image = imagesplit[1]
+       return imagesplit[1]
+    return imagesplit[0]
+
+def image_file(image:str, name:str="image"):
+    # 以原始二进制 multipart 上传, 避免 base64 膨胀和 model serve 端再次解码 base64
+    return (name, (f"{name}.jpg", base64.b64decode(strip_data_url(image)), "application/octet-stream"))
+
+async def modelserve(request: DetectRequest, with_ocr: bool = True):
+    api_base_url = os.environ.get("MODEL_SERVE_URL", "http://localhost:8000/caddetect")
      
     try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            response = await client.post(
-                api_base_url,
-                json={"image": image},
-                timeout=20
-            )
-            if response.status_code == 200:
-                return response.json()
-            else:
-                response.raise_for_status()
+        response = await request_with_retry(
+            "POST",
+            api_base_url,
+            upstream="modelserve",
+            params={"ocr": str(with_ocr).lower(), "mask_symbols": str(OCR_MASK_SYMBOLS).lower()},
+            files=[image_file(request.image)],
+            timeout=20
+        )
+        if response.status_code == 200:
+            return response.json()
+        else:
+            response.raise_for_status()
     except httpx.RequestError as e:
         raise Exception("Error taking model serve") from e
+
@@ -0,0 +1,71 @@
+import base64
+import unittest
+
+import cv2
+import numpy as np
+
+from diff_engine import compare_results, edit_distance
+
+
+def make_sheet(symbols, texts, scale=1.0, offset=(0, 0), size=(1000, 800)):
+    image = np.full((size[1], size[0], 3), 255, np.uint8)
+    boxes = []
+    for x, y, _ in symbols:
+        x1, y1 = int(x * scale + offset[0]), int(y * scale + offset[1])
+        x2, y2 = x1 + int(40 * scale), y1 + int(40 * scale)
+        cv2.rectangle(image, (x1, y1), (x2, y2), (0, 0, 0), 2)
+        boxes.append([x1, y1, x2, y2])
+    detections = []
+    for x, y, text in texts:
+        x1, y1 = x * scale + offset[0], y * scale + offset[1]
+        x2, y2 = x1 + 80 * scale, y1 + 15 * scale
+        detections.append({"bbox": [[x1, y1], [x2, y1], [x2, y2], [x1, y2]], "text": text, "confidence": 0.9})
+    _, buffer = cv2.imencode(".jpg", image)
+    return {
+        "org_image": base64.b64encode(buffer.tobytes()).decode(),
+        "detect_result": {"boxes": boxes, "classtexts": [c for _, _, c in symbols]},
+        "ocr_result": {"detections": detections, "texts": [d["text"] for d in detections]},
+    }
+
+
+SYMBOLS = [(100, 100, "闸阀"), (300, 120, "球阀"), (500, 400, "闸阀"), (700, 300, "法兰"), (200, 600, "仪表")]
+TEXTS = [(100, 50, "50-SW-3001-A1X"), (400, 200, "P-101"), (600, 500, "V-201"), (150, 700, "DN50")]
+
+
+class TestDiffEngine(unittest.TestCase):
+    def test_edit_distance(self):
+        self.assertEqual(edit_distance("V-201", "V-202"), 1)
+        self.assertEqual(edit_distance("", "DN50"), 4)
+        self.assertEqual(edit_distance("P-101", "P-101"), 0)
+
+    def test_identical_sheets_have_no_differences(self):
+        sheet = make_sheet(SYMBOLS, TEXTS)
+        result = compare_results([sheet, sheet])
+        self.assertEqual(result["differences"]["detail"], [])
+        self.assertEqual(result["differences"]["images"], [{"imageid": 0, "boxes": []}, {"imageid": 1, "boxes": []}])
+
+    def test_detects_changes_on_scaled_and_shifted_revision(self):
+        base = make_sheet(SYMBOLS, TEXTS)
+        symbols = [(100, 100, "球阀")] + SYMBOLS[1:2] + SYMBOLS[3:] + [(800, 650, "闸阀")]
+        texts = TEXTS[:2] + [(600, 500, "V-202")] + TEXTS[3:]
+        revision = make_sheet(symbols, texts, scale=1.2, offset=(30, -10), size=(1250, 960))
+
+        result = compare_results([base, revision])
+        self.assertEqual(
+            result["stats"][0],
+            {
+                "symbols_changed": 1,
+                "symbols_removed": 1,
+                "symbols_added": 1,
+                "texts_changed": 1,
+                "texts_removed": 0,
+                "texts_added": 0,
+            },
+        )
+        labels = [box["label"] for box in result["differences"]["images"][1]["boxes"]]
+        self.assertIn("闸阀->球阀", labels)
+        self.assertIn("V-202", labels)
+
+
+if __name__ == "__main__":
+    unittest.main()
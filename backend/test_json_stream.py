@@ -0,0 +1,68 @@
+import json
+import unittest
+
+from json_stream import IncrementalJSONParser
+
+PATTERNS = [
+    ("differences", "images", "*", "imageid"),
+    ("differences", "images", "*", "boxes", "*"),
+    ("differences", "detail", "*"),
+]
+
+COMPLETION = """```json
+{
+  "differences": {
+    "images": [
+      {"imageid": 0, "boxes": [{"bbox": [10, 20, 30, 40], "label": "闸阀"}, {"bbox": [1, 2, 3, 4], "label": "a \\"}\\" b"}]},
+      {"imageid": 1, "boxes": []}
+    ],
+    "detail": ["图片1 有闸阀, 图片2 没有", "V-201 -> V-202"],
+    "describe": "两张图纸有两处差异"
+  }
+}
+```"""
+
+
+def feed_in_pieces(parser, text, size):
+    events = []
+    for i in range(0, len(text), size):
+        events.extend(parser.feed(text[i : i + size]))
+    return events
+
+
+class TestIncrementalJSONParser(unittest.TestCase):
+    def test_emits_watched_items_for_any_chunking(self):
+        expected = [
+            (("differences", "images", 0, "imageid"), 0),
+            (("differences", "images", 0, "boxes", 0), {"bbox": [10, 20, 30, 40], "label": "闸阀"}),
+            (("differences", "images", 0, "boxes", 1), {"bbox": [1, 2, 3, 4], "label": 'a "}" b'}),
+            (("differences", "images", 1, "imageid"), 1),
+            (("differences", "detail", 0), "图片1 有闸阀, 图片2 没有"),
+            (("differences", "detail", 1), "V-201 -> V-202"),
+        ]
+        for size in (1, 3, 7, len(COMPLETION)):
+            parser = IncrementalJSONParser(PATTERNS)
+            self.assertEqual(feed_in_pieces(parser, COMPLETION, size), expected)
+            self.assertEqual(parser.result(), json.loads(COMPLETION.strip("`").removeprefix("json")))
+
+    def test_item_is_emitted_before_the_document_closes(self):
+        parser = IncrementalJSONParser(PATTERNS)
+        events = parser.feed('{"differences": {"images": [{"imageid": 0, "boxes": [{"bbox": [1, 2, 3, 4], "label": "x"},')
+        self.assertEqual(events[-1], (("differences", "images", 0, "boxes", 0), {"bbox": [1, 2, 3, 4], "label": "x"}))
+        self.assertIsNone(parser.result())
+
+    def test_malformed_item_does_not_stop_the_stream(self):
+        parser = IncrementalJSONParser(PATTERNS)
+        events = parser.feed('{"differences": {"detail": ["a", "b",], "images": [{"boxes": [{"bbox": [1, 2, 3, 4],}, {"label": "y"}]}]}}')
+        self.assertEqual(
+            events,
+            [
+                (("differences", "detail", 0), "a"),
+                (("differences", "detail", 1), "b"),
+                (("differences", "images", 0, "boxes", 1), {"label": "y"}),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
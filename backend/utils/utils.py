@@ -6,6 +6,8 @@ import base64
 import json
 from PIL import Image
 import numpy as np
+import cv2
+import fitz
 from io import BytesIO
 from utils.polt import Annotator,colors
 import os
@@ -125,19 +127,45 @@ def draw_box(images, result):
         return images
     return base64_images
 
-import fitz
-
-def pdf_to_image(pdf_path, output_path):
-    pdf_document = fitz.open(pdf_path)
-    
-    for page_num in range(pdf_document.page_count):
-        page = pdf_document.load_page(page_num)
-        image_list = page.get_pixmap()
-        
-        image_path = output_path.format(page_num)
-        image_list.save(image_path)
-    
-    pdf_document.close()
+def draw_region(image_base64, bbox, label, index, margin=40):
+    """
+    裁剪单个差异框周围的区域并标注, 用于流式推送, 不必每来一个框就重绘整张图纸
+    :param image_base64: 原图 base64
+    :param bbox: 像素坐标 [x1, y1, x2, y2]
+    :param label: 差异标签
+    :param index: 图纸序号, 决定框的颜色, 与 draw_box 一致
+    :param margin: 框外保留的像素
+    :return: 标注后区域的 base64, bbox 无效时返回 None
+    """
+    image = np.ascontiguousarray(base64_to_pil(image_base64).convert("RGB"))
+    height, width = image.shape[:2]
+    try:
+        x1, y1, x2, y2 = [int(v) for v in bbox]
+    except (TypeError, ValueError):
+        return None
+    left, top = max(min(x1, x2) - margin, 0), max(min(y1, y2) - margin, 0)
+    right, bottom = min(max(x1, x2) + margin, width), min(max(y1, y2) + margin, height)
+    if right <= left or bottom <= top:
+        return None
+    region = np.ascontiguousarray(image[top:bottom, left:right])
+    annotator = Annotator(region, example=str("闸阀"),font_size=12,font="msyh.ttc",pil=True)
+    annotator.box_label(box=[x1 - left, y1 - top, x2 - left, y2 - top], label=label, color=colors(index, True), rotated=False)
+    return convertBase64(annotator.result())
+
+def iter_pdf_images(pdf_path, dpi=300, clip=None):
+    # 逐页生成 RGB ndarray, 直接使用 pixmap 的 samples 缓冲区, 不写盘也不做 PNG 编解码
+    # clip 为 PDF 坐标(point)的区域 (x0, y0, x1, y1), 只渲染该区域
+    matrix = fitz.Matrix(dpi / 72, dpi / 72)
+    with fitz.open(pdf_path) as pdf_document:
+        for page in pdf_document:
+            pix = page.get_pixmap(matrix=matrix, clip=fitz.Rect(clip) if clip is not None else None, alpha=False)
+            yield np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n).copy()
+            del pix
+
+def pdf_to_image(pdf_path, output_path, dpi=72):
+    # 需要落盘时才使用; 逐页从 iter_pdf_images 取出后立即写出, 内存中只保留一页
+    for page_num, page in enumerate(iter_pdf_images(pdf_path, dpi=dpi)):
+        Image.fromarray(page).save(output_path.format(page_num))
 
 def convertBase64FromPath(image_path):
     current_directory = os.getcwd()
@@ -0,0 +1,88 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class BatchAugment(nn.Module):
+    """
+    整批张量上的训练增强, 在 collate 之后、模型所在的设备上执行, 对应 datasets.transform_train 中的逐样本 PIL 增强:
+    RandomHorizontalFlip, RandomRotation(5) + RandomAffine(translate=0.1, scale=(0.95, 1.05)) + RandomCrop(32, padding=2)
+    合并为每个样本一次 affine_grid / grid_sample, ColorJitter(brightness=0.1, contrast=0.1), RandomErasing(p=0.1)
+    灰度图上 saturation / hue 不起作用, 省略; CLAHE 不可微且依赖直方图, 由 datasets.transform_train_batched 在 CPU 上预先完成
+
+    输入为 Normalize 之后的 (B, 1, H, W), 输出同样是 Normalize 之后的张量
+    """
+    def __init__(self, degrees=5.0, translate=0.1, scale=(0.95, 1.05), crop_padding=2, brightness=0.1, contrast=0.1,
+                 erasing_p=0.1, erasing_scale=(0.02, 0.1), erasing_ratio=(0.3, 3.3), mean=0.485, std=0.229, interpolation='nearest'):
+        super(BatchAugment, self).__init__()
+        self.degrees = degrees
+        self.translate = translate
+        self.scale = scale
+        self.crop_padding = crop_padding
+        self.brightness = brightness
+        self.contrast = contrast
+        self.erasing_p = erasing_p
+        self.erasing_scale = erasing_scale
+        self.erasing_ratio = erasing_ratio
+        self.mean = mean
+        self.std = std
+        self.interpolation = interpolation
+
+    def uniform(self, n, low, high, like):
+        return torch.empty(n, device=like.device, dtype=like.dtype).uniform_(low, high)
+
+    def geometric(self, x):
+        n, _, h, w = x.shape
+        # 水平翻转并入 affine: x 方向乘 -1
+        flip = torch.where(torch.rand(n, device=x.device) < 0.5, -1.0, 1.0).to(x.dtype)
+        angle = self.uniform(n, -self.degrees, self.degrees, x) * (math.pi / 180)
+        scale = self.uniform(n, *self.scale, x)
+        # 平移 (像素): RandomAffine 的 translate 取整 + RandomCrop 的 padding 等价于 ±crop_padding 的整数平移
+        tx = torch.round(self.uniform(n, -self.translate * w, self.translate * w, x))
+        ty = torch.round(self.uniform(n, -self.translate * h, self.translate * h, x))
+        tx = tx + torch.randint(-self.crop_padding, self.crop_padding + 1, (n,), device=x.device)
+        ty = ty + torch.randint(-self.crop_padding, self.crop_padding + 1, (n,), device=x.device)
+
+        # affine_grid 需要输出 -> 输入的逆变换: p_in = F^-1 R^-1 (p_out - t) / s, 坐标归一化到 [-1, 1]
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        tx, ty = tx * 2 / w, ty * 2 / h
+        theta = torch.stack([
+            torch.stack([flip * cos / scale, flip * sin / scale, -flip * (cos * tx + sin * ty) / scale], dim=1),
+            torch.stack([-sin / scale, cos / scale, (sin * tx - cos * ty) / scale], dim=1),
+        ], dim=1)
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        # 超出原图的区域填 0 (黑), 与 torchvision 的默认 fill 一致
+        return F.grid_sample(x, grid, mode=self.interpolation, padding_mode='zeros', align_corners=False)
+
+    def color(self, x):
+        n = x.size(0)
+        brightness = self.uniform(n, 1 - self.brightness, 1 + self.brightness, x).view(n, 1, 1, 1)
+        x = (x * brightness).clamp(0, 1)
+        contrast = self.uniform(n, 1 - self.contrast, 1 + self.contrast, x).view(n, 1, 1, 1)
+        mean = x.mean(dim=(1, 2, 3), keepdim=True)
+        return ((x - mean) * contrast + mean).clamp(0, 1)
+
+    def erasing(self, x):
+        n, _, h, w = x.shape
+        area = self.uniform(n, *self.erasing_scale, x) * h * w
+        log_ratio = self.uniform(n, math.log(self.erasing_ratio[0]), math.log(self.erasing_ratio[1]), x)
+        eh = torch.sqrt(area * torch.exp(log_ratio)).round().clamp(1, h)
+        ew = torch.sqrt(area / torch.exp(log_ratio)).round().clamp(1, w)
+        top = (torch.rand(n, device=x.device) * (h - eh + 1)).floor()
+        left = (torch.rand(n, device=x.device) * (w - ew + 1)).floor()
+        rows = torch.arange(h, device=x.device, dtype=x.dtype).view(1, h, 1)
+        cols = torch.arange(w, device=x.device, dtype=x.dtype).view(1, 1, w)
+        mask = ((rows >= top.view(n, 1, 1)) & (rows < (top + eh).view(n, 1, 1)) &
+                (cols >= left.view(n, 1, 1)) & (cols < (left + ew).view(n, 1, 1)))
+        mask &= (torch.rand(n, device=x.device) < self.erasing_p).view(n, 1, 1)
+        # 与 RandomErasing(value=0) 一致, 在 Normalize 之后的空间填 0
+        return x.masked_fill(mask.unsqueeze(1), 0)
+
+    @torch.no_grad()
+    def forward(self, x):
+        x = x * self.std + self.mean
+        x = self.color(self.geometric(x))
+        x = (x - self.mean) / self.std
+        return self.erasing(x)
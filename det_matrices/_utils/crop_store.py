@@ -0,0 +1,152 @@
+"""
+打包的裁剪图存储
+
+把 root_dir/<class>/*.png 一次性解码、转灰度、缩放到 size x size, 写成一个 uint8 的 .npy (N, size, size)
+和对应的 labels.npy, 训练时以只读 mmap 打开, DataLoader 的多个 worker 共享同一份页缓存, 不再每个样本打开解码 PNG
+manifest.json 中记录类别映射、文件列表、有效性统计和源目录签名, 源目录不变时直接复用, 不再逐个校验图片
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+
+def source_signature(root_dir, class_to_idx, size):
+    """
+    源目录的签名: 文件相对路径、大小、修改时间 + 类别映射和尺寸, 只 stat 不读文件
+    :return: (签名, [(相对路径, 类别名), ...])
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([VERSION, size, class_to_idx], sort_keys=True).encode())
+    files = []
+    for class_dir in sorted(os.listdir(root_dir)):
+        class_path = os.path.join(root_dir, class_dir)
+        if not os.path.isdir(class_path) or class_dir not in class_to_idx:
+            continue
+        for entry in sorted(os.scandir(class_path), key=lambda e: e.name):
+            if not entry.name.endswith("png"):
+                continue
+            stat = entry.stat()
+            rel_path = os.path.join(class_dir, entry.name)
+            h.update(f"{rel_path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+            files.append((rel_path, class_dir))
+    return h.hexdigest(), files
+
+
+def check_crop(img_path, size):
+    """
+    解码一次, 同时完成有效性检查 (与 CombinedDataset.is_valid_image 的阈值一致) 和缩放
+    :return: (状态, 缩放后的 uint8 数组), 状态为 "valid" / "black" / "white" / "low_contrast" / "unreadable"
+    """
+    try:
+        with Image.open(img_path) as img:
+            img = img.convert('L')
+            array = np.asarray(img, dtype=np.float64)
+            if array.mean() < 5:
+                return "black", None
+            if array.mean() > 250:
+                return "white", None
+            if array.std() < 1:
+                return "low_contrast", None
+            return "valid", np.asarray(img.resize((size, size), Image.BILINEAR), dtype=np.uint8)
+    except Exception:
+        return "unreadable", None
+
+
+def build_crop_store(root_dir, store_dir, class_to_idx, size=32, workers=None):
+    """
+    :param root_dir: 按类别分目录的裁剪图根目录
+    :param store_dir: 存储目录
+    :param class_to_idx: 类别名 -> label
+    :param size: 预缩放的边长, 与 transform 中的 Resize 一致
+    :return: manifest
+    """
+    signature, files = source_signature(root_dir, class_to_idx, size)
+    os.makedirs(store_dir, exist_ok=True)
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        checked = list(pool.map(lambda f: check_crop(os.path.join(root_dir, f[0]), size), files))
+
+    valid = [(f, crop) for f, (status, crop) in zip(files, checked) if status == "valid"]
+    stats = {"total": len(files), "valid": len(valid)}
+    invalid = {}
+    for (rel_path, _), (status, _) in zip(files, checked):
+        if status != "valid":
+            stats[status] = stats.get(status, 0) + 1
+            invalid[rel_path] = status
+
+    # 先写临时文件再改名, 构建中断时不会留下不完整的存储
+    crops_tmp = os.path.join(store_dir, "crops.tmp.npy")
+    crops = np.lib.format.open_memmap(crops_tmp, mode="w+", dtype=np.uint8, shape=(len(valid), size, size))
+    for i, (_, crop) in enumerate(valid):
+        crops[i] = crop
+    crops.flush()
+    del crops
+    labels = np.array([class_to_idx[class_dir] for (_, class_dir), _ in valid], dtype=np.int64)
+    np.save(os.path.join(store_dir, "labels.tmp.npy"), labels)
+    os.replace(crops_tmp, os.path.join(store_dir, "crops.npy"))
+    os.replace(os.path.join(store_dir, "labels.tmp.npy"), os.path.join(store_dir, "labels.npy"))
+
+    manifest = {
+        "version": VERSION,
+        "signature": signature,
+        "size": size,
+        "class_to_idx": class_to_idx,
+        "files": [rel_path for (rel_path, _), _ in valid],
+        "stats": stats,
+        "invalid": invalid,
+    }
+    with open(os.path.join(store_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    return manifest
+
+
+class CropStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.files = self.manifest["files"]
+        self.labels = np.load(os.path.join(store_dir, "labels.npy"))
+        self._crops = None
+
+    @classmethod
+    def open(cls, root_dir, store_dir, class_to_idx, size=32):
+        """
+        源目录签名与 manifest 一致时直接打开, 否则重新构建
+        """
+        signature, _ = source_signature(root_dir, class_to_idx, size)
+        manifest_path = os.path.join(store_dir, MANIFEST)
+        manifest = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        if manifest is None or manifest.get("signature") != signature:
+            print(f"Building crop store {store_dir} from {root_dir} ...")
+            manifest = build_crop_store(root_dir, store_dir, class_to_idx, size)
+        stats = manifest["stats"]
+        print(f"Crop store {store_dir}: {stats['valid']}/{stats['total']} valid crops, skipped {len(manifest['invalid'])}")
+        return cls(store_dir)
+
+    @property
+    def crops(self):
+        # 在 worker 中首次访问时才 mmap, 避免 spawn 方式启动 worker 时 pickle 整个数组
+        if self._crops is None:
+            self._crops = np.load(os.path.join(self.store_dir, "crops.npy"), mmap_mode="r")
+        return self._crops
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_crops"] = None
+        return state
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, idx):
+        return Image.fromarray(np.array(self.crops[idx]))
@@ -4,21 +4,34 @@ import numpy as np
 from PIL import Image, ImageStat
 import torch
 from torch.utils.data import Dataset, DataLoader
-from torch.utils.data.sampler import WeightedRandomSampler
+from torch.utils.data.sampler import Sampler, WeightedRandomSampler
 from torchvision import transforms
 from imblearn.over_sampling import SMOTE
 from imblearn.under_sampling import RandomUnderSampler
 from imblearn.pipeline import Pipeline
 import json 
 import cv2
+from .crop_store import CropStore
 
 # 数据预处理和加载
 class CLAHETransform:
+    def __init__(self, clip_limit=2.0, tile_grid_size=(8, 8)):
+        self.clip_limit = clip_limit
+        self.tile_grid_size = tile_grid_size
+        self.clahe = None
+
     def __call__(self, img):
+        # 每个进程只创建一次 CLAHE 对象; cv2 对象不能 pickle, 在 worker 中首次调用时创建
+        if self.clahe is None:
+            self.clahe = cv2.createCLAHE(clipLimit=self.clip_limit, tileGridSize=self.tile_grid_size)
         img = np.array(img)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        img = clahe.apply(img)
+        img = self.clahe.apply(img)
         return Image.fromarray(img)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["clahe"] = None
+        return state
     
 transform_train = transforms.Compose([
     transforms.Resize((32, 32)),
@@ -32,6 +45,14 @@ transform_train = transforms.Compose([
     transforms.Normalize(mean=[0.485], std=[0.229]),
     transforms.RandomErasing(p=0.1, scale=(0.02, 0.1), ratio=(0.3, 3.3))
 ])
+# 配合 batch_augment.BatchAugment 使用: 逐样本只做缩放、CLAHE 和归一化, 随机增强在 collate 之后整批完成
+# CLAHE 放在几何 / 颜色增强之前, 是与 transform_train 唯一的顺序差异
+transform_train_batched = transforms.Compose([
+    transforms.Resize((32, 32)),
+    CLAHETransform(),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485], std=[0.229])
+])
 transform_val = transforms.Compose([
     transforms.Resize((32, 32)),
     transforms.ToTensor(),
@@ -39,8 +60,82 @@ transform_val = transforms.Compose([
 ])
 
 
+class ClassIndex:
+    """
+    按类别排序的样本索引, 在 __init__ 中构建一次
+    每个类别的样本在 order 中是连续的一段 [starts[c], starts[c] + counts[c]),
+    同类 / 异类的均匀采样都是 O(1), 不再每次遍历全部 labels
+    """
+    def __init__(self, labels):
+        labels = np.asarray(labels, dtype=np.int64)
+        self.order = np.argsort(labels, kind='stable')
+        self.counts = np.bincount(labels) if len(labels) else np.zeros(0, dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]]).astype(np.int64)
+        # 样本在 order 中的位置, 用于排除 anchor 自身
+        self.position = np.empty(len(labels), dtype=np.int64)
+        self.position[self.order] = np.arange(len(labels))
+        self.classes = np.flatnonzero(self.counts)
+
+    def indices(self, label):
+        start = self.starts[label]
+        return self.order[start:start + self.counts[label]]
+
+    def sample_positive(self, idx, label):
+        # 同类中除 idx 以外的样本; 类别只有一个样本时返回自身
+        count = self.counts[label]
+        if count < 2:
+            return int(idx)
+        offset = random.randrange(count - 1)
+        if offset >= self.position[idx] - self.starts[label]:
+            offset += 1
+        return int(self.order[self.starts[label] + offset])
+
+    def sample_negative(self, label):
+        # 在其余类别的全部样本中均匀采样: 跳过该类别所在的连续区间
+        count = self.counts[label]
+        offset = random.randrange(len(self.order) - count)
+        if offset >= self.starts[label]:
+            offset += count
+        return int(self.order[offset])
+
+
+class PKBatchSampler(Sampler):
+    """
+    每个 batch 固定包含 P 个类别 x 每类 K 个样本, 保证 hard triplet miner 在 batch 内总能找到正样本对
+    类别样本数不足 K 时有放回采样
+    """
+    def __init__(self, class_index, classes_per_batch, samples_per_class, num_batches, num_samples_per_class=1):
+        """
+        :param class_index: ClassIndex
+        :param classes_per_batch: P
+        :param samples_per_class: K
+        :param num_batches: 每个 epoch 的 batch 数
+        :param num_samples_per_class: CombinedDataset 中每张图展开的次数, 返回的是展开后的索引
+        """
+        self.class_index = class_index
+        self.classes_per_batch = min(classes_per_batch, len(class_index.classes))
+        self.samples_per_class = samples_per_class
+        self.num_batches = num_batches
+        self.num_samples_per_class = num_samples_per_class
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        for _ in range(self.num_batches):
+            batch = []
+            for label in np.random.choice(self.class_index.classes, self.classes_per_batch, replace=False):
+                indices = self.class_index.indices(label)
+                picked = np.random.choice(indices, self.samples_per_class, replace=len(indices) < self.samples_per_class)
+                batch.extend((picked * self.num_samples_per_class).tolist())
+            yield batch
+
+
 class CombinedDataset(Dataset):
-    def __init__(self, root_dir, transform=None, class_map_path='./weights/class_map.json', num_samples_per_class=5):
+    def __init__(self, root_dir, transform=None, class_map_path='./weights/class_map.json', num_samples_per_class=5, store_dir=None):
+        """
+        :param store_dir: 打包的裁剪图存储目录 (见 crop_store), 为 None 时按原方式逐个读取 PNG
+        """
         self.root_dir = root_dir
         self.transform = transform
         self.classes = os.listdir(root_dir)
@@ -57,19 +152,27 @@ class CombinedDataset(Dataset):
             self.class_to_idx = self.load_class_mapping(class_map_path)
             self.idx_to_class = {idx: cls_name for cls_name, idx in self.class_to_idx.items()}
                             
-        for class_dir in self.classes:
-            class_path = os.path.join(root_dir, class_dir)
-            if os.path.isdir(class_path):
-                for img_name in os.listdir(class_path):
-                    if not img_name.endswith("png"):
-                        print(f"filename error: {img_name}")
-                        continue
-                    img_path = os.path.join(class_path, img_name)
-                    if self.is_valid_image(img_path):
-                        self.data.append(img_path)
-                        self.labels.append(self.class_to_idx[class_dir])
+        self.store = None
+        if store_dir is not None:
+            # 有效性统计缓存在 manifest 中, 源目录未变化时不再逐个解码校验
+            self.store = CropStore.open(root_dir, store_dir, self.class_to_idx)
+            self.data = [os.path.join(root_dir, f) for f in self.store.files]
+            self.labels = self.store.labels.tolist()
+        else:
+            for class_dir in self.classes:
+                class_path = os.path.join(root_dir, class_dir)
+                if os.path.isdir(class_path):
+                    for img_name in os.listdir(class_path):
+                        if not img_name.endswith("png"):
+                            print(f"filename error: {img_name}")
+                            continue
+                        img_path = os.path.join(class_path, img_name)
+                        if self.is_valid_image(img_path):
+                            self.data.append(img_path)
+                            self.labels.append(self.class_to_idx[class_dir])
         
         # self.data, self.labels = self.balance_dataset()
+        self.class_index = ClassIndex(self.labels)
         self.sample_weights = self.compute_sample_weights()
         
         if "train" in root_dir:
@@ -81,19 +184,16 @@ class CombinedDataset(Dataset):
 
     def __getitem__(self, idx):
         base_idx = idx // self.num_samples_per_class
-        anchor_path = self.data[base_idx]
         anchor_label = self.labels[base_idx]
-        anchor_img = Image.open(anchor_path).convert('L')
+        anchor_img = self.load_image(base_idx)
 
-        positive_idx = random.choice([i for i, label in enumerate(self.labels) if label == anchor_label and i != idx])
-        positive_path = self.data[positive_idx]
+        positive_idx = self.class_index.sample_positive(base_idx, anchor_label)
         positive_label = self.labels[positive_idx]
-        positive_img = Image.open(positive_path).convert('L')
+        positive_img = self.load_image(positive_idx)
 
-        negative_idx = random.choice([i for i, label in enumerate(self.labels) if label != anchor_label])
-        negative_path = self.data[negative_idx]
+        negative_idx = self.class_index.sample_negative(anchor_label)
         negative_label = self.labels[negative_idx]
-        negative_img = Image.open(negative_path).convert('L')
+        negative_img = self.load_image(negative_idx)
         
 
         _anchor_img = self.transform(anchor_img)
@@ -103,6 +203,11 @@ class CombinedDataset(Dataset):
         return _anchor_img, contrastive_img, positive_img, negative_img, anchor_label, positive_label, negative_label
             
 
+    def load_image(self, idx):
+        if self.store is not None:
+            return self.store[idx]
+        return Image.open(self.data[idx]).convert('L')
+
     def get_class_name(self, idx):
         return self.idx_to_class.get(idx, "Unknown")
 
@@ -176,11 +281,25 @@ class CombinedDataset(Dataset):
             return json.load(f)
     
         
-def get_data_loaders(root_dir='../datas/cropped_images', mode='train', batch_size=256):
+def get_data_loaders(root_dir='../datas/cropped_images', mode='train', batch_size=256, pk_sampling=False, samples_per_class=4, crop_store=None, batch_augment=False):
+    """
+    :param pk_sampling: 训练集使用 PKBatchSampler, 每个 batch 为 (batch_size // samples_per_class) 个类别 x samples_per_class 个样本
+    :param crop_store: 打包裁剪图存储的根目录, 每个 mode 一个子目录, 首次使用时构建
+    :param batch_augment: 训练集使用 transform_train_batched, 随机增强由训练循环中的 BatchAugment 整批完成
+    """
     data_dir = os.path.join(root_dir, mode)
-    dataset = CombinedDataset(data_dir, transform_train if mode == 'train' else transform_val)
-    
+    store_dir = os.path.join(crop_store, mode) if crop_store else None
     if mode == 'train':
+        transform = transform_train_batched if batch_augment else transform_train
+    else:
+        transform = transform_val
+    dataset = CombinedDataset(data_dir, transform, store_dir=store_dir)
+    
+    if mode == 'train' and pk_sampling:
+        batch_sampler = PKBatchSampler(dataset.class_index, batch_size // samples_per_class, samples_per_class,
+                                       num_batches=len(dataset) // batch_size, num_samples_per_class=dataset.num_samples_per_class)
+        dataloader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=8)
+    elif mode == 'train':
         # sampler = WeightedRandomSampler(dataset.sample_weights, len(dataset.sample_weights))
         dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True, num_workers=8)
     else:
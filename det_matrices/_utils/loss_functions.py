@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from pytorch_metric_learning import losses, miners, distances
 import json
 from copy import deepcopy
+from .models import forward_views
 
 # BYOL the more effecient self-surprised loss
 class MLPHead(nn.Module):
@@ -40,17 +41,20 @@ class BYOL(nn.Module):
             target_params.data = self.moving_average_decay * target_params.data + (1 - self.moving_average_decay) * online_params.data
 
     def forward(self, x1, x2):
-        online_feature1, _ = self.online_encoder(x1)
-        online_feature2, _ = self.online_encoder(x2)
-        
+        (online_feature1, _), (online_feature2, _) = forward_views(self.online_encoder, x1, x2)
+        return self.loss_from_features(online_feature1, online_feature2, x1, x2)
+
+    def loss_from_features(self, online_feature1, online_feature2, x1, x2):
+        """
+        复用训练步骤中已经算好的 online encoder 特征 (anchor / contrastive 视图), 只为 target encoder 做一次拼接前向
+        """
         online_proj1 = self.online_projector(online_feature1)
         online_proj2 = self.online_projector(online_feature2)
         online_pred1 = self.online_predictor(online_proj1)
         online_pred2 = self.online_predictor(online_proj2)
 
         with torch.no_grad():
-            target_feature1, _ = self.target_encoder(x1)
-            target_feature2, _ = self.target_encoder(x2)
+            (target_feature1, _), (target_feature2, _) = forward_views(self.target_encoder, x1, x2)
             target_proj1 = self.target_projector(target_feature1)
             target_proj2 = self.target_projector(target_feature2)
 
@@ -237,7 +241,7 @@ class CombinedLoss(nn.Module):
         else:
             distillation_loss = self.distillation_loss(teacher_logits, anchor_logits, teacher_features, anchor_features)
         
-        combined_loss = self.weight_decay * self.l2_regularization() + (
+        combined_loss = (
             self.weights_triplet_cos * triplet_cos_loss +
             self.weights_ntxent * nt_xent_loss +
             self.weights_arc * arcface_loss +
@@ -248,6 +252,9 @@ class CombinedLoss(nn.Module):
             self.weights_triplet_cos + self.weights_ntxent + self.weights_arc + 
             self.weights_classification + self.weights_self_surprised + self.weights_distillation
         )
+        # 显式 L2 需要对所有参数求 norm 并反向传播; 默认为 0, 权重衰减由优化器的 decoupled weight decay 完成
+        if self.weight_decay > 0:
+            combined_loss = combined_loss + self.weight_decay * self.l2_regularization()
         
         return combined_loss
         
@@ -263,5 +270,5 @@ class CombinedLoss(nn.Module):
          
 #         return combined_loss
 
-def get_loss(model=None, margin=1.0, num_classes=None, num_epochs=0):
-    return CombinedLoss(model=model, margin=margin, num_classes=num_classes, num_epochs=num_epochs, temperature=4.0, s=30.0, m=0.50)
\ No newline at end of file
+def get_loss(model=None, margin=1.0, num_classes=None, num_epochs=0, weight_decay=0.0):
+    return CombinedLoss(model=model, margin=margin, num_classes=num_classes, num_epochs=num_epochs, temperature=4.0, s=30.0, m=0.50, weight_decay=weight_decay)
\ No newline at end of file
@@ -4,6 +4,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+from .models import forward_views
 
 def plot_histogram(positive_distances, negative_distances, title):
     plt.figure(figsize=(10, 5))
@@ -26,9 +27,7 @@ def compute_distances(device, model, data_loader):
         for anchor_img, contrastive_img, positive_img, negative_img, anchor_label, positive_label, negative_label in data_loader:
             anchor_img, positive_img, negative_img = anchor_img.to(device), positive_img.to(device), negative_img.to(device)
 
-            anchor_feature, _ = model(anchor_img)
-            positive_feature, _ = model(positive_img)
-            negative_feature, _ = model(negative_img)
+            (anchor_feature, _), (positive_feature, _), (negative_feature, _) = forward_views(model, anchor_img, positive_img, negative_img)
 
             positive_distance_euclid = F.pairwise_distance(anchor_feature, positive_feature).cpu().numpy()
             negative_distance_euclid = F.pairwise_distance(anchor_feature, negative_feature).cpu().numpy()
@@ -132,9 +131,8 @@ def evaluate_model(device, model, criterion, val_loader, threshold_euc, threshol
             anchor_img, contrastive_img, positive_img, negative_img = anchor_img.to(device), contrastive_img.to(device), positive_img.to(device), negative_img.to(device)
             anchor_label, positive_label, negative_label = anchor_label.to(device), positive_label.to(device), negative_label.to(device)
             
-            anchor_features, anchor_logits = model(anchor_img)
-            positive_features, positive_logits = model(positive_img)
-            negative_features, negative_logits = model(negative_img)
+            (anchor_features, anchor_logits), (positive_features, positive_logits), (negative_features, negative_logits) = \
+                forward_views(model, anchor_img, positive_img, negative_img)
             
             labels = torch.cat((anchor_label, positive_label, negative_label), dim=0)
             features = torch.cat((anchor_features, positive_features, negative_features), dim=0)
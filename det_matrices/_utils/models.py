@@ -1,5 +1,8 @@
+from contextlib import contextmanager
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.models as models
 from torchvision.models import EfficientNet_V2_S_Weights, ConvNeXt_Tiny_Weights, MobileNet_V2_Weights
 
@@ -148,3 +151,64 @@ def get_teacher_model(num_classes=0, dropout_p=0.3, init=True, update=False, wei
 
 def get_student_model(num_classes=0, dropout_p=0.3, init=True, update=False, weight_path=None, cuda=True):
     return HybridMobileNetV2(num_classes, dropout_p, init, update, weight_path, cuda)
+
+
+def _per_view_batchnorm_forward(bn, views, x):
+    """
+    views 个等长视图拼成的 batch 上, 按视图分别计算 BatchNorm 统计量, 并按依次调用 views 次的方式更新 running stats
+    (G*B, C, ...) -> (B, G*C, ...), 一次 F.batch_norm 完成所有视图
+    """
+    if not bn.training:
+        # eval 模式使用 running stats, 拼接与否结果相同
+        return type(bn).forward(bn, x)
+    if bn.momentum is None:
+        # 累计平均 (momentum=None) 的更新系数依赖调用次数, 逐视图调用
+        return torch.cat([type(bn).forward(bn, chunk) for chunk in x.chunk(views)])
+    batch, channels = x.size(0) // views, x.size(1)
+    grouped = x.reshape(views, batch, *x.shape[1:]).transpose(0, 1).reshape(batch, views * channels, *x.shape[2:])
+    running_mean = running_var = None
+    if bn.track_running_stats:
+        running_mean, running_var = bn.running_mean.repeat(views), bn.running_var.repeat(views)
+    weight = bn.weight.repeat(views) if bn.weight is not None else None
+    bias = bn.bias.repeat(views) if bn.bias is not None else None
+    out = F.batch_norm(grouped, running_mean, running_var, weight, bias, True, bn.momentum, bn.eps)
+    if bn.track_running_stats:
+        with torch.no_grad():
+            # 每个视图的更新为 r_g = (1 - m) r + m * stat_g, 依次更新 views 次等价于
+            # (1 - m)^G r + sum_g (1 - m)^(G-1-g) (r_g - (1 - m) r)
+            decay = 1 - bn.momentum
+            for buffer, updated in ((bn.running_mean, running_mean), (bn.running_var, running_var)):
+                deltas = updated.view(views, channels) - decay * buffer
+                powers = decay ** torch.arange(views - 1, -1, -1, device=buffer.device, dtype=buffer.dtype)
+                buffer.mul_(decay ** views).add_((powers.view(views, 1) * deltas).sum(0))
+            bn.num_batches_tracked.add_(views)
+    return out.reshape(batch, views, channels, *x.shape[2:]).transpose(0, 1).reshape(x.shape)
+
+
+@contextmanager
+def per_view_batchnorm(model, views):
+    """
+    在上下文中让 model 中所有 BatchNorm 按视图分别统计, 使拼接后的单次前向与逐视图调用 model 的结果一致
+    """
+    patched = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    for m in patched:
+        m.forward = lambda x, m=m: _per_view_batchnorm_forward(m, views, x)
+    try:
+        yield model
+    finally:
+        for m in patched:
+            del m.forward
+
+
+def forward_views(model, *views):
+    """
+    多个视图 (anchor / positive / negative ...) 拼成一个 batch 只做一次前向, 再按视图拆分输出
+    BatchNorm 按视图统计, 与逐个调用 model(view) 等价; LayerNorm 等逐样本的归一化本身不受拼接影响
+    :return: [(feature, logits), ...], 与 views 一一对应
+    """
+    sizes = [view.size(0) for view in views]
+    if len(set(sizes)) > 1:
+        return [model(view) for view in views]
+    with per_view_batchnorm(model, len(views)):
+        features, logits = model(torch.cat(views))
+    return list(zip(features.split(sizes), logits.split(sizes)))
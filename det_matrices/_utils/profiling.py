@@ -0,0 +1,51 @@
+import time
+
+import torch
+
+
+class StepTimer:
+    """
+    训练步骤的分阶段耗时: data (等待 DataLoader + 拷贝到设备 + 批量增强), forward, loss, backward, optimizer
+    每 every 步采样一次; 采样的步骤在每个阶段结束时同步 CUDA, 其余步骤不计时也不同步, 不影响吞吐
+    """
+    PHASES = ("data", "forward", "loss", "backward", "optimizer")
+
+    def __init__(self, device, every=50):
+        """
+        :param device: 训练设备, CUDA 上计时前需要同步
+        :param every: 采样间隔 (步), 0 表示关闭
+        """
+        self.cuda = torch.device(device).type == "cuda"
+        self.every = every
+        self.step = 0
+        self.active = False
+        self.last = None
+        self.times = {}
+
+    def start(self):
+        # 在取下一个 batch 之前调用, 标记 data 阶段的起点
+        self.active = self.every > 0 and self.step % self.every == 0
+        if self.active:
+            self.times = {}
+            self.last = self._now()
+
+    def mark(self, phase):
+        if self.active:
+            now = self._now()
+            self.times[phase] = self.times.get(phase, 0.0) + now - self.last
+            self.last = now
+
+    def end(self, writer, prefix="StepTime"):
+        """
+        结束当前步骤, 采样步骤的各阶段耗时 (ms) 和总耗时写入 TensorBoard
+        """
+        if self.active:
+            for phase in self.PHASES:
+                writer.add_scalar(f"{prefix}/{phase}", self.times.get(phase, 0.0) * 1000, self.step)
+            writer.add_scalar(f"{prefix}/total", sum(self.times.values()) * 1000, self.step)
+        self.step += 1
+
+    def _now(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
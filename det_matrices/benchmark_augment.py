@@ -0,0 +1,83 @@
+"""
+Benchmark training augmentation throughput: the per-sample PIL transform_train against
+transform_train_batched in the workers plus BatchAugment on whole collated batches,
+on the CPU and, when available, on CUDA. Also times CLAHE with a new cv2 object per call
+against the reused CLAHETransform.
+
+    python benchmark_augment.py --images 4096 --batch-size 256
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from _utils.batch_augment import BatchAugment
+from _utils.datasets import CLAHETransform, transform_train, transform_train_batched
+
+
+def clahe_per_call(img):
+    # 原 CLAHETransform: 每次调用都新建 CLAHE 对象, 作为对照
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return Image.fromarray(clahe.apply(np.array(img)))
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (int(rng.integers(24, 64)), int(rng.integers(24, 64))), dtype=np.uint8))
+              for _ in range(opt.images)]
+    small = [img.resize((32, 32)) for img in images]
+
+    start = time.perf_counter()
+    for img in small:
+        clahe_per_call(img)
+    t_new = time.perf_counter() - start
+    clahe = CLAHETransform()
+    start = time.perf_counter()
+    for img in small:
+        clahe(img)
+    t_reused = time.perf_counter() - start
+    print(f"{'CLAHE':>22} {'images/s':>10}")
+    print(f"{'new object per call':>22} {len(small) / t_new:>10.0f}")
+    print(f"{'reused object':>22} {len(small) / t_reused:>10.0f}")
+
+    start = time.perf_counter()
+    per_sample = torch.stack([transform_train(img) for img in images])
+    t_per_sample = time.perf_counter() - start
+
+    start = time.perf_counter()
+    prepared = torch.stack([transform_train_batched(img) for img in images])
+    t_prepare = time.perf_counter() - start
+
+    print(f"\n{'pipeline':>22} {'images/s':>10} {'worker (s)':>11} {'batch (s)':>10} {'mean':>7} {'std':>7}")
+    print(f"{'per-sample PIL':>22} {len(images) / t_per_sample:>10.0f} {t_per_sample:>11.3f} {'-':>10} "
+          f"{per_sample.mean():>7.3f} {per_sample.std():>7.3f}")
+
+    devices = [torch.device("cpu")] + ([torch.device("cuda")] if torch.cuda.is_available() else [])
+    for device in devices:
+        augment = BatchAugment().to(device)
+        batches = prepared.to(device).split(opt.batch_size)
+        augment(batches[0])  # warm-up
+        synchronize(device)
+        start = time.perf_counter()
+        outputs = [augment(batch) for batch in batches]
+        synchronize(device)
+        t_batch = time.perf_counter() - start
+        output = torch.cat(outputs)
+        name = f"batched ({device.type})"
+        print(f"{name:>22} {len(images) / (t_prepare + t_batch):>10.0f} {t_prepare:>11.3f} {t_batch:>10.3f} "
+              f"{output.mean():>7.3f} {output.std():>7.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=4096)
+    parser.add_argument("--batch-size", type=int, default=256, help="images per BatchAugment call (4 views x triplet batch in training)")
+    main(parser.parse_args())
@@ -0,0 +1,133 @@
+"""
+Benchmark triplet sampling of CombinedDataset: the original per-item list comprehensions
+over all labels against the precomputed ClassIndex, dataset start-up with and without the
+packed crop store, and end-to-end DataLoader throughput with shuffled batches and with the
+P x K batch sampler, on a synthetic crop tree.
+
+    python benchmark_loader.py --sizes 10000 100000 300000
+    python benchmark_loader.py --classes 50 --images-per-class 100 --workers 8 --batches 20
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from _utils.datasets import ClassIndex, CombinedDataset, PKBatchSampler, transform_train
+
+
+def legacy_triplet(labels, idx):
+    # 原 CombinedDataset.__getitem__ 中的正负样本采样, 作为对照
+    anchor_label = labels[idx]
+    positive_idx = random.choice([i for i, label in enumerate(labels) if label == anchor_label and i != idx])
+    negative_idx = random.choice([i for i, label in enumerate(labels) if label != anchor_label])
+    return positive_idx, negative_idx
+
+
+class LegacyDataset(CombinedDataset):
+    def __getitem__(self, idx):
+        base_idx = idx // self.num_samples_per_class
+        positive_idx, negative_idx = legacy_triplet(self.labels, base_idx)
+        anchor_img = Image.open(self.data[base_idx]).convert('L')
+        positive_img = Image.open(self.data[positive_idx]).convert('L')
+        negative_img = Image.open(self.data[negative_idx]).convert('L')
+        return (self.transform(anchor_img), self.transform(anchor_img), self.transform(positive_img), self.transform(negative_img),
+                self.labels[base_idx], self.labels[positive_idx], self.labels[negative_idx])
+
+
+def make_crops(root, num_classes, images_per_class, rng):
+    for c in range(num_classes):
+        class_dir = os.path.join(root, f"class_{c:03d}")
+        os.makedirs(class_dir, exist_ok=True)
+        for i in range(images_per_class):
+            crop = rng.integers(0, 256, (int(rng.integers(24, 64)), int(rng.integers(24, 64))), dtype=np.uint8)
+            Image.fromarray(crop).save(os.path.join(class_dir, f"{i}.png"))
+
+
+def time_loader(loader, batches):
+    iterator = iter(loader)
+    next(iterator)  # worker start-up
+    start = time.perf_counter()
+    samples = 0
+    for _ in range(batches):
+        samples += len(next(iterator)[4])
+    return samples / (time.perf_counter() - start)
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    print(f"{'samples':>8} {'classes':>8} {'legacy (us)':>12} {'index (us)':>11} {'speedup':>8}")
+    for n in opt.sizes:
+        labels = rng.integers(0, opt.classes, n).tolist()
+        index = ClassIndex(labels)
+        queries = rng.integers(0, n, opt.queries).tolist()
+
+        start = time.perf_counter()
+        for idx in queries:
+            legacy_triplet(labels, idx)
+        t_legacy = (time.perf_counter() - start) / len(queries) * 1e6
+
+        start = time.perf_counter()
+        for _ in range(100):
+            for idx in queries:
+                index.sample_positive(idx, labels[idx])
+                index.sample_negative(labels[idx])
+        t_index = (time.perf_counter() - start) / (100 * len(queries)) * 1e6
+        print(f"{n:>8} {opt.classes:>8} {t_legacy:>12.1f} {t_index:>11.2f} {t_legacy / t_index:>7.0f}x")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # CombinedDataset 会写 ./weights/class_map.json 和 class_weights.json, 在临时目录中运行以免覆盖
+        os.chdir(tmp)
+        os.makedirs("weights")
+        root = os.path.join(tmp, "train")
+        make_crops(root, opt.classes, opt.images_per_class, rng)
+
+        timings = {}
+        start = time.perf_counter()
+        legacy = LegacyDataset(root, transform_train)
+        timings["PNG tree"] = time.perf_counter() - start
+        dataset = CombinedDataset(root, transform_train)
+        store_dir = os.path.join(tmp, "store")
+        start = time.perf_counter()
+        CombinedDataset(root, transform_train, store_dir=store_dir)
+        timings["store (build)"] = time.perf_counter() - start
+        start = time.perf_counter()
+        stored = CombinedDataset(root, transform_train, store_dir=store_dir)
+        timings["store (cached)"] = time.perf_counter() - start
+        print(f"\n{'dataset start-up':>16} {'seconds':>10}")
+        for name, seconds in timings.items():
+            print(f"{name:>16} {seconds:>10.3f}")
+
+        print(f"\n{'loader':>16} {'samples/s':>10} {'classes/batch':>14}")
+        loaders = {
+            "legacy shuffle": DataLoader(legacy, batch_size=opt.batch_size, shuffle=True, drop_last=True, num_workers=opt.workers),
+            "index shuffle": DataLoader(dataset, batch_size=opt.batch_size, shuffle=True, drop_last=True, num_workers=opt.workers),
+            "index P x K": DataLoader(dataset, num_workers=opt.workers, batch_sampler=PKBatchSampler(
+                dataset.class_index, opt.batch_size // opt.samples_per_class, opt.samples_per_class,
+                num_batches=opt.batches + 1, num_samples_per_class=dataset.num_samples_per_class)),
+            "store shuffle": DataLoader(stored, batch_size=opt.batch_size, shuffle=True, drop_last=True, num_workers=opt.workers),
+            "store P x K": DataLoader(stored, num_workers=opt.workers, batch_sampler=PKBatchSampler(
+                stored.class_index, opt.batch_size // opt.samples_per_class, opt.samples_per_class,
+                num_batches=opt.batches + 1, num_samples_per_class=stored.num_samples_per_class)),
+        }
+        for name, loader in loaders.items():
+            throughput = time_loader(loader, opt.batches)
+            classes = np.mean([len(set(batch[4].tolist())) for batch, _ in zip(loader, range(3))])
+            print(f"{name:>16} {throughput:>10.0f} {classes:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 300000], help="dataset sizes for the sampling micro-benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="triplets sampled per size")
+    parser.add_argument("--classes", type=int, default=40)
+    parser.add_argument("--images-per-class", type=int, default=50, help="synthetic crops per class for the loader benchmark")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--samples-per-class", type=int, default=4, help="K of the P x K batch sampler")
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=8)
+    main(parser.parse_args())
@@ -0,0 +1,99 @@
+"""
+Benchmark the Hungarian cost matrix of match_optimized: the original nested Python
+loop against the broadcast build_cost_matrix, on synthetic symbol layouts, and the
+end-to-end dense match_optimized against the spatially gated match_sparse.
+
+    python benchmark_matching.py --counts 100 300 1000
+    python benchmark_matching.py --counts 2000 5000 --max-loop 0 --max-dense 2000
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from cad_pdf_matching import (build_cost_matrix, calculate_area, calculate_distance,
+                              calculate_relative_position_difference, calculate_shape_similarity,
+                              match_optimized, match_sparse, normalize_bbox)
+
+
+def cost_matrix_loop(boxes1, boxes2, image_shape1, image_shape2):
+    # 原 match_optimized 中的双重循环, 作为对照
+    norm_boxes1 = [normalize_bbox(image_shape1, box) for box in boxes1]
+    norm_boxes2 = [normalize_bbox(image_shape2, box) for box in boxes2]
+    cost_matrix = np.zeros((len(norm_boxes1), len(norm_boxes2)))
+    for i, box1 in enumerate(norm_boxes1):
+        for j, box2 in enumerate(norm_boxes2):
+            distance = calculate_distance(box1, box2)
+            shape_similarity = calculate_shape_similarity(box1, box2)
+            area1 = calculate_area(box1)
+            area2 = calculate_area(box2)
+            area_ratio = min(area1, area2) / max(area1, area2)
+            position_difference = calculate_relative_position_difference(box1, box2, image_shape1, image_shape2)
+            cost_matrix[i, j] = distance - shape_similarity - area_ratio + position_difference
+    return cost_matrix
+
+
+def random_boxes(n, image_shape, rng):
+    h, w = image_shape[:2]
+    xy = rng.uniform(0, 1, (n, 2)) * [w - 80, h - 80]
+    wh = rng.uniform(10, 80, (n, 2))
+    return np.concatenate([xy, xy + wh], axis=1)
+
+
+def jitter(boxes, rng, scale=5.0):
+    return boxes + rng.normal(0, scale, boxes.shape)
+
+
+def main(opt):
+    rng = np.random.default_rng(0)
+    image = np.zeros((4680, 6620, 3), dtype=np.uint8)  # A1 @ 200 DPI
+    print(f"{'symbols':>8} {'loop (s)':>10} {'broadcast (s)':>14} {'speedup':>8} {'assign (s)':>11} {'identical':>10}")
+    for n in opt.counts:
+        boxes1 = random_boxes(n, image.shape, rng)
+        boxes2 = jitter(boxes1, rng)
+
+        start = time.perf_counter()
+        expected = cost_matrix_loop(boxes1, boxes2, image.shape, image.shape) if n <= opt.max_loop else None
+        t_loop = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cost = build_cost_matrix([normalize_bbox(image.shape, b) for b in boxes1],
+                                 [normalize_bbox(image.shape, b) for b in boxes2], image.shape, image.shape)
+        t_vec = time.perf_counter() - start
+
+        start = time.perf_counter()
+        linear_sum_assignment(cost)
+        t_assign = time.perf_counter() - start
+
+        if expected is not None:
+            identical = bool(np.allclose(expected, cost, rtol=0, atol=1e-12) and
+                             np.array_equal(linear_sum_assignment(expected)[1], linear_sum_assignment(cost)[1]))
+            print(f"{n:>8} {t_loop:>10.3f} {t_vec:>14.4f} {t_loop / t_vec:>7.0f}x {t_assign:>11.3f} {str(identical):>10}")
+        else:
+            print(f"{n:>8} {'skipped':>10} {t_vec:>14.4f} {'-':>8} {t_assign:>11.3f} {'-':>10}")
+
+    print(f"\n{'symbols':>8} {'dense (s)':>10} {'pairs':>6} {'sparse (s)':>11} {'pairs':>6} {'agree':>6}")
+    for n in opt.counts:
+        boxes1 = random_boxes(n, image.shape, rng)
+        boxes2 = jitter(boxes1, rng)
+
+        start = time.perf_counter()
+        sparse = match_sparse(boxes1, boxes2, image, image)
+        t_sparse = time.perf_counter() - start
+
+        if n <= opt.max_dense:
+            start = time.perf_counter()
+            dense = match_optimized(boxes1, boxes2, image, image)
+            t_dense = time.perf_counter() - start
+            print(f"{n:>8} {t_dense:>10.3f} {len(dense):>6} {t_sparse:>11.3f} {len(sparse):>6} {len(set(dense) & set(sparse)):>6}")
+        else:
+            print(f"{n:>8} {'skipped':>10} {'-':>6} {t_sparse:>11.3f} {len(sparse):>6} {'-':>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", type=int, nargs="+", default=[50, 100, 300, 1000, 2000])
+    parser.add_argument("--max-loop", type=int, default=1000, help="largest symbol count to also time with the Python loop")
+    parser.add_argument("--max-dense", type=int, default=2000, help="largest symbol count to also run the dense match_optimized")
+    main(parser.parse_args())
@@ -1,12 +1,15 @@
 import fitz  # PyMuPDF
 from PIL import Image
-import io
 import os 
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import json
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from scipy.spatial import cKDTree
 
 from _utils.models import get_student_model
 
@@ -26,16 +29,30 @@ def load_class_mapping(class_map_path):
     with open(class_map_path, 'r') as f:
         return json.load(f)
 
+def pixmap_to_array(pix):
+    # 直接从 pixmap 的 samples 缓冲区构造 HWC 数组, 不经过 PNG 编码/解码; copy 后不再依赖 pixmap 的生命周期
+    return np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n).copy()
+
+def iter_pdf_pages(pdf_path, dpi=300, pages=None, clip=None):
+    """
+    Rasterize a PDF one page at a time, yielding (page_num, RGB ndarray).
+    Only one page is held in memory at a time. `clip` is a rect in PDF points
+    (x0, y0, x1, y1), so only that region is rendered at the requested DPI.
+    """
+    mat = fitz.Matrix(dpi / 72, dpi / 72)
+    with fitz.open(pdf_path) as doc:
+        for page_num in (range(len(doc)) if pages is None else pages):
+            page = doc.load_page(page_num)
+            pix = page.get_pixmap(matrix=mat, clip=fitz.Rect(clip) if clip is not None else None, alpha=False)
+            yield page_num, pixmap_to_array(pix)
+            del pix
+
+def render_pdf_region(pdf_path, page_num, clip, dpi=300):
+    # 只按高 DPI 渲染页面上需要的区域, clip 为 PDF 坐标(point)
+    return next(iter_pdf_pages(pdf_path, dpi=dpi, pages=[page_num], clip=clip))[1]
+
 def convert_pdf_to_images(pdf_path, dpi=300):
-    doc = fitz.open(pdf_path)
-    images = []
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        mat = fitz.Matrix(dpi / 72, dpi / 72)  
-        pix = page.get_pixmap(matrix=mat)  
-        img = Image.open(io.BytesIO(pix.tobytes()))
-        images.append(img)
-    return images
+    return [Image.fromarray(image) for _, image in iter_pdf_pages(pdf_path, dpi=dpi)]
 
 def resize_to_same_height(image1, image2):
     h1, w1 = image1.shape[:2]
@@ -50,16 +67,37 @@ def resize_to_same_height(image1, image2):
         image1_resized = cv2.resize(image1, (new_w1, h2))
         return image1_resized, image2
 
-def sliding_window(image, step_size, window_size):
-    for y in range(0, image.shape[0], step_size):
-        for x in range(0, image.shape[1], step_size):
-            window = image[y:y + window_size[1], x:x + window_size[0]]
-            if window.shape[0] != window_size[1] or window.shape[1] != window_size[0]:
-                # 添加填充，使窗口大小与window_size一致
-                pad_bottom = max(0, window_size[1] - window.shape[0])
-                pad_right = max(0, window_size[0] - window.shape[1])
-                window = cv2.copyMakeBorder(window, 0, pad_bottom, 0, pad_right, cv2.BORDER_CONSTANT, value=(0, 0, 0))
-            yield (x, y, window)
+def build_ink_integral(image, ink_threshold=200):
+    # 墨迹(灰度低于阈值的像素)积分图, 每页只计算一次, 任意窗口的墨迹像素数 O(1) 得到
+    gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+    ink = (gray < ink_threshold).astype(np.uint8)
+    return cv2.integral(ink)
+
+def window_ink_counts(integral, step_size, window_size):
+    # 一次性计算所有滑窗的墨迹像素数, 返回 (ys, xs, counts), counts 形状为 (len(ys), len(xs))
+    h, w = integral.shape[0] - 1, integral.shape[1] - 1
+    ys = np.arange(0, h, step_size)
+    xs = np.arange(0, w, step_size)
+    y1 = np.minimum(ys + window_size[1], h)
+    x1 = np.minimum(xs + window_size[0], w)
+    counts = integral[np.ix_(y1, x1)] - integral[np.ix_(ys, x1)] - integral[np.ix_(y1, xs)] + integral[np.ix_(ys, xs)]
+    return ys, xs, counts
+
+def sliding_window(image, step_size, window_size, ink_integral=None, min_ink_pixels=0):
+    # 提供 ink_integral 时跳过墨迹像素数少于 min_ink_pixels 的空白窗口
+    if ink_integral is not None:
+        ys, xs, counts = window_ink_counts(ink_integral, step_size, window_size)
+        origins = [(int(xs[c]), int(ys[r])) for r, c in zip(*np.nonzero(counts >= min_ink_pixels))]
+    else:
+        origins = [(x, y) for y in range(0, image.shape[0], step_size) for x in range(0, image.shape[1], step_size)]
+    for (x, y) in origins:
+        window = image[y:y + window_size[1], x:x + window_size[0]]
+        if window.shape[0] != window_size[1] or window.shape[1] != window_size[0]:
+            # 添加填充，使窗口大小与window_size一致
+            pad_bottom = max(0, window_size[1] - window.shape[0])
+            pad_right = max(0, window_size[0] - window.shape[1])
+            window = cv2.copyMakeBorder(window, 0, pad_bottom, 0, pad_right, cv2.BORDER_CONSTANT, value=(0, 0, 0))
+        yield (x, y, window)
 
 def process_image(image, step_size, window_size):
     windows = []
@@ -67,6 +105,23 @@ def process_image(image, step_size, window_size):
         windows.append((x, y, window))
     return windows
 
+def schedule_windows(image, step_size, window_size, min_ink_ratio=1e-4, ink_threshold=200):
+    """
+    Content-aware window scheduling: drop windows with too little ink and keep the rest
+    in raster order so neighbouring windows share a batch.
+    Returns (windows, stats) where stats reports total / kept / skipped window counts.
+    """
+    integral = build_ink_integral(image, ink_threshold)
+    min_ink_pixels = max(1, int(min_ink_ratio * window_size[0] * window_size[1]))
+    total = len(range(0, image.shape[0], step_size)) * len(range(0, image.shape[1], step_size))
+    windows = list(sliding_window(image, step_size, window_size, integral, min_ink_pixels))
+    stats = {"total": total, "kept": len(windows), "skipped": total - len(windows)}
+    return windows, stats
+
+def batch_windows(windows, batch_size):
+    for i in range(0, len(windows), batch_size):
+        yield windows[i:i + batch_size]
+
 def detect_objects(model, input_tensor_batch):
     results = model(input_tensor_batch)
     return results
@@ -148,25 +203,44 @@ def calculate_relative_position_difference(box1, box2, image_shape1, image_shape
     position_difference = np.linalg.norm(np.array(relative_center1) - np.array(relative_center2))
     return position_difference
 
+def pair_costs(norm_boxes1, norm_boxes2, image_shape1, image_shape2, distance_weight=1.0, shape_weight=1.0, area_weight=1.0, position_weight=1.0):
+    """
+    Element-wise (broadcastable) version of the match_optimized pair cost, combining
+    calculate_distance / calculate_shape_similarity / area ratio /
+    calculate_relative_position_difference. Boxes are (..., 4) normalized xyxy.
+    """
+    centers1 = (norm_boxes1[..., :2] + norm_boxes1[..., 2:]) / 2
+    centers2 = (norm_boxes2[..., :2] + norm_boxes2[..., 2:]) / 2
+    wh1 = norm_boxes1[..., 2:] - norm_boxes1[..., :2]
+    wh2 = norm_boxes2[..., 2:] - norm_boxes2[..., :2]
+
+    distance = np.sqrt(((centers1 - centers2) ** 2).sum(-1))
+    shape_similarity = 1 - np.abs(wh1[..., 0] / wh1[..., 1] - wh2[..., 0] / wh2[..., 1])
+    area1 = wh1[..., 0] * wh1[..., 1]
+    area2 = wh2[..., 0] * wh2[..., 1]
+    area_ratio = np.minimum(area1, area2) / np.maximum(area1, area2)
+    # 与 calculate_relative_position_difference 一致: 中心点再除以图像宽高
+    relative_centers1 = centers1 / np.array([image_shape1[1], image_shape1[0]], dtype=np.float64)
+    relative_centers2 = centers2 / np.array([image_shape2[1], image_shape2[0]], dtype=np.float64)
+    position_difference = np.sqrt(((relative_centers1 - relative_centers2) ** 2).sum(-1))
+
+    return distance_weight * distance - shape_weight * shape_similarity - area_weight * area_ratio + position_weight * position_difference
+
+def build_cost_matrix(norm_boxes1, norm_boxes2, image_shape1, image_shape2, distance_weight=1.0, shape_weight=1.0, area_weight=1.0, position_weight=1.0):
+    """Broadcast the pair cost over every (i, j) to get the dense Hungarian cost matrix."""
+    norm_boxes1 = np.asarray(norm_boxes1, dtype=np.float64).reshape(-1, 4)
+    norm_boxes2 = np.asarray(norm_boxes2, dtype=np.float64).reshape(-1, 4)
+    return pair_costs(norm_boxes1[:, None, :], norm_boxes2[None, :, :], image_shape1, image_shape2,
+                      distance_weight, shape_weight, area_weight, position_weight)
+
 def match_optimized(boxes1, boxes2, image1, image2, distance_weight=1.0, shape_weight=1.0, area_weight=1.0, position_weight=1.0, position_threshold=0.25):
     matched_pairs = []
 
     norm_boxes1 = [normalize_bbox(image1.shape, box) for box in boxes1]
     norm_boxes2 = [normalize_bbox(image2.shape, box) for box in boxes2]
 
-    cost_matrix = np.zeros((len(norm_boxes1), len(norm_boxes2)))
-
-    for i, box1 in enumerate(norm_boxes1):
-        for j, box2 in enumerate(norm_boxes2):
-            distance = calculate_distance(box1, box2)
-            shape_similarity = calculate_shape_similarity(box1, box2)
-            area1 = calculate_area(box1)
-            area2 = calculate_area(box2)
-            area_ratio = min(area1, area2) / max(area1, area2)
-            position_difference = calculate_relative_position_difference(box1, box2, image1.shape, image2.shape)
-
-            cost = distance_weight * distance - shape_weight * shape_similarity - area_weight * area_ratio + position_weight * position_difference
-            cost_matrix[i, j] = cost
+    cost_matrix = build_cost_matrix(norm_boxes1, norm_boxes2, image1.shape, image2.shape,
+                                    distance_weight, shape_weight, area_weight, position_weight)
 
     row_ind, col_ind = linear_sum_assignment(cost_matrix)
 
@@ -178,6 +252,67 @@ def match_optimized(boxes1, boxes2, image1, image2, distance_weight=1.0, shape_w
     return matched_pairs
 
 
+def relative_centers(boxes, image_shape):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return ((boxes[:, :2] + boxes[:, 2:]) / 2) / np.array([image_shape[1], image_shape[0]], dtype=np.float64)
+
+def match_sparse(boxes1, boxes2, image1, image2, distance_weight=1.0, shape_weight=1.0, area_weight=1.0, position_weight=1.0,
+                 position_threshold=0.25, max_candidates=16, unmatched_cost=4.0):
+    """
+    Spatially gated, sparse alternative to match_optimized for large sheets.
+
+    This is not the same optimisation problem. match_optimized solves the dense
+    assignment over all boxes and only afterwards drops pairs with cost >= 1.0 or a
+    relative position difference >= `position_threshold`. Here a KD-tree over
+    relative box centers keeps, for every box in image1, at most `max_candidates`
+    boxes of image2 within `position_threshold`, and candidates with cost >= 1.0 are
+    dropped before solving. The costs are shifted by `costs - costs.min() + 1` to make
+    them positive. Every box gets a dummy partner at `unmatched_cost`, and
+    the transposed candidate edges (eps weight) let any partial matching complete to
+    a perfect one for scipy's min_weight_full_bipartite_matching.
+
+    The result is the dense assignment only when every pair of the dense optimum
+    lies inside the gate: within `position_threshold`, among the `max_candidates`
+    nearest, and with cost < 1.0. When the dense optimum uses a gated-out pair,
+    this function may match those boxes differently instead of leaving them
+    unmatched. Larger `unmatched_cost` values slow the solver down considerably.
+    """
+    n, m = len(boxes1), len(boxes2)
+    if n == 0 or m == 0:
+        return []
+
+    tree = cKDTree(relative_centers(boxes2, image2.shape))
+    k = min(max_candidates, m)
+    dists, cols = tree.query(relative_centers(boxes1, image1.shape), k=k, distance_upper_bound=position_threshold)
+    dists, cols = dists.reshape(n, k), cols.reshape(n, k)
+    valid = dists < position_threshold
+    rows = np.repeat(np.arange(n), k)[valid.ravel()]
+    cols = cols.ravel()[valid.ravel()]
+
+    norm_boxes1 = np.array([normalize_bbox(image1.shape, box) for box in boxes1], dtype=np.float64)
+    norm_boxes2 = np.array([normalize_bbox(image2.shape, box) for box in boxes2], dtype=np.float64)
+    costs = pair_costs(norm_boxes1[rows], norm_boxes2[cols], image1.shape, image2.shape,
+                       distance_weight, shape_weight, area_weight, position_weight)
+    keep = costs < 1.0
+    rows, cols, costs = rows[keep], cols[keep], costs[keep]
+    if len(rows) == 0:
+        return []
+
+    # 扩展为 (n+m)x(m+n) 的二分图: 左上为真实候选边, 右上/左下为"不匹配"虚拟边,
+    # 右下为候选边的转置, 使任意匹配方案都能补全为完美匹配
+    # 代价整体平移为正数, 稀疏矩阵中不存在的元素即为不可匹配
+    shifted = costs - costs.min() + 1.0
+    eps = 1e-9
+    data = np.concatenate([shifted, np.full(n, unmatched_cost), np.full(m, unmatched_cost), np.full(len(rows), eps)])
+    row_idx = np.concatenate([rows, np.arange(n), n + np.arange(m), n + cols])
+    col_idx = np.concatenate([cols, m + np.arange(n), np.arange(m), m + rows])
+    graph = coo_matrix((data, (row_idx, col_idx)), shape=(n + m, m + n)).tocsr()
+    row_ind, col_ind = min_weight_full_bipartite_matching(graph)
+
+    matched = (row_ind < n) & (col_ind < m)
+    return [(int(r), int(c)) for r, c in zip(row_ind[matched], col_ind[matched])]
+
+
 def crop_and_preprocess(image, bbox, target_size=(32, 32)):
     x1, y1, x2, y2 = map(int, bbox)
     cropped = image[y1:y2, x1:x2]
@@ -186,53 +321,52 @@ def crop_and_preprocess(image, bbox, target_size=(32, 32)):
     tensor = torch.from_numpy(gray).float().unsqueeze(0).unsqueeze(0) / 255.0
     return tensor
 
+def crop_and_preprocess_batch(image, bboxes, target_size=(32, 32)):
+    # 所有框裁剪缩放后写入同一块预分配内存, 整块只做一次灰度转换和张量化, 返回 (K, 1, h, w)
+    w, h = target_size
+    resized = np.empty((len(bboxes), h, w, 3), dtype=np.uint8)
+    for k, bbox in enumerate(bboxes):
+        x1, y1, x2, y2 = map(int, bbox)
+        resized[k] = cv2.resize(image[y1:y2, x1:x2], target_size)
+    gray = cv2.cvtColor(resized.reshape(-1, w, 3), cv2.COLOR_BGR2GRAY).reshape(len(bboxes), 1, h, w)
+    return torch.from_numpy(gray).float() / 255.0
+
 def calculate_cosine_distance(feat1, feat2):
     return 1 - torch.nn.functional.cosine_similarity(feat1, feat2).item()
 
 def match_images(image1, image2, boxes1, boxes2, matches, match_model, threshold=0.5):
     match_model.eval()
-    same_entity_count = 0
     total_matches = len(matches)
-    img_match_success = 0
-    img_match_fail = 0
-
-    # 提取所有匹配的裁剪图像并批量处理
-    tensors1 = []
-    tensors2 = []
-    bboxes1 = []
-    bboxes2 = []
-
-    for (i, j) in matches:
-        tensor1 = crop_and_preprocess(image1, boxes1[i])
-        tensor2 = crop_and_preprocess(image2, boxes2[j])
-        tensors1.append(tensor1)
-        tensors2.append(tensor2)
-        bboxes1.append(boxes1[i])
-        bboxes2.append(boxes2[j])
-
-    # 将所有图像批量化
-    batch1 = torch.cat(tensors1, dim=0)
-    batch2 = torch.cat(tensors2, dim=0)
-
-    matched_results = []
+    if total_matches == 0:
+        return 0, 0, [], 0, 0
+    device = next(match_model.parameters()).device
+
+    # 每页只对去重后的符号做一次裁剪和嵌入
+    idx1 = np.array([i for i, _ in matches])
+    idx2 = np.array([j for _, j in matches])
+    uniq1, inv1 = np.unique(idx1, return_inverse=True)
+    uniq2, inv2 = np.unique(idx2, return_inverse=True)
+    boxes1 = np.asarray(boxes1)
+    boxes2 = np.asarray(boxes2)
+    batch1 = crop_and_preprocess_batch(image1, boxes1[uniq1]).to(device)
+    batch2 = crop_and_preprocess_batch(image2, boxes2[uniq2]).to(device)
 
     with torch.no_grad():
         feats1, logits1 = match_model(batch1)
         feats2, logits2 = match_model(batch2)
-        clses1 = torch.argmax(logits1, dim=1).cpu().numpy()
-        clses2 = torch.argmax(logits2, dim=1).cpu().numpy()
-
-    for feat1, feat2, cls1, cls2, bbox1, bbox2 in zip(feats1, feats2, clses1, clses2, bboxes1, bboxes2):
-        cosine_distance = calculate_cosine_distance(feat1.unsqueeze(0), feat2.unsqueeze(0))
-        bbox1 = [float(x) for x in bbox1]
-        bbox2 = [float(x) for x in bbox2]
-        matched_results.append([float(cosine_distance), int(cls1), int(cls2), bbox1, bbox2])
-
-        if cosine_distance < threshold:
-            same_entity_count += 1
-            img_match_success += 1
-        else:
-            img_match_fail += 1
+        # 归一化后一次矩阵乘得到所有余弦相似度, 再取出匹配对
+        similarity = F.normalize(feats1, dim=1) @ F.normalize(feats2, dim=1).T
+        cosine_distances = (1 - similarity[torch.from_numpy(inv1), torch.from_numpy(inv2)]).cpu().numpy()
+        clses1 = torch.argmax(logits1, dim=1).cpu().numpy()[inv1]
+        clses2 = torch.argmax(logits2, dim=1).cpu().numpy()[inv2]
+
+    matched_results = [
+        [float(cosine_distance), int(cls1), int(cls2), [float(x) for x in boxes1[i]], [float(x) for x in boxes2[j]]]
+        for cosine_distance, cls1, cls2, i, j in zip(cosine_distances, clses1, clses2, idx1, idx2)
+    ]
+    same_entity_count = int((cosine_distances < threshold).sum())
+    img_match_success = same_entity_count
+    img_match_fail = total_matches - same_entity_count
 
     return same_entity_count, total_matches, matched_results, img_match_success, img_match_fail
 
@@ -357,6 +491,7 @@ def main():
     idx_to_class = {idx: cls_name for cls_name, idx in class_to_idx.items()}
     window_size = (640, 640)
     step_size = 480
+    batch_size = 16
 
     detection_model = load_det_model(det_model_path)
     match_model = get_student_model(num_classes=len(idx_to_class), 
@@ -372,7 +507,7 @@ def main():
     for pdf_name in pdf_paths:
         pdf_path = f'./data/{pdf_name}.pdf'
         # assert one page pre pdf file
-        hd_images.append(np.array(convert_pdf_to_images(pdf_path, dpi=200)[0]))
+        hd_images.append(next(iter_pdf_pages(pdf_path, dpi=200, pages=[0]))[1])
     
     # aligned in the shape
     hd_images[0], hd_images[1] = resize_to_same_height(hd_images[0], hd_images[1])
@@ -380,14 +515,20 @@ def main():
     
     for image in hd_images:
        
-        windows = process_image(image, step_size, window_size)
-        
-        # compose the windowsed images to a batch tensor
-        window_tensors = [torch.from_numpy(window).permute(2, 0, 1).float().unsqueeze(0) / 255.0 for _, _, window in windows]
-        input_tensor_batch = torch.cat(window_tensors, dim=0)
+        # skip blank windows (most of a CAD sheet is white paper) before running the detector
+        windows, window_stats = schedule_windows(image, step_size, window_size)
+        print(f'windows: {window_stats}')
         
-        results = detect_objects(detection_model, input_tensor_batch)[0]        
-        all_boxes, all_scores = postprocess_results(results)
+        all_boxes, all_scores = [], []
+        for batch in batch_windows(windows, batch_size):
+            # compose the windowsed images to a batch tensor
+            window_tensors = [torch.from_numpy(window).permute(2, 0, 1).float().unsqueeze(0) / 255.0 for _, _, window in batch]
+            input_tensor_batch = torch.cat(window_tensors, dim=0)
+            
+            results = detect_objects(detection_model, input_tensor_batch)[0]        
+            batch_boxes, batch_scores = postprocess_results(results)
+            all_boxes.extend(batch_boxes)
+            all_scores.extend(batch_scores)
         
         # integraet local result of windows image to a global result  
         global_boxes, global_scores = integrate_detections(windows, all_boxes, all_scores)
@@ -402,7 +543,7 @@ def main():
         result_image = Image.fromarray(image)
         result_image.save(f'./outputs/{pdf_name}_detected.png')
     
-    matches = match_optimized(bbox_results[0], bbox_results[1], hd_images[0], hd_images[1])
+    matches = match_sparse(bbox_results[0], bbox_results[1], hd_images[0], hd_images[1])
     thre_euc, thre_cos = np.load(threshold_path)['arr_0']
     same_entity_count, total_matches, matched_results, img_match_success, img_match_fail = \
             match_images(hd_images[0], hd_images[1], bbox_results[0], bbox_results[1], \
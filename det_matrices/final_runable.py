@@ -128,25 +128,39 @@ def calculate_relative_position_difference(box1, box2, image_shape1, image_shape
     position_difference = np.linalg.norm(np.array(relative_center1) - np.array(relative_center2))
     return position_difference
 
+def build_cost_matrix(norm_boxes1, norm_boxes2, image_shape1, image_shape2, distance_weight=1.0, shape_weight=1.0, area_weight=1.0, position_weight=1.0):
+    """
+    Broadcast version of the pairwise cost used by match_optimized, computing every
+    (i, j) term of calculate_distance / calculate_shape_similarity / area ratio /
+    calculate_relative_position_difference at once. Boxes are (n, 4) normalized xyxy.
+    """
+    norm_boxes1 = np.asarray(norm_boxes1, dtype=np.float64).reshape(-1, 4)
+    norm_boxes2 = np.asarray(norm_boxes2, dtype=np.float64).reshape(-1, 4)
+    centers1 = (norm_boxes1[:, :2] + norm_boxes1[:, 2:]) / 2
+    centers2 = (norm_boxes2[:, :2] + norm_boxes2[:, 2:]) / 2
+    wh1 = norm_boxes1[:, 2:] - norm_boxes1[:, :2]
+    wh2 = norm_boxes2[:, 2:] - norm_boxes2[:, :2]
+
+    distance = np.sqrt(((centers1[:, None, :] - centers2[None, :, :]) ** 2).sum(-1))
+    shape_similarity = 1 - np.abs((wh1[:, 0] / wh1[:, 1])[:, None] - (wh2[:, 0] / wh2[:, 1])[None, :])
+    area1 = wh1[:, 0] * wh1[:, 1]
+    area2 = wh2[:, 0] * wh2[:, 1]
+    area_ratio = np.minimum(area1[:, None], area2[None, :]) / np.maximum(area1[:, None], area2[None, :])
+    # 与 calculate_relative_position_difference 一致: 中心点再除以图像宽高
+    relative_centers1 = centers1 / np.array([image_shape1[1], image_shape1[0]], dtype=np.float64)
+    relative_centers2 = centers2 / np.array([image_shape2[1], image_shape2[0]], dtype=np.float64)
+    position_difference = np.sqrt(((relative_centers1[:, None, :] - relative_centers2[None, :, :]) ** 2).sum(-1))
+
+    return distance_weight * distance - shape_weight * shape_similarity - area_weight * area_ratio + position_weight * position_difference
+
 def match_optimized(boxes1, boxes2, image1, image2, distance_weight=1.0, shape_weight=1.0, area_weight=1.0, position_weight=1.0, position_threshold=0.25):
     matched_pairs = []
 
     norm_boxes1 = [normalize_bbox(image1.shape, box) for box in boxes1]
     norm_boxes2 = [normalize_bbox(image2.shape, box) for box in boxes2]
 
-    cost_matrix = np.zeros((len(norm_boxes1), len(norm_boxes2)))
-
-    for i, box1 in enumerate(norm_boxes1):
-        for j, box2 in enumerate(norm_boxes2):
-            distance = calculate_distance(box1, box2)
-            shape_similarity = calculate_shape_similarity(box1, box2)
-            area1 = calculate_area(box1)
-            area2 = calculate_area(box2)
-            area_ratio = min(area1, area2) / max(area1, area2)
-            position_difference = calculate_relative_position_difference(box1, box2, image1.shape, image2.shape)
-
-            cost = distance_weight * distance - shape_weight * shape_similarity - area_weight * area_ratio + position_weight * position_difference
-            cost_matrix[i, j] = cost
+    cost_matrix = build_cost_matrix(norm_boxes1, norm_boxes2, image1.shape, image2.shape,
+                                    distance_weight, shape_weight, area_weight, position_weight)
 
     row_ind, col_ind = linear_sum_assignment(cost_matrix)
 
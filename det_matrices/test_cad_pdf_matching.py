@@ -0,0 +1,41 @@
+import unittest
+
+import numpy as np
+
+from cad_pdf_matching import build_cost_matrix, match_optimized, match_sparse, normalize_bbox
+
+
+def make_boxes(rng, count, size=(1000, 1400)):
+    # 尺寸相近的框, 两两代价都小于 1.0
+    x1 = rng.uniform(0, size[1] - 60, count)
+    y1 = rng.uniform(0, size[0] - 60, count)
+    w = rng.uniform(30, 40, count)
+    h = rng.uniform(30, 40, count)
+    return np.stack([x1, y1, x1 + w, y1 + h], axis=1)
+
+
+class MatchSparseTest(unittest.TestCase):
+    def test_matches_dense_solver_when_ungated(self):
+        rng = np.random.default_rng(0)
+        image = np.zeros((1000, 1400, 3), np.uint8)
+        for n, m in [(12, 12), (9, 14), (15, 8)]:
+            boxes1 = make_boxes(rng, n)
+            boxes2 = make_boxes(rng, m)
+            # 门限放宽到整张图, 候选数覆盖全部框, 保证稠密解的每一对都在门限内
+            norm1 = [normalize_bbox(image.shape, box) for box in boxes1]
+            norm2 = [normalize_bbox(image.shape, box) for box in boxes2]
+            self.assertTrue((build_cost_matrix(norm1, norm2, image.shape, image.shape) < 1.0).all())
+            dense = match_optimized(boxes1, boxes2, image, image, position_threshold=2.0)
+            sparse = match_sparse(boxes1, boxes2, image, image, position_threshold=2.0, max_candidates=m)
+            self.assertEqual(sorted((int(r), int(c)) for r, c in dense), sorted(sparse))
+            self.assertEqual(len(sparse), min(n, m))
+
+    def test_pairs_outside_gate_are_not_matched(self):
+        image = np.zeros((1000, 1000, 3), np.uint8)
+        boxes1 = np.array([[100, 100, 140, 140], [800, 800, 840, 840]], dtype=np.float64)
+        boxes2 = np.array([[105, 100, 145, 140], [100, 800, 140, 840]], dtype=np.float64)
+        self.assertEqual(match_sparse(boxes1, boxes2, image, image, position_threshold=0.25), [(0, 0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,9 +7,11 @@ from lookahead.optimizer import Lookahead
 from tqdm import tqdm
 import argparse
 from utils.datasets import get_data_loaders
+from utils.batch_augment import BatchAugment
 from utils.loss_functions import get_loss, BYOL
-from utils.models import get_teacher_model, get_student_model
+from utils.models import get_teacher_model, get_student_model, forward_views
 from utils.matrices import find_optimal_threshold, evaluate_model
+from utils.profiling import StepTimer
 from torch.utils.tensorboard import SummaryWriter
 
 
@@ -18,21 +20,28 @@ def check_requires_grad(model):
         if not param.requires_grad:
             print(f"Parameter {name} does not require grad.")
 
-def train_teacher(device, init, margin, learning_rate, num_class, num_epochs, train_loader, val_loader, weight_path, threshold_path):
+def should_check(step, every):
+    # 调试检查按步数采样, every=0 时关闭
+    return every > 0 and step % every == 0
+
+def train_teacher(device, init, margin, learning_rate, num_class, num_epochs, train_loader, val_loader, weight_path, threshold_path, augment=None,
+                  weight_decay=1e-2, loss_l2=0.0, check_grad_every=0, profile_every=50):
     writter = SummaryWriter(log_dir="/root/tf-logs/teacher")
     
     model = get_teacher_model(num_classes=num_class, dropout_p=0.3, init=init, update=False, weight_path=weight_path, cuda=True).to(device)
     byol = BYOL(base_encoder=model).to(device)
     # byol = None
     
-    criterion = get_loss(model=model, margin=margin, num_classes=num_class, num_epochs=num_epochs)
+    criterion = get_loss(model=model, margin=margin, num_classes=num_class, num_epochs=num_epochs, weight_decay=loss_l2)
     
-    base_optimizer = AdaBelief(model.parameters(), lr=learning_rate, weight_decay=1e-2, eps=1e-16, betas=(0.89, 0.999), weight_decouple=True, rectify=True)
+    # decoupled weight decay 在优化器的更新中完成, 不再在 loss 中额外对所有参数求 L2 norm
+    base_optimizer = AdaBelief(model.parameters(), lr=learning_rate, weight_decay=weight_decay, eps=1e-16, betas=(0.89, 0.999), weight_decouple=True, rectify=True)
     optimizer = Lookahead(base_optimizer, k=5, alpha=0.5)
     # scheduler = optim.lr_scheduler.CosineAnnealingWarmRestarts(optimizer, T_0=10, T_mult=2, eta_min=1e-7)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=10, min_lr=1e-8)
     
     scaler = GradScaler()
+    timer = StepTimer(device, every=profile_every)
     best_val_loss = float('inf')
     best_score_cos = 0
 
@@ -41,40 +50,56 @@ def train_teacher(device, init, margin, learning_rate, num_class, num_epochs, tr
         model.train()
         
         train_tqdm = tqdm(train_loader, desc=f"Train Epoch {epoch+1}/{num_epochs}")
+        timer.start()
         for (anchor_img, contrastive_img, positive_img, negative_img, 
              anchor_label, positive_label, negative_label) in train_tqdm:
             
             anchor_img, contrastive_img, positive_img, negative_img = anchor_img.to(device), contrastive_img.to(device), positive_img.to(device), negative_img.to(device)
             anchor_label, positive_label, negative_label = anchor_label.to(device), positive_label.to(device), negative_label.to(device)
+            if augment is not None:
+                anchor_img, contrastive_img, positive_img, negative_img = augment(
+                    torch.cat([anchor_img, contrastive_img, positive_img, negative_img])).chunk(4)
+            timer.mark("data")
             
             optimizer.zero_grad()
 
             with autocast():
-                anchor_features, anchor_logits = model(anchor_img)
-                positive_features, positive_logits = model(positive_img)
-                negative_features, negative_logits = model(negative_img)
+                # 四个视图一次前向, BYOL 复用 anchor / contrastive 的 online 特征
+                (anchor_features, anchor_logits), (positive_features, positive_logits), \
+                    (negative_features, negative_logits), (contrastive_features, _) = \
+                    forward_views(model, anchor_img, positive_img, negative_img, contrastive_img)
+                timer.mark("forward")
                 
-                byol_loss = byol(anchor_img, contrastive_img)
+                byol_loss = byol.loss_from_features(anchor_features, contrastive_features, anchor_img, contrastive_img)
                 loss = criterion(anchor_features, positive_features, negative_features, 
                                  anchor_logits, positive_logits, negative_logits, 
                                  anchor_label, positive_label, negative_label, byol_loss )
 
+            timer.mark("loss")
+
             scaler.scale(loss).backward()
+            timer.mark("backward")
             scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            check_requires_grad(model)
+            if should_check(timer.step, check_grad_every):
+                check_requires_grad(model)
             scaler.step(optimizer)
             scaler.update()
+            timer.mark("optimizer")
 
-            epoch_loss += loss.item()
-            train_tqdm.set_postfix(loss=loss.item())
+            # loss 留在设备上累加, 每 10 步才同步到 CPU 更新进度条
+            epoch_loss += loss.detach()
+            if timer.step % 10 == 0:
+                train_tqdm.set_postfix(loss=loss.item())
+            timer.end(writter)
+            timer.start()
 
         if epoch % 10 == 0:
             threshold_euc, threshold_cos = find_optimal_threshold(device, model, train_loader)
             print(f'\nThreshold found on train set: euclid = {threshold_euc}, cosine = {threshold_cos}')
             np.savez(threshold_path+'_teacher.npz', [threshold_euc, threshold_cos])
             
-        avg_epoch_loss = epoch_loss / len(train_loader)
+        avg_epoch_loss = float(epoch_loss) / len(train_loader)
         torch.save(model.state_dict(), weight_path+"_teacher_last.pth")
         
         (
@@ -117,7 +142,8 @@ def train_teacher(device, init, margin, learning_rate, num_class, num_epochs, tr
     writter.close()
 
 
-def train_student(device, init, margin, learning_rate, num_class, num_epochs, train_loader, val_loader, weight_path, threshold_path):
+def train_student(device, init, margin, learning_rate, num_class, num_epochs, train_loader, val_loader, weight_path, threshold_path, augment=None,
+                  weight_decay=1e-2, loss_l2=0.0, check_grad_every=0, profile_every=50):
     writter = SummaryWriter(log_dir="/root/tf-logs/student")
     
     threshold_euc, threshold_cos = np.load(threshold_path+'_teacher.npz')['arr_0']
@@ -126,13 +152,15 @@ def train_student(device, init, margin, learning_rate, num_class, num_epochs, tr
     model = get_student_model(num_classes=num_class, dropout_p=0.3, init=init, update=False, weight_path=weight_path, cuda=True).to(device)
     teacher = get_teacher_model(num_classes=num_class, dropout_p=0.3, init=False, update=False, weight_path=weight_path, cuda=True).to(device)
     
-    criterion = get_loss(model=model, margin=margin, num_classes=num_class, num_epochs=None)
+    criterion = get_loss(model=model, margin=margin, num_classes=num_class, num_epochs=None, weight_decay=loss_l2)
     
-    base_optimizer = AdaBelief(model.parameters(), lr=learning_rate, weight_decay=1e-2, eps=1e-16, betas=(0.89, 0.999), weight_decouple=True, rectify=True)
+    # decoupled weight decay 在优化器的更新中完成, 不再在 loss 中额外对所有参数求 L2 norm
+    base_optimizer = AdaBelief(model.parameters(), lr=learning_rate, weight_decay=weight_decay, eps=1e-16, betas=(0.89, 0.999), weight_decouple=True, rectify=True)
     optimizer = Lookahead(base_optimizer, k=5, alpha=0.5)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', factor=0.1, patience=10, min_lr=1e-8)
     
     scaler = GradScaler()
+    timer = StepTimer(device, every=profile_every)
     best_val_loss = float('inf')
     best_score_cos = 0
 
@@ -141,40 +169,54 @@ def train_student(device, init, margin, learning_rate, num_class, num_epochs, tr
         model.train()
         
         train_tqdm = tqdm(train_loader, desc=f"Train Epoch {epoch+1}/{num_epochs}")
+        timer.start()
         for (anchor_img, contrastive_img, positive_img, negative_img, 
              anchor_label, positive_label, negative_label) in train_tqdm:
             
             anchor_img, contrastive_img, positive_img, negative_img = anchor_img.to(device), contrastive_img.to(device), positive_img.to(device), negative_img.to(device)
             anchor_labels, positive_labels, negative_labels = anchor_label.to(device), positive_label.to(device), negative_label.to(device)
+            if augment is not None:
+                anchor_img, contrastive_img, positive_img, negative_img = augment(
+                    torch.cat([anchor_img, contrastive_img, positive_img, negative_img])).chunk(4)
+            timer.mark("data")
             
             optimizer.zero_grad()
 
             with autocast():
-                anchor_features, anchor_logits = model(anchor_img)
-                positive_features, positive_logits = model(positive_img)
-                negative_features, negative_logits = model(negative_img)
+                (anchor_features, anchor_logits), (positive_features, positive_logits), (negative_features, negative_logits) = \
+                    forward_views(model, anchor_img, positive_img, negative_img)
                 teacher_features, teacher_logits = teacher(anchor_img)
+                timer.mark("forward")
                 
                 loss = criterion(anchor_features, positive_features, negative_features, 
                                  anchor_logits, positive_logits, negative_logits, 
                                  anchor_labels, positive_labels, negative_labels, 
                                  None, teacher_logits, teacher_features )
 
+            timer.mark("loss")
+
             scaler.scale(loss).backward()
+            timer.mark("backward")
             scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            check_requires_grad(model)
+            if should_check(timer.step, check_grad_every):
+                check_requires_grad(model)
             scaler.step(optimizer)
             scaler.update()
+            timer.mark("optimizer")
 
-            epoch_loss += loss.item()
-            train_tqdm.set_postfix(loss=loss.item())
+            # loss 留在设备上累加, 每 10 步才同步到 CPU 更新进度条
+            epoch_loss += loss.detach()
+            if timer.step % 10 == 0:
+                train_tqdm.set_postfix(loss=loss.item())
+            timer.end(writter)
+            timer.start()
         if epoch % 10 == 0:
             threshold_euc, threshold_cos = find_optimal_threshold(device, model, train_loader)
             print(f'\nThreshold found on train set: euclid = {threshold_euc}, cosine = {threshold_cos}')
             np.savez(threshold_path+'_student.npz', [threshold_euc, threshold_cos])
             
-        avg_epoch_loss = epoch_loss / len(train_loader)
+        avg_epoch_loss = float(epoch_loss) / len(train_loader)
         torch.save(model.state_dict(), weight_path+"_student_last.pth")
         
         (
@@ -227,6 +269,14 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', type=int, default=256)
     parser.add_argument('--lr', type=float, default=0.01, help='init learning rate, 0.01 for SGD')
     parser.add_argument('--margin', type=float, default=1.0)
+    parser.add_argument('--pk_sampling', action='store_true', help='P classes x K samples per train batch for the hard triplet miner')
+    parser.add_argument('--samples_per_class', type=int, default=4, help='K of --pk_sampling')
+    parser.add_argument('--crop_store', type=str, default=None, help='directory of the packed crop store, built on first use')
+    parser.add_argument('--batch_augment', action='store_true', help='augment whole batches on the training device instead of per sample in the workers')
+    parser.add_argument('--weight_decay', type=float, default=1e-2, help='decoupled weight decay of the optimizer')
+    parser.add_argument('--loss_l2', type=float, default=0.0, help='explicit L2 norm term in the loss (1e-3 in earlier runs), 0 to disable')
+    parser.add_argument('--check_grad_every', type=int, default=0, help='run check_requires_grad every N steps, 0 to disable')
+    parser.add_argument('--profile_every', type=int, default=50, help='log a per-phase step-time breakdown every N steps, 0 to disable')
     args = parser.parse_args()
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -239,9 +289,15 @@ if __name__ == '__main__':
     learning_rate = args.lr
     margin = args.margin
 
-    train_loader, num_class = get_data_loaders(root_dir=data, mode='train', batch_size=batch_size)
-    val_loader, _ = get_data_loaders(root_dir=data, mode='val', batch_size=batch_size)
+    train_loader, num_class = get_data_loaders(root_dir=data, mode='train', batch_size=batch_size,
+                                               pk_sampling=args.pk_sampling, samples_per_class=args.samples_per_class,
+                                               crop_store=args.crop_store, batch_augment=args.batch_augment)
+    val_loader, _ = get_data_loaders(root_dir=data, mode='val', batch_size=batch_size, crop_store=args.crop_store)
+    
+    augment = BatchAugment().to(device) if args.batch_augment else None
     
-    # train_teacher(device, init, margin, learning_rate, num_class, num_epochs, train_loader, val_loader, weight_path, threshold_path)
+    # train_teacher(device, init, margin, learning_rate, num_class, num_epochs, train_loader, val_loader, weight_path, threshold_path, augment,
+    #               args.weight_decay, args.loss_l2, args.check_grad_every, args.profile_every)
     
-    train_student(device, init, margin, learning_rate, num_class, num_epochs, train_loader, val_loader, weight_path, threshold_path)
\ No newline at end of file
+    train_student(device, init, margin, learning_rate, num_class, num_epochs, train_loader, val_loader, weight_path, threshold_path, augment,
+                  args.weight_decay, args.loss_l2, args.check_grad_every, args.profile_every)
\ No newline at end of file
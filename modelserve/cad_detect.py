@@ -1,14 +1,26 @@
+import ray
 from ray import serve
+from ray.serve import metrics
 from ray.serve.handle import DeploymentHandle
-from pipeline import YOLOv5ONNXPipeline
-import base64   
-import cv2
+from pipeline import YOLOv5ONNXPipeline, OCRPipeline
+import asyncio
 import numpy as np 
-import torch
 import json
-from utils.convert import CustomJSONEncoder
+import time
+from utils.convert import CustomJSONEncoder, decode_image
+from utils.cache import ResultCache, image_digest, params_digest, file_version
+import os
+from starlette.responses import Response
 
 onnx_model_path = 'models/yolov5x_cad_gpu_1.0.onnx'  # ONNX模型文件的路径
+max_batch_size = 8  # 动态批处理的最大批次, 可通过 config.yaml 的 user_config 覆盖
+batch_wait_timeout_s = 0.01  # 凑批的最长等待时间(秒)
+ocr_max_batch_size = 8  # OCR 动态批处理的最大批次, 一批图片的文本框合并后一起识别
+ocr_batch_wait_timeout_s = 0.05  # 单张 OCR 耗时在秒级, 多等几十毫秒换取更满的识别批次
+# 结果缓存: 同一张图纸(解码后像素相同)在模型和阈值不变时直接返回缓存结果
+cache_dir = os.environ.get("RESULT_CACHE_DIR", "cache")
+cache_memory_items = 256  # 每个副本内存 LRU 的条目数
+cache_disk_bytes = 1 << 30  # 每个缓存文件的大小上限, 可通过 user_config 的 cache_disk_mb 覆盖
 
 import logging
 
@@ -16,66 +28,258 @@ import logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-@serve.deployment
-def imageconverts(image: str):
-    # 将base64格式的数据解码为二进制格式
-    binary_data = base64.b64decode(image)
-    # 将二进制数据转换为OpenCV格式的图片对象
-    img = cv2.imdecode(np.frombuffer(binary_data, np.uint8), cv2.IMREAD_COLOR)
-    # 调整图片大小
-    img_size = (640, 640)  # 设置输出图片大小
-    img_resized = cv2.resize(img, img_size)
-    # 将图片转换为PyTorch张量
-    img_tensor = torch.from_numpy(img_resized).permute(2, 0, 1).float().unsqueeze(0)
-    return img_tensor
-
 @serve.deployment
 class ObjectDetect:
-    def __init__(self,converter:DeploymentHandle):
-        self.converter = converter
+    def __init__(self):
         self.model = YOLOv5ONNXPipeline(onnx_model_path)
+        self.model_version = file_version(onnx_model_path)
+        self.cache = ResultCache(os.path.join(cache_dir, "detect.sqlite"), cache_memory_items, cache_disk_bytes)
         self.logger = logging.getLogger(__name__)
-        
-    async def detect(self,base64_str:str):
-        image = await self.converter.remote(base64_str)
-        self.logger.info(f"image type：{type(image)}")
-        results = self.model(image)
+        self.cache_counter = metrics.Counter(
+            "objectdetect_cache_lookups",
+            description="Detection result cache lookups by tier (memory, disk, miss).",
+            tag_keys=("tier",),
+        )
+        self.batch_size_histogram = metrics.Histogram(
+            "objectdetect_batch_size",
+            description="Number of images in each dynamically batched ONNX run.",
+            boundaries=[1, 2, 4, 8, 16, 32],
+        )
+        self.queue_delay_histogram = metrics.Histogram(
+            "objectdetect_queue_delay_ms",
+            description="Time an image waits in the batch queue before inference starts.",
+            boundaries=[1, 2, 5, 10, 20, 50, 100, 200, 500],
+        )
+
+    def reconfigure(self, config: dict):
+        # user_config: {"max_batch_size": 8, "batch_wait_timeout_s": 0.01, "tile_size": null, "tile_overlap": 0.25}
+        self.detect_batched.set_max_batch_size(config.get("max_batch_size", max_batch_size))
+        self.detect_batched.set_batch_wait_timeout_s(config.get("batch_wait_timeout_s", batch_wait_timeout_s))
+        # 设置 tile_size 后大图按切片推理, 小目标不会因整图缩放到 640 而丢失
+        self.model.tile_size = config.get("tile_size", self.model.tile_size)
+        self.model.tile_overlap = config.get("tile_overlap", self.model.tile_overlap)
+        self.model.blank_std = config.get("blank_std", self.model.blank_std)
+        self.cache.disk_bytes = config.get("cache_disk_mb", cache_disk_bytes >> 20) << 20
+
+    def cache_key(self, digest: str):
+        # 像素哈希 + 模型版本 + 影响结果的阈值和切片参数
+        m = self.model
+        return f"{digest}:{params_digest(self.model_version, m.img_size, m.threshold, m.iou_thres, m.agnostic, m.tile_size, m.tile_overlap, m.blank_std)}"
+
+    @serve.batch(max_batch_size=max_batch_size, batch_wait_timeout_s=batch_wait_timeout_s)
+    async def detect_batched(self, requests: list):
+        # 并发到达的请求被收集成一个批次: requests 为 [(image, enqueue_time), ...]
+        start = time.perf_counter()
+        images = [image for image, _ in requests]
+        self.batch_size_histogram.observe(len(images))
+        for _, enqueue_time in requests:
+            self.queue_delay_histogram.observe((start - enqueue_time) * 1000)
+        # 推理放到线程池中执行, 事件循环可以继续为下一批收集请求
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, self.model.predict_batch, images)
+        self.logger.info(f"batch size：{len(images)} inference：{(time.perf_counter() - start) * 1000:.1f}ms")
         return results
+
+    async def detect(self,image:np.ndarray, digest:str = None):
+        # image 由 ingress 解码后放入对象存储, 这里拿到的是共享内存上的只读 ndarray, 没有额外复制
+        # digest 为 ingress 计算好的像素哈希, 缺省时在这里计算
+        key = self.cache_key(digest or image_digest(image))
+        result, tier = self.cache.get(key)
+        self.cache_counter.inc(tags={"tier": tier})
+        if result is None:
+            result = await self.detect_batched((image, time.perf_counter()))
+            self.cache.put(key, result)
+        return result
     
-    async def __call__(self, base64_str: str):
-        return await self.detect(base64_str)
+    async def detect_batch(self,image_refs:list, digests:list = None):
+        # 同一请求的多张图片与其他并发请求一起进入动态批处理队列, 命中缓存的图片不再推理
+        images = await asyncio.gather(*image_refs)
+        digests = digests or [None] * len(images)
+        return await asyncio.gather(*[self.detect(image, digest) for image, digest in zip(images, digests)])
     
-@serve.deployment
-def CvConverter(base64_str:str):
-    # return BGR image which required be convert to RGB in post 
-    binary_data = base64.b64decode(base64_str)
-    return cv2.imdecode(np.frombuffer(binary_data, np.uint8), cv2.IMREAD_COLOR)
+    async def render(self, image: np.ndarray, result: dict):
+        # 按已有的检测结果画框, 不占用推理批次
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.model.render, image, result)
+
+    async def __call__(self, image: np.ndarray):
+        return await self.detect(image)
+    
+
+# 副本自动扩缩容只在 config.yaml 中配置
+@serve.deployment(ray_actor_options={"num_cpus": 2})
+class OCRTransform:
+    def __init__(self, use_gpu: bool = False):
+        # 模型在副本启动时加载一次, 之后所有请求复用
+        self.model = OCRPipeline(use_angle_cls=True, lang="ch", use_gpu=use_gpu)
+        self.cache = ResultCache(os.path.join(cache_dir, "ocr.sqlite"), cache_memory_items, cache_disk_bytes)
+        self.logger = logging.getLogger(__name__)
+        self.cache_counter = metrics.Counter(
+            "ocrtransform_cache_lookups",
+            description="OCR result cache lookups by tier (memory, disk, miss).",
+            tag_keys=("tier",),
+        )
+
+    def reconfigure(self, config: dict):
+        # user_config: {"max_batch_size": 8, "batch_wait_timeout_s": 0.05, "tile_size": 960, "tile_overlap": 0.2, "blank_std": 3.0}
+        self.ocr_batched.set_max_batch_size(config.get("max_batch_size", ocr_max_batch_size))
+        self.ocr_batched.set_batch_wait_timeout_s(config.get("batch_wait_timeout_s", ocr_batch_wait_timeout_s))
+        self.model.tile_size = config.get("tile_size", self.model.tile_size)
+        self.model.tile_overlap = config.get("tile_overlap", self.model.tile_overlap)
+        self.model.blank_std = config.get("blank_std", self.model.blank_std)
+        self.cache.disk_bytes = config.get("cache_disk_mb", cache_disk_bytes >> 20) << 20
+
+    def cache_key(self, digest: str, symbols: dict = None):
+        # 像素哈希 + OCR 参数; 遮挡符号时结果还取决于检测框
+        m = self.model
+        masked = (symbols or {}).get("boxes"), (symbols or {}).get("classtexts")
+        return f"{digest}:{params_digest('paddleocr', m.use_angle_cls, m.drop_score, m.tile_size, m.tile_overlap, m.blank_std, m.seam_thres, masked)}"
+
+    @serve.batch(max_batch_size=ocr_max_batch_size, batch_wait_timeout_s=ocr_batch_wait_timeout_s)
+    async def ocr_batched(self, requests: list):
+        # requests: [(image, symbols), ...], symbols 为该图的检测结果, 用于遮挡无文字符号, 可为 None
+        # 文字检测逐图执行, 所有图片的文本框合并后方向分类和识别各一次, 识别模型按 rec_batch_num 分批
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(None, self.model.ocr_batch, requests)
+        self.logger.info(f"ocr batch size：{len(requests)} time：{(time.perf_counter() - start) * 1000:.1f}ms")
+        return results
+
+    async def ocr(self, image: np.ndarray, symbols: dict = None, digest: str = None):
+        key = self.cache_key(digest or image_digest(image), symbols)
+        result, tier = self.cache.get(key)
+        self.cache_counter.inc(tags={"tier": tier})
+        if result is None:
+            result = await self.ocr_batched((image, symbols))
+            self.cache.put(key, result)
+        return result
+
+    async def ocr_batch(self, image_refs: list, symbols_list: list = None, digests: list = None):
+        images = await asyncio.gather(*image_refs)
+        symbols_list = symbols_list or [None] * len(images)
+        digests = digests or [None] * len(images)
+        return await asyncio.gather(*[self.ocr(image, symbols, digest) for image, symbols, digest in zip(images, symbols_list, digests)])
+
+    async def render(self, image: np.ndarray, ocr_result: dict):
+        # 按已有的 OCR 结果绘制文字, 不占用推理批次
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.model.render, image, ocr_result)
+
+    async def __call__(self, image: np.ndarray, symbols: dict = None):
+        return await self.ocr(image, symbols)
+
+
+class RequestError(Exception):
+    # 请求格式错误, 以 400 返回具体原因, 与服务内部异常区分
+    pass
 
 
 @serve.deployment(ray_actor_options={"num_cpus": 4, "num_gpus": 1},health_check_timeout_s=60,health_check_period_s=60)
 class CADDetect:
     def __init__(
-        self, detect_responder: DeploymentHandle
+        self, detect_responder: DeploymentHandle, ocr_responder: DeploymentHandle
     ):
         self.detect_responder = detect_responder
+        self.ocr_responder = ocr_responder
         self.logger = logging.getLogger(__name__)
     
+    async def read_images(self,http_request):
+        # 支持三种请求体:
+        # application/octet-stream: 原始图片二进制
+        # multipart/form-data: image 或 images 字段上传的文件
+        # application/json: {"image": base64} 或 {"images": [base64, ...]}
+        content_type = http_request.headers.get("content-type", "")
+        if content_type.startswith("application/octet-stream"):
+            return [decode_image(await http_request.body())]
+        if content_type.startswith("multipart/form-data"):
+            form = await http_request.form()
+            files = form.getlist("images") or form.getlist("image")
+            return [decode_image(await file.read()) for file in files]
+        request = await http_request.json()
+        return [decode_image(image) for image in request.get("images", [request.get("image")])]
+
+    async def read_results(self, http_request):
+        # /render 请求中已有的检测和 OCR 结果: JSON 字段或 multipart 表单中的 JSON 字符串
+        # 与 read_images 一样按 content-type 区分; octet-stream 只能携带图片, 无法同时携带结果
+        content_type = http_request.headers.get("content-type", "")
+        if content_type.startswith("multipart/form-data"):
+            form = await http_request.form()
+            request = {key: json.loads(form[key]) for key in ("detect_result", "detect_results", "ocr_result", "ocr_results") if key in form}
+        elif content_type.startswith("application/json"):
+            request = await http_request.json()
+        else:
+            raise RequestError("/render 需要以 application/json 或 multipart/form-data 提交图片和 detect_result(s) / ocr_result(s)")
+        detect_results = request.get("detect_results", [request.get("detect_result")])
+        ocr_results = request.get("ocr_results", [request.get("ocr_result")])
+        return detect_results, ocr_results
+
+    async def infer(self, image_refs, digests, with_ocr, mask_symbols):
+        # 返回 (detect_results, ocr_results), ocr_results 在 with_ocr 为 False 时为 None
+        # digests 为解码后像素的哈希, 下游部署用它查结果缓存
+        detect_coro = self.detect_responder.detect_batch.remote(image_refs, digests)
+        if not with_ocr:
+            return await detect_coro, None
+        if mask_symbols:
+            # 先检测, 再把符号框交给 OCR 遮挡无文字符号的内部
+            detect_results = await detect_coro
+            return detect_results, await self.ocr_responder.ocr_batch.remote(image_refs, detect_results, digests)
+        # 检测和 OCR 在同一份解码图片上并行执行
+        return await asyncio.gather(detect_coro, self.ocr_responder.ocr_batch.remote(image_refs, None, digests))
+
+    async def render(self, image_refs, detect_results, ocr_results=None):
+        # 在结果中补充 image_with_box / draw_image, 只在显式请求时执行
+        async def render_detect(image_ref, result):
+            result["image_with_box"] = await self.detect_responder.render.remote(image_ref, result)
+
+        async def render_ocr(image_ref, result):
+            result["draw_image"] = await self.ocr_responder.render.remote(image_ref, result)
+
+        await asyncio.gather(
+            *[render_detect(image_ref, result) for image_ref, result in zip(image_refs, detect_results or []) if result],
+            *[render_ocr(image_ref, result) for image_ref, result in zip(image_refs, ocr_results or []) if result],
+        )
+
     async def __call__(self,http_request):
         try:
-            request = await http_request.json()
-            image = request["image"]
-            detect_result = await self.detect_responder.remote(image)
-            response = {"detect_result":detect_result}
+            # 只在 ingress 解码一次, 之后在部署间只传递对象存储中的 ndarray 引用
+            images = await self.read_images(http_request)
+            image_refs = [ray.put(image) for image in images]
+            path = http_request.url.path.rstrip("/")
+            if path.endswith("/render"):
+                # 根据调用方缓存的检测 / OCR 结果画图, 不做推理
+                detect_results, ocr_results = await self.read_results(http_request)
+                await self.render(image_refs, detect_results, ocr_results)
+                batch = len(image_refs) > 1
+            else:
+                # ?ocr=false 只做检测; ?mask_symbols=true 先检测再 OCR; ?render=true 在结果中附带画好的图片
+                params = http_request.query_params
+                with_ocr = params.get("ocr", "true").lower() != "false"
+                mask_symbols = params.get("mask_symbols", "false").lower() == "true"
+                batch = path.endswith("/batch")
+                digests = [image_digest(image) for image in images]
+                detect_results, ocr_results = await self.infer(image_refs, digests, with_ocr, mask_symbols)
+                if params.get("render", "false").lower() == "true":
+                    await self.render(image_refs, detect_results, ocr_results)
+            if batch:
+                response = {"detect_results":detect_results}
+                if ocr_results is not None:
+                    response["ocr_results"] = ocr_results
+            else:
+                response = {"detect_result":detect_results[0]}
+                if ocr_results is not None:
+                    response["ocr_result"] = ocr_results[0]
             json_response = json.dumps(response,cls = CustomJSONEncoder)
             return  json_response
             # return response
+        except RequestError as e:
+            self.logger.warning(f"Bad request : {e}")
+            return Response(json.dumps({"error": str(e)}, ensure_ascii=False), status_code=400, media_type="application/json")
         except Exception as e:
             self.logger.error(f"Error : {e}")
             return json.dumps({"error":"服务异常"})
             # 根据需要处理异常
         
 
-objectdetect_responder = ObjectDetect.bind(CvConverter.bind())
-# ocrtransform_responder = OCRTransform.bind(converter.bind())
-# cad_detect = CADDetect.options(route_prefix="/caddetect").bind(objectdetect_responder, ocrtransform_responder)
-cad_detect = CADDetect.options(route_prefix="/caddetect").bind(objectdetect_responder)
\ No newline at end of file
+objectdetect_responder = ObjectDetect.bind()
+ocrtransform_responder = OCRTransform.bind()
+cad_detect = CADDetect.options(route_prefix="/caddetect").bind(objectdetect_responder, ocrtransform_responder)
\ No newline at end of file
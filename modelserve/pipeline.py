@@ -1,3 +1,4 @@
+import logging
 import onnxruntime
 import numpy as np
 from paddleocr import PaddleOCR, draw_ocr
@@ -6,6 +7,8 @@ import cv2
 from utils import utils
 from utils.polt import Annotator,colors
 
+logger = logging.getLogger(__name__)
+
 class YOLOv5ONNXPipeline:
     def __init__(self, 
                  onnx_model_path, 
@@ -18,10 +21,19 @@ class YOLOv5ONNXPipeline:
                  hide_labels=False, 
                  hide_conf=True,
                  half=False,
-                 threshold = 0.2):
+                 threshold = 0.2,
+                 agnostic=False,
+                 tile_size=None,
+                 tile_overlap=0.25,
+                 tile_batch_size=16,
+                 blank_std=3.0,
+                 render=False):
         # 初始化ONNX运行时会话
         self.session = onnxruntime.InferenceSession(onnx_model_path)
         self.input_name = self.session.get_inputs()[0].name
+        # 静态导出的模型 batch 维为固定整数, 动态导出(--dynamic)时为字符串
+        batch_dim = self.session.get_inputs()[0].shape[0]
+        self.batch_size = batch_dim if isinstance(batch_dim, int) else None
         self.img_size = img_size
         self.conf_thres = conf_thres
         self.iou_thres = iou_thres
@@ -33,6 +45,14 @@ class YOLOv5ONNXPipeline:
         self.half = half
         self.labels_map = LabelMap.labels_map
         self.threshold = threshold
+        self.agnostic = agnostic
+        # 切片推理: tile_size 为 None 时整图缩放到 img_size, 否则按 tile_size 切片后分批推理
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+        self.blank_std = blank_std  # 灰度标准差低于该值的 tile 视为空白, 直接跳过
+        # 画框图只在 render 为 True 时随结果返回, 默认只做推理, 需要时通过 render() 按检测结果补画
+        self.render_result = render
         self.ration = 0
         self.font = "msyh.ttc"
         self.colors = colors
@@ -58,57 +78,45 @@ class YOLOv5ONNXPipeline:
       
         return image
     
+    def inference(self, images):
+        # images: (N,3,H,W), 模型 batch 维固定时按固定大小分块推理, 不足的块补零
+        if self.batch_size is None or len(images) == self.batch_size:
+            return self.session.run(None, {self.input_name: images})[0].astype(np.float32)
+        preds = []
+        for i in range(0, len(images), self.batch_size):
+            chunk = images[i:i + self.batch_size]
+            n = len(chunk)
+            if n < self.batch_size:
+                chunk = np.concatenate([chunk, np.zeros((self.batch_size - n,) + chunk.shape[1:], dtype=chunk.dtype)])
+            preds.append(self.session.run(None, {self.input_name: chunk})[0][:n])
+        return np.concatenate(preds).astype(np.float32)
+
     def detect_image(self, image):
-        pred = self.session.run(None, {self.input_name: image})[0]  # 执行推理
-        pred = pred.astype(np.float32)
+        pred = self.inference(image)  # 执行推理
         pred = np.squeeze(pred, axis=0)
-        boxes = []
-        classIds = []
-        confidences = []
-        for detection in pred:
-            scores = detection[5:]
-            classID = np.argmax(scores)
-            confidence = scores[classID] * detection[4]  # 置信度为类别的概率和目标框概率值得乘积
-
-            if confidence > self.threshold:
-                box = detection[0:4]
-                (centerX, centerY, width, height) = box.astype("int")
-                x = int(centerX - (width / 2))
-                y = int(centerY - (height / 2))
-                boxes.append([x, y, int(width), int(height)])
-                classIds.append(classID)
-                confidences.append(float(confidence))
-
+        # 向量化解码: 置信度为类别的概率和目标框概率值得乘积, 框为 xyxy
+        boxes, confidences, classIds = utils.decode_predictions(pred, self.threshold)
         return boxes, classIds, confidences
         
-    def postprocess_results(self,image, boxes, classIds, confidences):
+    def postprocess_results(self,image, boxes, classIds, confidences, scale=True):
         # YOLOv5的后处理步骤通常包括：
         # 1. 解析模型输出，通常包括边界框坐标、置信度和类别
         # 2. 应用阈值来过滤低置信度的预测
         # 3. 应用非极大值抑制（NMS）来去除重叠的边界框
-        idxs = cv2.dnn.NMSBoxes(boxes, confidences, self.threshold, self.iou_thres)  # 执行nms算法
-        pred_boxes = []
-        pred_confes = []
-        pred_classes = []
-        pred_texts = []
-        if len(idxs) > 0:
-            for i in idxs.flatten():
-                confidence = confidences[i]
-                if confidence >= self.threshold:
-                    # 进行坐标还原
-                    box = boxes[i]
-                    left, top, right, bottom = (box[0], box[1], box[0] + box[2], box[1] + box[3])
-                    box = [left, top, right, bottom]
-                    box = np.squeeze(
-                        utils.scale_coords(self.img_size, np.expand_dims(box, axis=0).astype("float"), image.shape[:2]).round(), axis=0).astype(
-                        "int").tolist()
-                    pred_boxes.append(box)
-                    pred_confes.append(confidence)
-                    pred_classes.append(classIds[i])
-                    pred_texts.append(self.labels_map[classIds[i]])
+        idxs = utils.batched_nms(boxes, confidences, classIds, self.iou_thres, agnostic=self.agnostic)  # 按类别执行nms算法
+        if len(idxs) == 0:
+            return [], [], [], []
+        boxes = boxes[idxs].astype("float")
+        if scale:
+            # 进行坐标还原
+            boxes = utils.scale_coords(self.img_size, boxes, image.shape[:2])
+        pred_boxes = boxes.round().astype("int").tolist()
+        pred_confes = confidences[idxs].tolist()
+        pred_classes = classIds[idxs].tolist()
+        pred_texts = [self.labels_map[classId] for classId in pred_classes]
         return pred_boxes, pred_classes, pred_confes,pred_texts
     
-    def draw_image_with_bbox(self, image, boxes, classIds, confidences):
+    def draw_image_with_bbox(self, image, boxes, classIds, confidences, save_path=None):
         annotator = Annotator(image, example=str("闸阀"),font_size=12,font=self.font,pil=True)
         for i, _ in enumerate(boxes):
             box = boxes[i]
@@ -120,28 +128,77 @@ class YOLOv5ONNXPipeline:
                 annotator.box_label(box= box, label= className, color=color,rotated = False)
                 
         im0 = annotator.result()
-        cv2.imwrite("run/output.jpg", im0)
+        if save_path:
+            cv2.imwrite(save_path, im0)
         return im0
+
+    def render(self, image, result):
+        # 根据已有的检测结果画框, 返回 base64 图片
+        image_with_box = self.draw_image_with_bbox(image, result["boxes"], result["classIds"], result["confidences"])
+        return utils.convertBase64(image_with_box)
         
-    def __call__(self, image):
-        # 预处理图像
-        image_deal = self.preprocess_image(image.copy())
-        # 推理
-        boxes, classIds, confidences = self.detect_image(image_deal)
+    def build_result(self, image, boxes, classIds, confidences, scale=True):
         # 后处理
-        boxes, classIds, confidences,texts = self.postprocess_results(image,boxes, classIds, confidences)
-        # 画图传回去
-        image_with_box = self.draw_image_with_bbox(image, boxes, classIds, confidences)
-        image_base64_str = utils.convertBase64(image_with_box)
+        boxes, classIds, confidences,texts = self.postprocess_results(image,boxes, classIds, confidences, scale=scale)
         result = {
-            "image_with_box":image_base64_str,
             "boxes":boxes, 
             "classIds":classIds, 
             "classtexts":texts, 
             "confidences": [round(num, 2) for num in confidences]
             }
+        if self.render_result:
+            # 画图传回去
+            result["image_with_box"] = self.render(image, result)
+        return result
+
+    def predict_tiled(self, image):
+        # 大图按 tile_size 切成带重叠的 tile, 跳过空白 tile, 其余分批推理, 坐标还原到全图后统一做 nms
+        h, w = image.shape[:2]
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        step = max(1, int(self.tile_size * (1 - self.tile_overlap)))
+        origins = [(x, y) for y in utils.tile_origins(h, self.tile_size, step) for x in utils.tile_origins(w, self.tile_size, step)]
+        tiles = [(x, y) for x, y in origins if gray[y:y + self.tile_size, x:x + self.tile_size].std() >= self.blank_std]
+        all_boxes = [np.zeros((0, 4), dtype=np.float32)]
+        all_confidences = [np.zeros(0, dtype=np.float32)]
+        all_classIds = [np.zeros(0, dtype=int)]
+        for i in range(0, len(tiles), self.tile_batch_size):
+            chunk = tiles[i:i + self.tile_batch_size]
+            crops = [image[y:y + self.tile_size, x:x + self.tile_size] for x, y in chunk]
+            preds = self.inference(np.concatenate([self.preprocess_image(crop) for crop in crops], axis=0))
+            for (x, y), crop, pred in zip(chunk, crops, preds):
+                boxes, confidences, classIds = utils.decode_predictions(pred, self.threshold)
+                # tile 内坐标还原后平移到全图坐标
+                boxes = utils.scale_coords(self.img_size, boxes, crop.shape[:2]) + np.array([x, y, x, y], dtype=boxes.dtype)
+                all_boxes.append(boxes)
+                all_confidences.append(confidences)
+                all_classIds.append(classIds)
+        logger.debug("tiles: %d inferred: %d skipped: %d", len(origins), len(tiles), len(origins) - len(tiles))
+        result = self.build_result(image, np.concatenate(all_boxes), np.concatenate(all_classIds), np.concatenate(all_confidences), scale=False)
+        result["tiles"] = {"total": len(origins), "inferred": len(tiles)}
         return result
 
+    def predict_batch(self, images):
+        if self.tile_size:
+            return [self.predict_tiled(image) for image in images]
+        # 多张图片 letterbox 后拼成一个 (N,3,H,W) 张量, 执行一次推理后按图片拆分结果
+        # letterbox 不修改原图, 输入可以是对象存储中的只读 ndarray, 无需复制
+        batch = np.concatenate([self.preprocess_image(image) for image in images], axis=0)
+        preds = self.inference(batch)
+        results = []
+        for image, pred in zip(images, preds):
+            boxes, confidences, classIds = utils.decode_predictions(pred, self.threshold)
+            results.append(self.build_result(image, boxes, classIds, confidences))
+        return results
+
+    def __call__(self, image):
+        if self.tile_size:
+            return self.predict_tiled(image)
+        # 预处理图像
+        image_deal = self.preprocess_image(image.copy())
+        # 推理
+        boxes, classIds, confidences = self.detect_image(image_deal)
+        return self.build_result(image, boxes, classIds, confidences)
+
 class YOLOv8SegmentationPipeline:
     def __init__(self, onnx_model_path):
         # 初始化ONNX模型
@@ -189,21 +246,115 @@ class YOLOv8SegmentationPipeline:
         return segmentation
 
 class OCRPipeline:
-    def __init__(self,use_angle_cls=True, lang="ch",use_gpu=True):
-        self.ocr = PaddleOCR(use_angle_cls=use_angle_cls, lang=lang,use_gpu=use_gpu)  # 这里设置为中文识    
+    def __init__(self,use_angle_cls=True, lang="ch",use_gpu=True,
+                 tile_size=None,
+                 tile_overlap=0.2,
+                 blank_std=3.0,
+                 rec_batch_num=32,
+                 drop_score=0.5,
+                 seam_thres=0.5,
+                 text_symbol_classes=("仪表", "装置"),
+                 mask_margin=2,
+                 render=False):
+        self.ocr = PaddleOCR(use_angle_cls=use_angle_cls, lang=lang,use_gpu=use_gpu,rec_batch_num=rec_batch_num)  # 这里设置为中文识    
+        self.use_angle_cls = use_angle_cls
+        # 切片 OCR: tile_size 为 None 时整图交给 PaddleOCR(检测模型内部会把长边缩放到 960, 大图上的小字会丢失)
+        # 否则按 tile_size 切片检测文字, 全图的文本框合并后分批识别
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.blank_std = blank_std  # 灰度标准差低于该值的 tile 视为空白, 不做文字检测
+        self.drop_score = drop_score
+        self.seam_thres = seam_thres
+        # 带位号的符号(仪表、设备)内部有文字, 不遮挡; 其余符号内部用白色填充, 避免线条被误检为文字
+        self.text_symbol_classes = set(text_symbol_classes)
+        self.mask_margin = mask_margin
+        # draw_ocr 逐行用 TrueType 字体绘制文字, 代价较高, 只在 render 为 True 时随结果返回
+        self.render_result = render
 
     def preprocess_image(self,image):
         return image
 
-    def postprocess_results(self,original_image,result):
+    def mask_symbols(self, image, symbols=None):
+        # symbols: YOLO 检测结果, 使用其中的 boxes(xyxy) 和 classtexts
+        if not symbols or not symbols.get("boxes"):
+            return image
+        masked = image.copy()
+        m = self.mask_margin
+        for box, classtext in zip(symbols["boxes"], symbols.get("classtexts", [])):
+            if classtext in self.text_symbol_classes:
+                continue
+            x1, y1, x2, y2 = box
+            masked[max(0, y1 + m):max(0, y2 - m), max(0, x1 + m):max(0, x2 - m)] = 255
+        return masked
+
+    def detect_tiled(self, det_image):
+        # 大图切成带重叠的 tile 分别做文字检测, 跳过空白 tile, 检测框还原到全图后合并接缝处的重复框
+        h, w = det_image.shape[:2]
+        # 输入为 decode_image 解码的 BGR 图片, 与 PaddleOCR 一致
+        gray = cv2.cvtColor(det_image, cv2.COLOR_BGR2GRAY) if det_image.ndim == 3 else det_image
+        step = max(1, int(self.tile_size * (1 - self.tile_overlap)))
+        origins = [(x, y) for y in utils.tile_origins(h, self.tile_size, step) for x in utils.tile_origins(w, self.tile_size, step)]
+        tiles = [(x, y) for x, y in origins if gray[y:y + self.tile_size, x:x + self.tile_size].std() >= self.blank_std]
+        all_boxes = [np.zeros((0, 4, 2), dtype=np.float32)]
+        tile_ids = [np.zeros(0, dtype=int)]
+        for tile_id, (x, y) in enumerate(tiles):
+            dt_boxes, _ = self.ocr.text_detector(det_image[y:y + self.tile_size, x:x + self.tile_size])
+            if dt_boxes is None or len(dt_boxes) == 0:
+                continue
+            all_boxes.append(np.asarray(dt_boxes, dtype=np.float32) + np.array([x, y], dtype=np.float32))
+            tile_ids.append(np.full(len(dt_boxes), tile_id))
+        quads = utils.merge_text_boxes(np.concatenate(all_boxes), np.concatenate(tile_ids), self.seam_thres)
+        logger.debug("ocr tiles: %d detected: %d skipped: %d", len(origins), len(tiles), len(origins) - len(tiles))
+        return quads, {"total": len(origins), "detected": len(tiles)}
 
-        draw_image = self.draw_text_on_white_image(original_image,result)
+    def detect_text(self, image, symbols=None):
+        # 文字检测: 返回按阅读顺序排列的文本框 (4,2) 和切片统计 (未切片时为 None)
+        det_image = self.mask_symbols(image, symbols)
+        if self.tile_size and max(image.shape[:2]) > self.tile_size:
+            quads, tiles = self.detect_tiled(det_image)
+        else:
+            dt_boxes, _ = self.ocr.text_detector(det_image)
+            quads = [np.asarray(box, dtype=np.float32) for box in (dt_boxes if dt_boxes is not None else [])]
+            tiles = None
+        quads.sort(key=lambda q: (q[:, 1].min(), q[:, 0].min()))  # 阅读顺序
+        return quads, tiles
+
+    def ocr_batch(self, requests):
+        """
+        一批图片的 OCR: 逐图(或逐 tile)检测文字, 再把所有图片的文本框裁剪到一起, 方向分类和识别各只调用一次
+        识别模型按 rec_batch_num 分批推理, 多张图片的文本框可以凑满批次
+        :param requests: [(image, symbols), ...], symbols 为该图的检测结果, 用于遮挡无文字符号, 可为 None
+        :return: 每张图片的 OCR 结果, 与 requests 一一对应
+        """
+        images = [self.preprocess_image(image) for image, _ in requests]
+        detected = [self.detect_text(image, symbols) for image, (_, symbols) in zip(images, requests)]
+        # 从原图裁剪文本框, 遮挡只用于检测
+        crops = [utils.crop_text_region(image, quad) for image, (quads, _) in zip(images, detected) for quad in quads]
+        rec_res = []
+        if crops:
+            if self.use_angle_cls:
+                crops, _, _ = self.ocr.text_classifier(crops)
+            rec_res, _ = self.ocr.text_recognizer(crops)
+        results = []
+        offset = 0
+        for image, (quads, tiles) in zip(images, detected):
+            lines = zip(quads, rec_res[offset:offset + len(quads)])
+            offset += len(quads)
+            result = [[quad.tolist(), (text, float(score))] for quad, (text, score) in lines if score >= self.drop_score]
+            detections = self.postprocess_results(image, result)
+            if tiles is not None:
+                detections["tiles"] = tiles
+            results.append(detections)
+        return results
+
+    def postprocess_results(self,original_image,result):
         # 准备JSON格式的数据结构
         ocr_results = {
-            "draw_image":utils.convertBase64(draw_image),
             "detections": [],
             "texts":[line[1][0] for line in result]
         }
+        if self.render_result:
+            ocr_results["draw_image"] = utils.convertBase64(self.draw_text_on_white_image(original_image,result))
 
         # 遍历PaddleOCR的输出结果
         for line in result:
@@ -222,14 +373,16 @@ class OCRPipeline:
         scores = [line[1][1] for line in result]
         im_show = draw_ocr(image, boxes, txts, scores, font_path=font_path)
         return im_show
+
+    def render(self, image, ocr_result):
+        # 根据已有的 OCR 结果绘制, 返回 base64 图片
+        result = [[detection["bbox"], (detection["text"], detection["confidence"])] for detection in ocr_result["detections"]]
+        return utils.convertBase64(self.draw_text_on_white_image(image, result))
     
  
     
-    def __call__(self, image):
-        image_deal = self.preprocess_image(image)
-        results = self.ocr.ocr(image_deal)
-        detections= self.postprocess_results(image,results[0])
-        return detections
+    def __call__(self, image, symbols=None):
+        return self.ocr_batch([(image, symbols)])[0]
 
 
     
\ No newline at end of file
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+YOLOv5 输出解码的微基准: 逐行 for 循环 vs 向量化 decode_predictions + batched_nms
+
+在 modelserve 目录下运行:
+    python -m tests.benchmark_decode --weights models/yolov5x_cad_gpu_1.0.onnx --source ../backend/images
+不提供 --weights 时使用随机生成的 (25200, 5+nc) 输出
+"""
+import argparse
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+
+from utils import utils
+
+
+def decode_loop(pred, threshold, iou_thres):
+    # 原 YOLOv5ONNXPipeline.detect_image / postprocess_results 的逐行实现, 作为对照
+    boxes = []
+    classIds = []
+    confidences = []
+    for detection in pred:
+        scores = detection[5:]
+        classID = np.argmax(scores)
+        confidence = scores[classID] * detection[4]
+        if confidence > threshold:
+            box = detection[0:4]
+            (centerX, centerY, width, height) = box.astype("int")
+            x = int(centerX - (width / 2))
+            y = int(centerY - (height / 2))
+            boxes.append([x, y, int(width), int(height)])
+            classIds.append(classID)
+            confidences.append(float(confidence))
+    idxs = cv2.dnn.NMSBoxes(boxes, confidences, threshold, iou_thres)
+    return [boxes[i] for i in np.asarray(idxs, dtype=int).reshape(-1)]
+
+
+def decode_vectorized(pred, threshold, iou_thres):
+    boxes, confidences, classIds = utils.decode_predictions(pred, threshold)
+    idxs = utils.batched_nms(boxes, confidences, classIds, iou_thres)
+    return boxes[idxs]
+
+
+def load_predictions(opt):
+    if not opt.weights:
+        rng = np.random.default_rng(0)
+        pred = rng.random((opt.rows, 5 + opt.nc), dtype=np.float32)
+        pred[:, :4] *= opt.img_size
+        pred[:, 4] **= 64  # 模拟真实输出中绝大多数行 obj_conf 很低
+        return [pred]
+
+    import onnxruntime
+    session = onnxruntime.InferenceSession(opt.weights)
+    input_name = session.get_inputs()[0].name
+    half = "float16" in session.get_inputs()[0].type
+    preds = []
+    for path in sorted(glob.glob(os.path.join(opt.source, "*.jpg")))[:opt.max_images]:
+        image, _ = utils.letterbox(cv2.imread(path), new_shape=opt.img_size)
+        image = np.ascontiguousarray(image[:, :, ::-1].transpose(2, 0, 1))
+        image = np.expand_dims(image.astype(np.float16 if half else np.float32) / 255.0, axis=0)
+        pred = session.run(None, {input_name: image})[0]
+        preds.append(np.squeeze(pred.astype(np.float32), axis=0))
+    return preds
+
+
+def timeit(fn, preds, opt):
+    start = time.perf_counter()
+    for _ in range(opt.repeat):
+        for pred in preds:
+            fn(pred, opt.conf_thres, opt.iou_thres)
+    return (time.perf_counter() - start) / (opt.repeat * len(preds)) * 1000
+
+
+def main(opt):
+    preds = load_predictions(opt)
+    print(f"{len(preds)} prediction(s), shape {preds[0].shape}")
+    for pred in preds:
+        n_loop = len(decode_loop(pred, opt.conf_thres, opt.iou_thres))
+        n_vec = len(decode_vectorized(pred, opt.conf_thres, opt.iou_thres))
+        print(f"kept boxes  loop(agnostic): {n_loop:5d}  vectorized(per class): {n_vec:5d}")
+    t_loop = timeit(decode_loop, preds, opt)
+    t_vec = timeit(decode_vectorized, preds, opt)
+    print(f"loop:       {t_loop:8.2f} ms/image")
+    print(f"vectorized: {t_vec:8.2f} ms/image  ({t_loop / t_vec:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weights", type=str, default="", help="onnx 模型路径, 为空时使用随机输出")
+    parser.add_argument("--source", type=str, default="../backend/images", help="CAD 图片目录")
+    parser.add_argument("--max-images", type=int, default=10)
+    parser.add_argument("--img-size", type=int, default=640)
+    parser.add_argument("--conf-thres", type=float, default=0.2)
+    parser.add_argument("--iou-thres", type=float, default=0.45)
+    parser.add_argument("--rows", type=int, default=25200)
+    parser.add_argument("--nc", type=int, default=80)
+    parser.add_argument("--repeat", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+decode_predictions + batched_nms 与原逐行解码的结果对比
+
+在 modelserve 目录下运行:
+    python -m pytest tests/test_decode.py
+"""
+import unittest
+
+import cv2
+import numpy as np
+
+from utils import utils
+
+
+def decode_loop(pred, threshold, iou_thres):
+    # 原 YOLOv5ONNXPipeline 的逐行解码 + cv2.dnn.NMSBoxes, 返回 xyxy 框、类别和置信度
+    boxes = []
+    classIds = []
+    confidences = []
+    for detection in pred:
+        scores = detection[5:]
+        classID = np.argmax(scores)
+        confidence = scores[classID] * detection[4]
+        if confidence > threshold:
+            (centerX, centerY, width, height) = detection[0:4].astype("int")
+            x = int(centerX - (width / 2))
+            y = int(centerY - (height / 2))
+            boxes.append([x, y, int(width), int(height)])
+            classIds.append(classID)
+            confidences.append(float(confidence))
+    idxs = np.asarray(cv2.dnn.NMSBoxes(boxes, confidences, threshold, iou_thres), dtype=int).reshape(-1)
+    xyxy = [[boxes[i][0], boxes[i][1], boxes[i][0] + boxes[i][2], boxes[i][1] + boxes[i][3]] for i in idxs]
+    return xyxy, [int(classIds[i]) for i in idxs], [confidences[i] for i in idxs]
+
+
+def decode_vectorized(pred, threshold, iou_thres):
+    boxes, confidences, classIds = utils.decode_predictions(pred, threshold)
+    idxs = utils.batched_nms(boxes, confidences, classIds, iou_thres)
+    return boxes[idxs].tolist(), classIds[idxs].tolist(), confidences[idxs].tolist()
+
+
+def make_pred(rng, rows, nc, img_size=640):
+    # 中心点和宽高取偶数, 原实现的 int 截断不改变坐标, 两种解码的框可以直接比较
+    pred = np.zeros((rows, 5 + nc), dtype=np.float32)
+    pred[:, 2:4] = rng.integers(5, 40, (rows, 2)) * 2
+    pred[:, 0:2] = rng.integers(40, img_size // 2 - 40, (rows, 2)) * 2
+    pred[:, 4] = rng.uniform(0, 1, rows)
+    pred[:, 5:] = rng.uniform(0, 1, (rows, nc))
+    return pred
+
+
+def sorted_by_score(boxes, classIds, confidences):
+    order = sorted(range(len(confidences)), key=lambda i: -confidences[i])
+    return [boxes[i] for i in order], [classIds[i] for i in order], [confidences[i] for i in order]
+
+
+class DecodeTest(unittest.TestCase):
+    def test_matches_row_loop(self):
+        rng = np.random.default_rng(0)
+        nc = 4
+        for _ in range(5):
+            pred = make_pred(rng, 300, nc)
+            # 每类一份坐标: 不同类别的框互不重叠, 逐类 nms 与原来的全局 nms 结果相同
+            pred[:, 5:] = 0
+            classes = rng.integers(0, nc, len(pred))
+            pred[np.arange(len(pred)), 5 + classes] = rng.uniform(0.5, 1, len(pred))
+            pred[:, 0] += classes * 1280
+            expected = sorted_by_score(*decode_loop(pred, 0.25, 0.45))
+            boxes, classIds, confidences = sorted_by_score(*decode_vectorized(pred, 0.25, 0.45))
+            self.assertGreater(len(boxes), 0)
+            np.testing.assert_array_equal(np.array(boxes), np.array(expected[0], dtype=np.float32))
+            self.assertEqual(classIds, expected[1])
+            np.testing.assert_allclose(confidences, expected[2], rtol=1e-6)
+
+    def test_overlapping_boxes_of_different_classes_are_kept(self):
+        # 两个几乎重合的框: 不同类别时都保留, 同一类别时只保留置信度高的
+        pred = np.zeros((2, 7), dtype=np.float32)
+        pred[:, :5] = [[100, 100, 40, 40, 0.9], [102, 100, 40, 40, 0.8]]
+        pred[0, 5] = pred[1, 6] = 1.0
+        boxes, classIds, confidences = decode_vectorized(pred, 0.25, 0.45)
+        self.assertEqual(sorted(classIds), [0, 1])
+        self.assertEqual(len(decode_loop(pred, 0.25, 0.45)[0]), 1)  # 原实现的全局 nms 会抑制其中一个
+
+        pred[1, 5:] = [1.0, 0.0]
+        boxes, classIds, confidences = decode_vectorized(pred, 0.25, 0.45)
+        self.assertEqual(classIds, [0])
+        self.assertAlmostEqual(confidences[0], 0.9, places=6)
+
+    def test_empty(self):
+        pred = make_pred(np.random.default_rng(1), 10, 3)
+        pred[:, 4] = 0.1
+        boxes, classIds, confidences = decode_vectorized(pred, 0.25, 0.45)
+        self.assertEqual((boxes, classIds, confidences), ([], [], []))
+
+
+if __name__ == "__main__":
+    unittest.main()
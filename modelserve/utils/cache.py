@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""
+检测 / OCR 结果的内容寻址缓存
+
+key 由解码后像素的哈希和模型版本、阈值等参数组成, 同一张图纸重复上传时直接返回缓存结果, 不再推理
+两级存储: 进程内 LRU + SQLite 磁盘缓存, 磁盘缓存可在同一节点的多个副本间共享, 按总大小淘汰最久未访问的条目
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.convert import CustomJSONEncoder
+
+
+def image_digest(image: np.ndarray) -> str:
+    """
+    解码后像素的哈希, 与图片的编码格式、压缩参数无关
+    :param image: HWC ndarray
+    :return: 32 位十六进制字符串
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{image.shape}:{image.dtype}".encode())
+    h.update(memoryview(np.ascontiguousarray(image)).cast("B"))
+    return h.hexdigest()
+
+
+def params_digest(*params) -> str:
+    # 模型版本和阈值等参数的哈希, 参数变化后旧的缓存条目自然失效
+    return hashlib.blake2b(json.dumps(params, sort_keys=True, cls=CustomJSONEncoder).encode(), digest_size=8).hexdigest()
+
+
+def file_version(path: str) -> str:
+    # 模型文件的版本: 文件名 + 大小 + 修改时间, 替换模型文件后缓存失效
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class ResultCache:
+    def __init__(self, path=None, memory_items=256, disk_bytes=1 << 30):
+        """
+        :param path: SQLite 文件路径, 为 None 时只使用内存缓存
+        :param memory_items: 内存 LRU 的最大条目数
+        :param disk_bytes: 磁盘缓存的最大字节数, 超过后按最近访问时间淘汰到 90%
+        """
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory": 0, "disk": 0, "miss": 0}
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get(self, key):
+        """
+        :return: (value, tier), tier 为 "memory" / "disk", 未命中时为 (None, "miss")
+        每次返回新的对象, 调用方可以修改结果而不影响缓存
+        """
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                tier = "memory"
+            elif self.db is not None:
+                row = self.db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    data = row[0]
+                    self.db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+                    self._remember(key, data)
+                tier = "disk"
+            if data is None:
+                tier = "miss"
+            self.stats[tier] += 1
+        return (json.loads(data) if data is not None else None), tier
+
+    def put(self, key, value):
+        data = json.dumps(value, cls=CustomJSONEncoder).encode()
+        with self.lock:
+            self._remember(key, data)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, data, len(data), time.time()))
+                self._evict()
+
+    def _remember(self, key, data):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.disk_bytes:
+            return
+        # 从最久未访问的条目开始删除, 直到总大小降到上限的 90%
+        excess = total - int(self.disk_bytes * 0.9)
+        freed = 0
+        keys = []
+        for key, size in self.db.execute("SELECT key, size FROM cache ORDER BY accessed"):
+            keys.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.db.executemany("DELETE FROM cache WHERE key = ?", keys)
@@ -1,8 +1,28 @@
+import base64
 import json
+import cv2
 import numpy as np
 
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, np.int64):
+        if isinstance(obj, np.integer):
             return int(obj)  # 将 int64 类型转换为普通的整数类型
-        return json.JSONEncoder.default(self, obj)
\ No newline at end of file
+        if isinstance(obj, np.floating):
+            return float(obj)  # PaddleOCR 的识别置信度为 np.float32
+        if isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return json.JSONEncoder.default(self, obj)
+
+def decode_image(data):
+    """
+    将图片的编码数据解码为 BGR 的 OpenCV 图片
+    :param data: 原始二进制数据(bytes/bytearray/memoryview) 或 base64 字符串
+    :return: HWC BGR ndarray
+    """
+    if isinstance(data, str):
+        data = base64.b64decode(data.split(",")[-1])  # 兼容 data:image/...;base64, 前缀
+    # np.frombuffer 直接引用 memoryview 的内存, 不复制编码数据
+    image = cv2.imdecode(np.frombuffer(memoryview(data), np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("无法解码图片数据")
+    return image
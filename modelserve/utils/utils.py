@@ -109,6 +109,129 @@ def scale_coords(img1_shape, coords, img0_shape, ratio_pad=None):
     clip_coords(coords, img0_shape)
     return coords
 
+def tile_origins(length, tile_size, step):
+    """
+    计算一个方向上切片的起点, 最后一片与图像边缘对齐, 保证整幅图都被覆盖
+    :param length: 图像在该方向上的长度
+    :param tile_size: 切片大小
+    :param step: 步长, tile_size 减去重叠
+    :return: 起点列表
+    """
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size + 1, step))
+    if origins[-1] + tile_size < length:
+        origins.append(length - tile_size)
+    return origins
+
+def xywh2xyxy(x):
+    """
+    中心点格式转换为角点格式
+    :param x: (n,4) [center_x, center_y, width, height]
+    :return: (n,4) [x1, y1, x2, y2]
+    """
+    y = x.copy() if isinstance(x, np.ndarray) else x.clone()
+    y[:, 0] = x[:, 0] - x[:, 2] / 2  # top left x
+    y[:, 1] = x[:, 1] - x[:, 3] / 2  # top left y
+    y[:, 2] = x[:, 0] + x[:, 2] / 2  # bottom right x
+    y[:, 3] = x[:, 1] + x[:, 3] / 2  # bottom right y
+    return y
+
+def decode_predictions(pred, conf_thres=0.25):
+    """
+    YOLOv5 原始输出的向量化解码, 一次处理整个 (n, 5+nc) 数组
+    :param pred: 模型输出 [center_x, center_y, width, height, obj_conf, cls_conf...]
+    :param conf_thres: 置信度阈值, 置信度为类别概率和目标框概率的乘积
+    :return: boxes (m,4) xyxy, confidences (m,), classIds (m,)
+    """
+    # cls_conf <= 1, obj_conf 即为置信度上界, 先按 obj_conf 粗筛, 只对候选框做 argmax
+    pred = pred[pred[:, 4] > conf_thres]
+    classIds = pred[:, 5:].argmax(axis=1)
+    confidences = pred[np.arange(len(pred)), classIds + 5] * pred[:, 4]
+    keep = confidences > conf_thres
+    return xywh2xyxy(pred[keep, :4]), confidences[keep], classIds[keep]
+
+def batched_nms(boxes, confidences, classIds, iou_thres=0.45, agnostic=False, max_wh=7680):
+    """
+    按类别进行非极大值抑制, 不同类别的框平移到互不重叠的区域后一次性执行 nms
+    :param boxes: (n,4) xyxy
+    :param confidences: (n,) 置信度
+    :param classIds: (n,) 类别
+    :param iou_thres: iou 阈值
+    :param agnostic: 为 True 时不区分类别
+    :param max_wh: 类别平移量, 需大于图像尺寸
+    :return: 保留框的索引, 按置信度降序
+    """
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=int)
+    offset = 0 if agnostic else classIds[:, None].astype(boxes.dtype) * max_wh
+    shifted = boxes + offset
+    xywh = np.concatenate((shifted[:, :2], shifted[:, 2:] - shifted[:, :2]), axis=1)
+    idxs = cv2.dnn.NMSBoxes(xywh.astype(np.float64), confidences.astype(np.float32), 0.0, iou_thres)
+    return np.asarray(idxs, dtype=int).reshape(-1)
+
+def crop_text_region(img, points):
+    """
+    按文本框四点做透视变换裁剪, 与 PaddleOCR 的 get_rotate_crop_image 一致, 竖排文本旋转为横排
+    :param img: HWC 图像
+    :param points: (4,2) 文本框四点坐标, 顺时针, 左上角开始
+    :return: 裁剪后的文本图像
+    """
+    points = np.asarray(points, dtype=np.float32)
+    width = max(1, int(max(np.linalg.norm(points[0] - points[1]), np.linalg.norm(points[2] - points[3]))))
+    height = max(1, int(max(np.linalg.norm(points[0] - points[3]), np.linalg.norm(points[1] - points[2]))))
+    pts_std = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    M = cv2.getPerspectiveTransform(points, pts_std)
+    crop = cv2.warpPerspective(img, M, (width, height), borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_CUBIC)
+    if crop.shape[0] * 1.0 / crop.shape[1] >= 1.5:
+        crop = np.rot90(crop)
+    return crop
+
+def merge_text_boxes(boxes, tile_ids, cross_thres=0.5):
+    """
+    合并切片接缝处的文本框: 重叠区内同一行文字会在相邻 tile 中各检测一次, 或被 tile 边缘截成两段
+    来自不同 tile 且相交的两个框, 在垂直于文字方向上的重叠比例(相对较小的框)超过 cross_thres 时视为同一行, 取外接矩形
+    :param boxes: (n,4,2) 全图坐标下的文本框四点
+    :param tile_ids: (n,) 文本框来源的 tile 编号, 同一 tile 内的框不合并
+    :param cross_thres: 垂直方向重叠比例阈值
+    :return: 合并后的文本框列表, 每个为 (4,2) float32
+    """
+    n = len(boxes)
+    if n == 0:
+        return []
+    x1, y1 = boxes[:, :, 0].min(axis=1), boxes[:, :, 1].min(axis=1)
+    x2, y2 = boxes[:, :, 0].max(axis=1), boxes[:, :, 1].max(axis=1)
+    w, h = x2 - x1, y2 - y1
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(n - 1):
+        j = np.arange(i + 1, n)
+        iw = np.minimum(x2[i], x2[j]) - np.maximum(x1[i], x1[j])
+        ih = np.minimum(y2[i], y2[j]) - np.maximum(y1[i], y1[j])
+        # 横排文字比较 y 方向的重叠, 竖排文字比较 x 方向的重叠
+        horizontal = np.maximum(w[i], w[j]) >= np.maximum(h[i], h[j])
+        cross = np.where(horizontal, ih / np.maximum(np.minimum(h[i], h[j]), 1e-6), iw / np.maximum(np.minimum(w[i], w[j]), 1e-6))
+        same = (iw > 0) & (ih > 0) & (tile_ids[j] != tile_ids[i]) & (cross >= cross_thres)
+        for k in j[same]:
+            parent[find(k)] = find(i)
+
+    roots = np.array([find(i) for i in range(n)])
+    merged = []
+    for root in np.unique(roots):
+        members = np.flatnonzero(roots == root)
+        if len(members) == 1:
+            merged.append(boxes[root].astype(np.float32))
+        else:
+            bx1, by1, bx2, by2 = x1[members].min(), y1[members].min(), x2[members].max(), y2[members].max()
+            merged.append(np.array([[bx1, by1], [bx2, by1], [bx2, by2], [bx1, by2]], dtype=np.float32))
+    return merged
+
 def non_max_suppression(
     prediction,
     conf_thres=0.25,